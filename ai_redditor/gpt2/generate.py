@@ -11,6 +11,10 @@ from transformers import (
     AutoModelWithLMHead
 )
 
+# The dedup index is shared with the web service, whose package must be on the
+# Python path (e.g. PYTHONPATH=web_service python ai_redditor/gpt2/generate.py ...).
+from ai_redditor_service.dedup import HashSet, BloomFilter, content_hash
+
 parser = argparse.ArgumentParser(description='Generate text from a model with an language modelling head.')
 parser.add_argument('model_name_or_path', type=str, help='The model checkpoint for weights initialization (i.e. a pretrained model).')
 parser.add_argument('--output', type=Path, default=None, help='Output file name.')
@@ -47,6 +51,13 @@ parser.add_argument('--hide-logs', action='store_true', help='Hide INFO log stat
 parser.add_argument('--format', required=True, choices=['qa', 'phc'], help='The format of generated text. ' +
                     'One of \'qa\' (query-answer), \'phc\'.')
 parser.add_argument('--no-duplicates', action='store_true', help='Don\'t generate any duplicate records. Defaults to False.')
+parser.add_argument('--dedup-index', type=Path, default=None, help='A Bloom filter file of the records generated by previous runs. ' +
+                    'Records in the filter are skipped and new records are added to it, so that runs can be deduplicated ' +
+                    'across restarts. Only used with --no-duplicates.')
+parser.add_argument('--dedup-capacity', type=int, default=10000000, help='The number of records that a new Bloom filter ' +
+                    'is sized for. Defaults to 10000000.')
+parser.add_argument('--dedup-error-rate', type=float, default=1e-4, help='The false positive rate of a new Bloom filter ' +
+                    '(i.e. the rate of unique records wrongly skipped as duplicates). Defaults to 0.0001.')
 parser.add_argument('--filter', type=str, default=None, help='A regex filter applied on the decoded output. If the text matches this filter, it is skipped.')
 args = parser.parse_args()
 
@@ -155,7 +166,12 @@ class ProfileResult:
 decode_filter = re.compile(args.filter) if args.filter is not None else None
 
 results = []
-visited = set()
+visited = HashSet(max_size=max(args.samples, 1))
+dedup_index = None
+if args.no_duplicates and args.dedup_index is not None:
+    dedup_index = BloomFilter(args.dedup_index, capacity=args.dedup_capacity, error_rate=args.dedup_error_rate)
+    print('- Loaded dedup index from \'{}\''.format(args.dedup_index))
+
 profiling_results = []
 
 current_iteration = 0
@@ -252,14 +268,15 @@ with tqdm(total=args.samples) as progress_bar:
 
             # Strip all match groups
             groups = {key: value.strip() for key, value in groups.items()}
-            # Convert the groups dict to JSON and use it as a unique identifier.
-            groups_id = json.dumps(groups, sort_keys=True)
             if args.no_duplicates:
-                if groups_id in visited:
+                groups_hash = content_hash(groups, digest_size=16)
+                if groups_hash in visited or (dedup_index is not None and groups_hash in dedup_index):
                     progress_bar.write('- Generated duplicate. Skipping...')
                     continue
 
-                visited.add(groups_id)
+                visited.add(groups_hash)
+                if dedup_index is not None:
+                    dedup_index.add(groups_hash)
 
             n += 1
             results.append({
@@ -270,6 +287,9 @@ with tqdm(total=args.samples) as progress_bar:
             if args.output is not None and (len(results) + 1) % args.dump_batch == 0:
                 with open(args.output, 'w+') as output_file:
                     json.dump(results, output_file, indent=args.indent_json)
+
+                if dedup_index is not None:
+                    dedup_index.flush()
             
                 batch_index = (len(results) + 1) // args.dump_batch
                 progress_bar.write('Writing to file (batch {})'.format(batch_index))
@@ -285,6 +305,9 @@ if args.output is not None:
     with open(args.output, 'w+') as output_file:
         json.dump(results, output_file, indent=args.indent_json)
 
+if dedup_index is not None:
+    dedup_index.close()
+
 if args.print_results:
     print(results)
 
@@ -0,0 +1,222 @@
+'''
+Statically quantize a GPT-2 model to int8, calibrating the ranges of its activations
+on samples of its training dataset.
+
+The linear layers of the model (the Conv1D layers of each transformer block and,
+optionally, the language modelling head) are replaced by int8 layers whose inputs are
+quantized with the scale and zero point observed during calibration, rather than
+computed from every input at runtime as with dynamic quantization. The quantized model
+is saved as a TorchScript module along with its configuration and tokenizer, so that
+the output directory can be served with the "torchscript" inference engine of the web
+service (GPT2_ENGINE = 'torchscript').
+
+The perplexity on the test dataset and the decode throughput of the quantized model
+are reported next to those of the float model and of the dynamically quantized model
+(GPT2_QUANTIZE = True).
+
+'''
+
+import copy
+import json
+import time
+import torch
+import logging
+import argparse
+from pathlib import Path
+from transformers import (
+    set_seed,
+    AutoTokenizer,
+    AutoModelWithLMHead
+)
+from transformers.modeling_utils import Conv1D
+
+# The engines and evaluation functions are shared with the web service, whose package
+# must be on the Python path (e.g. PYTHONPATH=web_service python ai_redditor/gpt2/quantize.py ...).
+from ai_redditor_service.engines import save_engine, load_engine
+from ai_redditor_service.gpt2 import get_model_nbytes
+from ai_redditor_service.evaluation import read_samples, get_perplexity, get_throughput
+
+class _StaticQuantizedLinear(torch.nn.Module):
+    '''
+    A linear layer whose input is quantized with a static (calibrated) scale
+    and zero point, and whose output is dequantized.
+
+    '''
+
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.linear = linear
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+def _conv1d_to_linear(module):
+    '''
+    Converts a :class:`transformers.modeling_utils.Conv1D` layer, whose weight is
+    transposed, to an equivalent :class:`torch.nn.Linear` layer.
+
+    '''
+
+    linear = torch.nn.Linear(module.weight.size(0), module.weight.size(1))
+    linear.weight.data = module.weight.data.t().contiguous()
+    linear.bias.data = module.bias.data
+    return linear
+
+def prepare_static_quantization(model, backend='fbgemm', quantize_lm_head=False):
+    '''
+    Replaces the linear layers of a model by layers observing the ranges of their
+    inputs and outputs, ready to be calibrated.
+
+    :param model:
+        The :class:`transformers.PreTrainedModel` to quantize. It is modified in place.
+    :param backend:
+        The quantized kernel backend (``fbgemm`` for x86, ``qnnpack`` for ARM).
+        Defaults to ``fbgemm``.
+    :param quantize_lm_head:
+        Whether to quantize the language modelling head. Defaults to False,
+        since the logits are then also quantized to 8 bits.
+    :returns:
+        The prepared model.
+
+    '''
+
+    replaced = []
+    for name, module in model.named_modules():
+        if isinstance(module, Conv1D):
+            replaced.append((name, _conv1d_to_linear(module)))
+        elif quantize_lm_head and name == 'lm_head':
+            replaced.append((name, module))
+
+    modules = dict(model.named_modules())
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    for name, linear in replaced:
+        parent_name, _, child_name = name.rpartition('.')
+        wrapper = _StaticQuantizedLinear(linear)
+        # Only the wrapped layers are quantized; the rest of the model stays float.
+        wrapper.qconfig = qconfig
+        setattr(modules[parent_name], child_name, wrapper)
+
+    torch.backends.quantized.engine = backend
+    return torch.quantization.prepare(model.eval(), inplace=True)
+
+@torch.no_grad()
+def calibrate(model, tokenizer, samples, block_size=256, batch_size=8):
+    '''
+    Runs samples through a prepared model so that its observers record the
+    ranges of the activations.
+
+    :param samples:
+        A list of the texts to calibrate on, including their special tokens.
+    :param block_size:
+        The maximum number of tokens per sample. Defaults to 256.
+    :param batch_size:
+        The number of samples per forward pass. Defaults to 8.
+
+    '''
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    token_ids = [tokenizer.encode(text, add_special_tokens=False)[:block_size] for text in samples]
+    # Batch samples of similar lengths, so that few padding positions are observed.
+    token_ids = sorted((x for x in token_ids if len(x) > 0), key=len)
+    for i in range(0, len(token_ids), batch_size):
+        batch = token_ids[i:i + batch_size]
+        max_length = max(len(x) for x in batch)
+        input_ids = torch.tensor([x + [pad_token_id] * (max_length - len(x)) for x in batch], dtype=torch.long)
+        attention_mask = torch.tensor([[1] * len(x) + [0] * (max_length - len(x)) for x in batch], dtype=torch.long)
+        model(input_ids, attention_mask=attention_mask, use_cache=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Statically quantize a GPT-2 model to int8, calibrating on its training dataset.')
+    parser.add_argument('model_name_or_path', type=str, help='The model checkpoint to quantize.')
+    parser.add_argument('train_dataset', type=Path, help='The preprocessed training dataset file (to calibrate on).')
+    parser.add_argument('test_dataset', type=Path, help='The preprocessed test dataset file (to report perplexity on).')
+    parser.add_argument('--outdir', type=Path, required=True, help='The directory to save the quantized model in.')
+    parser.add_argument('--tokenizer', default=None, type=str, help='Optional pretrained tokenizer name or path if not the same as the model ' +
+                        'checkpoint path.')
+    parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help='The quantized kernel backend: \'fbgemm\' (x86) or \'qnnpack\' (ARM). Defaults to \'fbgemm\'.')
+    parser.add_argument('--quantize-lm-head', action='store_true', help='Also quantize the language modelling head. ' +
+                        'Defaults to False.')
+    parser.add_argument('--calibration-samples', type=int, default=256, help='The number of training samples to calibrate on. ' +
+                        'Defaults to 256.')
+    parser.add_argument('--eval-samples', type=int, default=512, help='The number of test samples to compute the perplexity on. ' +
+                        'Defaults to 512. If -1, all test samples are used.')
+    parser.add_argument('--block-size', type=int, default=256, help='The maximum number of tokens per calibration sample. ' +
+                        'Defaults to 256.')
+    parser.add_argument('--batch-size', type=int, default=8, help='The number of samples per forward pass. Defaults to 8.')
+    parser.add_argument('--benchmark-batch-size', type=int, default=8, help='The number of sequences decoded at once when ' +
+                        'measuring throughput. Defaults to 8.')
+    parser.add_argument('--benchmark-steps', type=int, default=64, help='The number of decode steps when measuring throughput. ' +
+                        'Defaults to 64.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    set_seed(args.seed)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model_name_or_path)
+    model = AutoModelWithLMHead.from_pretrained(args.model_name_or_path).eval()
+    # The model is quantized in place; keep a float copy to compare against.
+    float_model = copy.deepcopy(model)
+
+    calibration_samples = read_samples(args.train_dataset, args.calibration_samples, seed=args.seed)
+    eval_samples = read_samples(
+        args.test_dataset, args.eval_samples if args.eval_samples >= 0 else None,
+        seed=args.seed
+    )
+
+    start_time = time.time()
+    prepare_static_quantization(model, backend=args.backend, quantize_lm_head=args.quantize_lm_head)
+    calibrate(model, tokenizer, calibration_samples, block_size=args.block_size, batch_size=args.batch_size)
+    torch.quantization.convert(model, inplace=True)
+    logging.info('Calibrated on {} samples ({} seconds)'.format(
+        len(calibration_samples), round(time.time() - start_time, 2)
+    ))
+
+    args.outdir.mkdir(parents=True, exist_ok=True)
+    filepath = save_engine(model, 'torchscript', args.outdir)
+    model.config.save_pretrained(str(args.outdir))
+    tokenizer.save_pretrained(str(args.outdir))
+    logging.info('Saved the quantized model to \'{}\''.format(filepath))
+
+    # The same dynamic quantization as load_model with quantize=True. Conv1D layers
+    # have no dynamically quantized counterpart, so only the head is quantized.
+    dynamic_model = torch.quantization.quantize_dynamic(
+        copy.deepcopy(float_model), {torch.nn.Linear, Conv1D}, dtype=torch.qint8
+    )
+
+    models = {
+        'float': float_model,
+        'dynamic': dynamic_model,
+        'static': load_engine(args.outdir, 'torchscript')
+    }
+
+    report = {}
+    for name, candidate in models.items():
+        set_seed(args.seed)
+        report[name] = {
+            'perplexity': get_perplexity(candidate, tokenizer, eval_samples, batch_size=args.batch_size),
+            'tokens_per_second': get_throughput(
+                candidate, len(tokenizer), batch_size=args.benchmark_batch_size,
+                steps=args.benchmark_steps
+            ),
+            'megabytes': get_model_nbytes(candidate) / 1024 ** 2
+        }
+
+        logging.info('{}: perplexity {:.3f}, {:.1f} tokens/s, {:.1f} MB'.format(
+            name, report[name]['perplexity'], report[name]['tokens_per_second'], report[name]['megabytes']
+        ))
+
+    with open(args.outdir / 'quantization_report.json', 'w+') as file:
+        json.dump({
+            'backend': args.backend,
+            'quantize_lm_head': args.quantize_lm_head,
+            'calibration_samples': len(calibration_samples),
+            'eval_samples': len(eval_samples),
+            'results': report
+        }, file, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+'''
+Build a restricted output vocabulary for a GPT-2 model from the tokens of its training
+dataset, so that its language modelling head only computes the logits of those tokens.
+
+The vocabulary (which always keeps the special tokens and the byte-level tokens of the
+tokenizer) is saved to the model directory, where the web service restricts the head of
+the model to it when loading the model (GPT2_RESTRICTED_VOCAB = True).
+
+The coverage of the vocabulary (the fraction of the tokens, and of the samples, of the
+test dataset that it can generate) is reported along with the time per decode step, and
+the time per step of the language modelling head alone, of the full and restricted models.
+
+'''
+
+import copy
+import json
+import time
+import torch
+import logging
+import argparse
+from pathlib import Path
+from transformers import (
+    set_seed,
+    AutoTokenizer,
+    AutoModelWithLMHead
+)
+
+# The restricted vocabularies and evaluation functions are shared with the web service, whose
+# package must be on the Python path (e.g. PYTHONPATH=web_service python ai_redditor/gpt2/restrict_vocab.py ...).
+from ai_redditor_service.evaluation import read_samples, get_throughput
+from ai_redditor_service.vocab import (
+    count_tokens,
+    get_coverage,
+    build_vocabulary,
+    save_vocabulary,
+    restrict_vocabulary
+)
+
+@torch.no_grad()
+def get_head_time(lm_head, hidden_size, batch_size=8, steps=256, runs=3):
+    '''
+    Measures the time per decode step, in seconds, of a language modelling head.
+
+    '''
+
+    hidden_states = torch.randn(batch_size, 1, hidden_size)
+    timings = []
+    # The first run warms up the head.
+    for _ in range(runs + 1):
+        start_time = time.time()
+        for _ in range(steps):
+            lm_head(hidden_states)
+
+        timings.append(time.time() - start_time)
+
+    return min(timings[1:]) / steps
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a restricted output vocabulary for a GPT-2 model from its training dataset.')
+    parser.add_argument('model_name_or_path', type=str, help='The model checkpoint to build the vocabulary for.')
+    parser.add_argument('train_dataset', type=Path, help='The preprocessed training dataset file (to build the vocabulary from).')
+    parser.add_argument('test_dataset', type=Path, help='The preprocessed test dataset file (to report coverage on).')
+    parser.add_argument('--outdir', type=Path, default=None, help='The directory to save the vocabulary in. Defaults to the ' +
+                        'model checkpoint directory.')
+    parser.add_argument('--tokenizer', default=None, type=str, help='Optional pretrained tokenizer name or path if not the same as the model ' +
+                        'checkpoint path.')
+    parser.add_argument('--min-count', type=int, default=1, help='The minimum number of occurrences of a training token to keep it. ' +
+                        'Defaults to 1.')
+    parser.add_argument('--max-size', type=int, default=None, help='The maximum size of the vocabulary (including the special and ' +
+                        'byte-level tokens). Defaults to no maximum.')
+    parser.add_argument('--benchmark-batch-size', type=int, default=8, help='The number of sequences decoded at once when ' +
+                        'measuring the time per step. Defaults to 8.')
+    parser.add_argument('--benchmark-steps', type=int, default=64, help='The number of decode steps when measuring the time per step. ' +
+                        'Defaults to 64.')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+    set_seed(args.seed)
+
+    outdir = args.outdir or Path(args.model_name_or_path)
+    if args.outdir is None and not outdir.is_dir():
+        raise ValueError('The model checkpoint \'{}\' is not a directory; use --outdir.'.format(args.model_name_or_path))
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model_name_or_path)
+    model = AutoModelWithLMHead.from_pretrained(args.model_name_or_path).eval()
+
+    train_counts = count_tokens(tokenizer, read_samples(args.train_dataset))
+    token_ids = build_vocabulary(tokenizer, train_counts, min_count=args.min_count, max_size=args.max_size)
+    filepath = save_vocabulary(token_ids, model.config.vocab_size, outdir)
+    logging.info('Saved a vocabulary of {} tokens (out of {}) to \'{}\''.format(
+        len(token_ids), model.config.vocab_size, filepath
+    ))
+
+    test_samples = read_samples(args.test_dataset)
+    kept = set(token_ids)
+    covered_samples = sum(
+        all(token_id in kept for token_id in tokenizer.encode(text, add_special_tokens=False))
+        for text in test_samples
+    )
+
+    coverage = {
+        'train_token_coverage': get_coverage(train_counts, token_ids),
+        'test_token_coverage': get_coverage(count_tokens(tokenizer, test_samples), token_ids),
+        'test_sample_coverage': covered_samples / max(len(test_samples), 1)
+    }
+
+    logging.info('Coverage: {:.4%} of training tokens, {:.4%} of test tokens, {:.4%} of test samples'.format(
+        coverage['train_token_coverage'], coverage['test_token_coverage'], coverage['test_sample_coverage']
+    ))
+
+    models = {
+        'full': model,
+        'restricted': restrict_vocabulary(copy.deepcopy(model), token_ids)
+    }
+
+    report = {}
+    for name, candidate in models.items():
+        set_seed(args.seed)
+        tokens_per_second = get_throughput(
+            candidate, model.config.vocab_size, batch_size=args.benchmark_batch_size,
+            steps=args.benchmark_steps
+        )
+
+        report[name] = {
+            'step_milliseconds': args.benchmark_batch_size / tokens_per_second * 1000,
+            'head_step_milliseconds': get_head_time(
+                candidate.lm_head, model.config.n_embd, batch_size=args.benchmark_batch_size,
+                steps=args.benchmark_steps
+            ) * 1000
+        }
+
+        logging.info('{}: {:.2f} ms per decode step, of which {:.2f} ms in the head'.format(
+            name, report[name]['step_milliseconds'], report[name]['head_step_milliseconds']
+        ))
+
+    logging.info('Speedup per decode step: {:.2f}x ({:.2f}x for the head)'.format(
+        report['full']['step_milliseconds'] / report['restricted']['step_milliseconds'],
+        report['full']['head_step_milliseconds'] / report['restricted']['head_step_milliseconds']
+    ))
+
+    with open(outdir / 'restricted_vocab_report.json', 'w+') as file:
+        json.dump({
+            'vocab_size': model.config.vocab_size,
+            'restricted_vocab_size': len(token_ids),
+            'min_count': args.min_count,
+            'max_size': args.max_size,
+            'coverage': coverage,
+            'results': report
+        }, file, indent=4)
+
+if __name__ == '__main__':
+    main()
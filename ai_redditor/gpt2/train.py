@@ -94,6 +94,187 @@ def get_checkpoints(directory, prefix='checkpoint', use_mtime=False, sort_ascend
 
     return [checkpoint for _, checkpoint in sorted(checkpoints, key=lambda x: x[0])]
 
+# The GPT2 modules that are adapted by default (by their name within each transformer block).
+_DEFAULT_LORA_TARGET_MODULES = ['attn.c_attn', 'attn.c_proj', 'mlp.c_fc', 'mlp.c_proj']
+
+LORA_CONFIG_FILENAME = 'adapter_config.json'
+LORA_WEIGHTS_FILENAME = 'adapter_model.bin'
+
+class LoRAConv1D(torch.nn.Module):
+    '''
+    A Conv1D layer of GPT2 whose (frozen) weights are updated by the product of two
+    trainable low-rank matrices (LoRA).
+
+    '''
+
+    def __init__(self, base, rank, alpha, dropout=0):
+        '''
+        Initializes an instance of :class:`LoRAConv1D`.
+
+        :param base:
+            The Conv1D layer to adapt.
+        :param rank:
+            The rank of the update.
+        :param alpha:
+            The scale of the update, which is multiplied by alpha over the rank.
+        :param dropout:
+            The dropout probability of the input of the update. Defaults to 0.
+
+        '''
+
+        super().__init__()
+        self.base = base
+        self.scale = alpha / rank
+        self.dropout = torch.nn.Dropout(dropout)
+
+        in_features, out_features = base.weight.shape
+        self.lora_A = torch.nn.Parameter(base.weight.new_empty(in_features, rank))
+        self.lora_B = torch.nn.Parameter(base.weight.new_zeros(rank, out_features))
+        # The same initialization as an input projection of shape (rank, in_features),
+        # so that the update starts at zero but its gradients do not.
+        torch.nn.init.kaiming_uniform_(self.lora_A.data.t(), a=math.sqrt(5))
+
+    def forward(self, x):
+        return self.base(x) + torch.matmul(torch.matmul(self.dropout(x), self.lora_A), self.lora_B) * self.scale
+
+class ExtendedEmbedding(torch.nn.Module):
+    '''
+    The (frozen) token embeddings of a model, followed by the trainable
+    embeddings of the special tokens added to its vocabulary.
+
+    '''
+
+    def __init__(self, base, num_extra_tokens, init_std=0.02):
+        super().__init__()
+        self.base = base
+        self.extra_token_embeddings = torch.nn.Parameter(
+            base.weight.new_empty(num_extra_tokens, base.embedding_dim).normal_(std=init_std)
+        )
+
+    def forward(self, input_ids):
+        base_vocab_size = self.base.num_embeddings
+        is_extra = input_ids >= base_vocab_size
+        embeddings = self.base(input_ids.masked_fill(is_extra, 0))
+        extra_embeddings = torch.nn.functional.embedding(
+            (input_ids - base_vocab_size).clamp(min=0), self.extra_token_embeddings
+        )
+
+        return torch.where(is_extra.unsqueeze(-1), extra_embeddings, embeddings)
+
+class ExtendedLMHead(torch.nn.Module):
+    '''
+    The language modelling head of a model, tied to an :class:`ExtendedEmbedding`.
+
+    '''
+
+    def __init__(self, embedding):
+        super().__init__()
+        # Not registered as a submodule, so that the embeddings are not saved twice.
+        object.__setattr__(self, 'embedding', embedding)
+
+    def forward(self, hidden_states):
+        return torch.cat([
+            torch.nn.functional.linear(hidden_states, self.embedding.base.weight),
+            torch.nn.functional.linear(hidden_states, self.embedding.extra_token_embeddings)
+        ], dim=-1)
+
+def add_lora_adapter(model, base_model, num_extra_tokens, rank, alpha, dropout=0, target_modules=None):
+    '''
+    Freezes the weights of a GPT2 model, and adds a low-rank adapter to it
+    along with the embeddings of the special tokens added to its vocabulary.
+    Only the adapter and the added embeddings are trained.
+
+    :param model:
+        The :class:`transformers.GPT2LMHeadModel` to adapt.
+    :param base_model:
+        The name or path of the pretrained model, saved with the adapter.
+    :param num_extra_tokens:
+        The number of special tokens added to the vocabulary of the model.
+    :param rank:
+        The rank of the adapter.
+    :param alpha:
+        The scale of the adapter (see :class:`LoRAConv1D`).
+    :param dropout:
+        The dropout probability of the adapter. Defaults to 0.
+    :param target_modules:
+        The names of the adapted modules within each transformer block.
+        Defaults to the attention and feed-forward projections.
+
+    '''
+
+    target_modules = target_modules or _DEFAULT_LORA_TARGET_MODULES
+    base_vocab_size = model.config.vocab_size
+    for parameter in model.parameters():
+        parameter.requires_grad = False
+
+    target_names = []
+    for i, block in enumerate(model.transformer.h):
+        modules = dict(block.named_modules())
+        for name in target_modules:
+            parent_name, _, child_name = name.rpartition('.')
+            setattr(modules[parent_name], child_name, LoRAConv1D(modules[name], rank, alpha, dropout=dropout))
+            target_names.append('transformer.h.{}.{}'.format(i, name))
+
+    embedding = ExtendedEmbedding(
+        model.transformer.wte, num_extra_tokens,
+        init_std=getattr(model.config, 'initializer_range', 0.02)
+    )
+
+    model.transformer.wte = embedding
+    model.lm_head = ExtendedLMHead(embedding)
+    model.config.vocab_size = base_vocab_size + num_extra_tokens
+    model.lora_config = {
+        'base_model': base_model,
+        'rank': rank,
+        'alpha': alpha,
+        'target_modules': target_names,
+        'base_vocab_size': base_vocab_size
+    }
+
+def save_lora_adapter(model, output_dir):
+    '''
+    Saves the adapter of a model (see :func:`add_lora_adapter`) to a directory, in the
+    format loaded by the web service (see :mod:`ai_redditor_service.adapters`).
+
+    '''
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    modules = dict(model.named_modules())
+    weights = {'extra_token_embeddings': model.transformer.wte.extra_token_embeddings.detach().cpu()}
+    for name in model.lora_config['target_modules']:
+        weights['{}.lora_A'.format(name)] = modules[name].lora_A.detach().cpu()
+        weights['{}.lora_B'.format(name)] = modules[name].lora_B.detach().cpu()
+
+    torch.save(weights, str(output_dir / LORA_WEIGHTS_FILENAME))
+    with open(output_dir / LORA_CONFIG_FILENAME, 'w+') as file:
+        json.dump(model.lora_config, file, indent=2)
+
+def load_lora_adapter(model, adapter_dir):
+    '''
+    Loads the weights of an adapter saved with :func:`save_lora_adapter`
+    into a model with an adapter of the same configuration.
+
+    '''
+
+    weights = torch.load(str(Path(adapter_dir) / LORA_WEIGHTS_FILENAME), map_location='cpu')
+    modules = dict(model.named_modules())
+    with torch.no_grad():
+        model.transformer.wte.extra_token_embeddings.copy_(weights['extra_token_embeddings'])
+        for name in model.lora_config['target_modules']:
+            modules[name].lora_A.copy_(weights['{}.lora_A'.format(name)])
+            modules[name].lora_B.copy_(weights['{}.lora_B'.format(name)])
+
+def get_lora_base_model(adapter_dir):
+    '''
+    Gets the name or path of the pretrained model that an adapter was trained on.
+
+    '''
+
+    with open(Path(adapter_dir) / LORA_CONFIG_FILENAME, 'r') as file:
+        return json.load(file)['base_model']
+
 def get_dataset(filepath, tokenizer, block_size, line_by_line=False, overwrite_cache=False):
     '''
     Load a dataset from the specified filepath.
@@ -187,6 +368,15 @@ def main():
     parser.add_argument('--tpu-metrics-debug', action='store_true', help='Whether to print TPU debug metrics. Defaults to False.')
     parser.add_argument('--dataloader-drop-last', action='store_true', help='Drop the last incomplete ' +
                         'batch if it is not divisible by the batch size. Defaults to False.')
+    parser.add_argument('--lora-rank', type=int, default=0, help='Train a low-rank adapter (LoRA) of this rank, along with the ' +
+                        'embeddings of the special tokens, on top of the frozen pretrained model, rather than fine-tuning ' +
+                        'the whole model. Only the adapter is saved. Defaults to 0, meaning that the whole model is fine-tuned.')
+    parser.add_argument('--lora-alpha', type=float, default=16, help='The scale of the adapter, which is multiplied by alpha ' +
+                        'over the rank. Defaults to 16.')
+    parser.add_argument('--lora-dropout', type=float, default=0.05, help='The dropout probability of the adapter. Defaults to 0.05.')
+    parser.add_argument('--lora-target-modules', type=str, nargs='+', default=None, help='The names of the modules adapted ' +
+                        'within each transformer block. Defaults to the attention and feed-forward projections ' +
+                        '({}).'.format(', '.join(_DEFAULT_LORA_TARGET_MODULES)))
     args = parser.parse_args()
 
     if args.logdir is None:
@@ -219,6 +409,12 @@ def main():
                     .format(args.outdir)
         )
 
+    lora_checkpoint = None
+    if args.lora_rank > 0 and args.restore_checkpoint:
+        # The checkpoints of an adapter are restored on top of the model it was trained on.
+        lora_checkpoint = Path(args.model_name_or_path)
+        args.model_name_or_path = get_lora_base_model(lora_checkpoint)
+
     # Setup PTVSD (Python Tools for Visual Studio Debugging) server
     if args.debug_server_ip and args.debug_server_port:
         import ptvsd
@@ -308,7 +504,18 @@ def main():
     # Add special tokens and resize the model
     logging.info('Initializing tokenizer with special tokens and resizing the model\'s token embeddings.')
     tokenizer.add_special_tokens(get_special_tokens(args.special_tokens))
-    model.resize_token_embeddings(len(tokenizer))
+    if args.lora_rank > 0:
+        logging.info('Adding a low-rank adapter of rank {} to the frozen model.'.format(args.lora_rank))
+        add_lora_adapter(
+            model, args.model_name_or_path, len(tokenizer) - model.config.vocab_size,
+            args.lora_rank, args.lora_alpha, dropout=args.lora_dropout,
+            target_modules=args.lora_target_modules
+        )
+
+        if lora_checkpoint is not None:
+            load_lora_adapter(model, lora_checkpoint)
+    else:
+        model.resize_token_embeddings(len(tokenizer))
 
     # Load datasets
     train_dataset = get_dataset(
@@ -363,6 +570,8 @@ def main():
 
     def _on_save_model(trainer, output_dir):
         tokenizer.save_pretrained(output_dir)
+        if args.lora_rank > 0:
+            save_lora_adapter(model, output_dir)
 
     trainer = Trainer(
         model=model,
@@ -382,20 +591,42 @@ def main():
             else None
         )
 
+        if lora_checkpoint is not None:
+            model_path = str(lora_checkpoint)
+
         trainer.train(model_path=model_path)
-        trainer.save_model()      
+        if args.lora_rank > 0:
+            if trainer.is_world_master():
+                save_lora_adapter(model, args.outdir)
+        else:
+            trainer.save_model()
+
         if trainer.is_world_master():
             tokenizer.save_pretrained(args.outdir)
 
     if args.do_eval:
         checkpoints = [args.outdir]
         if args.eval_all_checkpoints:
-            checkpoints = list(args.outdir.glob('**/{}'.format(WEIGHTS_NAME)))
+            if args.lora_rank > 0:
+                checkpoints = [filepath.parent for filepath in args.outdir.glob('**/{}'.format(LORA_WEIGHTS_FILENAME))]
+            else:
+                checkpoints = list(args.outdir.glob('**/{}'.format(WEIGHTS_NAME)))
+
             logging.getLogger('transformers.modelling_utils').setLevel(logging.WARN)
 
         logging.info('Evaluating the following checkpoints: {}'.format(checkpoints))
         for checkpoint in checkpoints:
-            model = AutoModelWithLMHead.from_pretrained(str(checkpoint.absolute()))
+            if args.lora_rank > 0:
+                model = AutoModelWithLMHead.from_pretrained(get_lora_base_model(checkpoint), cache_dir=args.cache_dir)
+                add_lora_adapter(
+                    model, get_lora_base_model(checkpoint), len(tokenizer) - model.config.vocab_size,
+                    args.lora_rank, args.lora_alpha, target_modules=args.lora_target_modules
+                )
+
+                load_lora_adapter(model, checkpoint)
+            else:
+                model = AutoModelWithLMHead.from_pretrained(str(checkpoint.absolute()))
+
             # Recreate trainer with model from checkpoint
             trainer = Trainer(
                 model=model,
@@ -1,13 +1,16 @@
 import mimetypes
 from pathlib import Path
-from flask import Flask
 
 def create_app(instance_config_filename='local_config.py', test_config=None):
     '''
     Creates the Flask app.
 
     '''
-    
+
+    # Imported here so that the modules shared with the training scripts (e.g.
+    # ai_redditor_service.dedup) can be imported without flask installed.
+    from flask import Flask
+
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object('ai_redditor_service.config')
     if test_config is None:
@@ -0,0 +1,241 @@
+'''
+Tracking of sample acceptance rates, used to decide how many sequences
+to sample in each iteration of a generation.
+
+'''
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are only available on Unix, where the Celery workers run.
+    fcntl = None
+
+class AcceptanceTracker:
+    '''
+    Exponentially decayed counters of sampled and accepted sequences.
+
+    Counters are kept per key (e.g. the model, decode format and prompt class)
+    and decay with a half-life measured in sampled sequences, so that the rates
+    follow changes in the models or their configuration. The counters can be
+    persisted to a JSON file so that they survive worker restarts.
+
+    Several processes (e.g. the prefork workers of Celery) can share the file: each
+    save applies the observations of the process since its last save to the counters
+    on disk, under a file lock, and takes the merged counters as its own.
+
+    '''
+
+    def __init__(self, filepath=None, half_life=500, prior_rate=0.5, prior_weight=4,
+                 save_interval=30):
+        '''
+        Initializes an instance of :class:`AcceptanceTracker`.
+
+        :param filepath:
+            The path of the JSON file that the counters are loaded from and saved to.
+            Defaults to None, meaning that the counters are not persisted.
+        :param half_life:
+            The number of sampled sequences after which the weight of an observation
+            is halved. Defaults to 500.
+        :param prior_rate:
+            The acceptance rate assumed for keys with no observations. Defaults to 0.5.
+        :param prior_weight:
+            The weight (in sampled sequences) of the prior rate. Defaults to 4.
+        :param save_interval:
+            The minimum time, in seconds, between two saves of the counters. Defaults to 30.
+
+        '''
+
+        self.filepath = Path(filepath) if filepath is not None else None
+        self.half_life = half_life
+        self.prior_rate = prior_rate
+        self.prior_weight = prior_weight
+        self.save_interval = save_interval
+
+        self._counters = self._load()
+        # The observations (key, sampled and accepted sequences) since the last save.
+        self._pending = []
+        self._last_save_time = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        '''
+        Loads the counters from the JSON file.
+
+        :returns:
+            A dictionary mapping each key to its sampled and accepted counters, which
+            is empty if the file does not exist (or is corrupt).
+
+        '''
+
+        if self.filepath is None or not self.filepath.is_file(): return {}
+
+        try:
+            with open(self.filepath) as file:
+                return {
+                    key: (float(value['sampled']), float(value['accepted']))
+                    for key, value in json.load(file).items()
+                }
+        except (ValueError, KeyError, TypeError):
+            # A corrupt file only costs us the history.
+            return {}
+
+    def _apply(self, counters, key, sampled, accepted):
+        '''
+        Decays the counters of a key and adds an observation to them, in place.
+
+        '''
+
+        decay = 0.5 ** (sampled / self.half_life)
+        total_sampled, total_accepted = counters.get(key, (0, 0))
+        counters[key] = (
+            total_sampled * decay + sampled,
+            total_accepted * decay + accepted
+        )
+
+    @staticmethod
+    def get_key(*parts):
+        '''
+        Gets the key of the counters for the specified parts (e.g. the model,
+        the decode format and the prompt class).
+
+        '''
+
+        return '|'.join(str(part) for part in parts)
+
+    def update(self, key, sampled, accepted):
+        '''
+        Records the outcome of sampling sequences.
+
+        :param key:
+            The key of the counters.
+        :param sampled:
+            The number of sequences that were sampled.
+        :param accepted:
+            The number of sampled sequences that were accepted.
+
+        '''
+
+        if sampled <= 0: return
+
+        with self._lock:
+            self._apply(self._counters, key, sampled, accepted)
+            if self.filepath is not None:
+                self._pending.append((key, sampled, accepted))
+
+        if self.filepath is not None and time.time() - self._last_save_time >= self.save_interval:
+            self.save()
+
+    def rate(self, key):
+        '''
+        Gets the estimated acceptance rate of the specified key.
+
+        '''
+
+        with self._lock:
+            sampled, accepted = self._counters.get(key, (0, 0))
+
+        return (accepted + self.prior_rate * self.prior_weight) / (sampled + self.prior_weight)
+
+    def num_sequences(self, key, samples, target_probability=0.9, max_sequences=None):
+        '''
+        Gets the smallest number of sequences to sample so that at least the specified
+        number of them are accepted with the target probability.
+
+        :param key:
+            The key of the counters.
+        :param samples:
+            The number of sequences that need to be accepted.
+        :param target_probability:
+            The target probability of accepting at least ``samples`` sequences.
+            Defaults to 0.9.
+        :param max_sequences:
+            The maximum number of sequences to sample. Defaults to None, meaning no maximum.
+        :returns:
+            The number of sequences to sample.
+
+        '''
+
+        rate = self.rate(key)
+        if samples <= 0: return 0
+        if rate >= 1: return samples if max_sequences is None else min(samples, max_sequences)
+
+        n = samples
+        while max_sequences is None or n < max_sequences:
+            if _binomial_survival(n, rate, samples) >= target_probability: break
+            # Guard against a vanishing rate when there is no maximum.
+            if max_sequences is None and n >= samples * 100: break
+            n += 1
+
+        return n if max_sequences is None else min(n, max_sequences)
+
+    def save(self):
+        '''
+        Merges the observations since the last save into the counters of the JSON
+        file (which may have been saved by other workers since) and saves them.
+
+        '''
+
+        if self.filepath is None: return
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_save_time = time.time()
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        lock_filepath = self.filepath.with_name('{}.lock'.format(self.filepath.name))
+        with open(lock_filepath, 'a') as lock_file:
+            # Serialize the saves of all the workers, so that none of them overwrites
+            # the observations that another one merged in the meantime.
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                counters = self._load()
+                for key, sampled, accepted in pending:
+                    self._apply(counters, key, sampled, accepted)
+
+                # Write to a temporary file and move it into place, so that readers
+                # (and other workers) never see a partially written file.
+                temporary_filepath = self.filepath.with_name('{}.{}.tmp'.format(self.filepath.name, os.getpid()))
+                with open(temporary_filepath, 'w') as file:
+                    json.dump({
+                        key: {'sampled': sampled, 'accepted': accepted}
+                        for key, (sampled, accepted) in counters.items()
+                    }, file, indent=4)
+
+                os.replace(temporary_filepath, self.filepath)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        with self._lock:
+            # Take the merged counters, along with the observations made while saving.
+            for key, sampled, accepted in self._pending:
+                self._apply(counters, key, sampled, accepted)
+
+            self._counters = counters
+
+def _binomial_survival(n, p, k):
+    '''
+    Computes the probability that a binomial random variable with ``n`` trials
+    and success probability ``p`` is at least ``k``.
+
+    '''
+
+    if k <= 0: return 1
+    if p <= 0: return 0
+
+    # Accumulate the probability mass below k and take the complement.
+    pmf = (1 - p) ** n
+    cdf = 0
+    for i in range(k):
+        cdf += pmf
+        pmf *= (n - i) / (i + 1) * p / (1 - p)
+
+    return max(0, 1 - cdf)
@@ -0,0 +1,325 @@
+'''
+Low-rank adapters (LoRA) of a GPT2 base model shared by the record types.
+
+An adapter is trained with ``ai_redditor/gpt2/train.py --lora-rank`` on top of a base
+model (e.g. the pretrained ``gpt2`` model), and saved to a directory containing:
+
+- ``adapter_config.json``: the path of the base model, the rank and alpha of the
+  adapter, the names of the adapted modules, and the vocabulary size of the base model.
+- ``adapter_model.bin``: the low-rank matrices of each adapted module (e.g.
+  ``transformer.h.0.attn.c_attn.lora_A`` and ``transformer.h.0.attn.c_attn.lora_B``),
+  and the embeddings of the special tokens added to the vocabulary of the base model
+  (``extra_token_embeddings``).
+- the tokenizer, whose added special tokens follow the vocabulary of the base model.
+
+Any number of adapters are installed on a single base model (see :func:`load_adapters`).
+The adapter of each row of a batch is selected for every forward pass (see
+:func:`use_adapters`), so that a single forward pass samples from several adapters at once;
+:class:`AdapterView` runs the base model with a single adapter. Alternatively, an adapter
+is merged into a copy of its base model with :func:`merge_adapter`.
+
+'''
+
+import json
+import functools
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+import torch
+
+ADAPTER_CONFIG_FILENAME = 'adapter_config.json'
+ADAPTER_WEIGHTS_FILENAME = 'adapter_model.bin'
+
+def read_adapter(adapter_path):
+    '''
+    Reads the configuration and weights of an adapter.
+
+    :param adapter_path:
+        The path to the adapter directory.
+    :returns:
+        A dictionary containing the configuration of the adapter, and a dictionary
+        mapping the name of each of its weights to its tensor.
+
+    '''
+
+    adapter_path = Path(adapter_path)
+    with open(adapter_path / ADAPTER_CONFIG_FILENAME, 'r') as file:
+        config = json.load(file)
+
+    weights = torch.load(str(adapter_path / ADAPTER_WEIGHTS_FILENAME), map_location='cpu')
+    return config, weights
+
+class _AdapterState(threading.local):
+    '''
+    The adapters selected for the forward passes of the current thread.
+
+    '''
+
+    def __init__(self):
+        # The index of the adapter of every row, or a 1-dimensional tensor of the
+        # index of the adapter of each row. The index 0 is the base model itself.
+        self.adapter_ids = 0
+
+class _LoRAConv1D(torch.nn.Module):
+    '''
+    A :class:`transformers.modeling_utils.Conv1D` of the base model with the low-rank
+    update of each adapter (the index 0 being the base model itself).
+
+    '''
+
+    def __init__(self, base, state, lora_A, lora_B):
+        '''
+        Initializes an instance of :class:`_LoRAConv1D`.
+
+        :param lora_A:
+            A tensor of shape (num_adapters + 1, in_features, rank).
+        :param lora_B:
+            A tensor of shape (num_adapters + 1, rank, out_features), scaled by
+            the alpha over the rank of each adapter.
+
+        '''
+
+        super().__init__()
+        self.base = base
+        self.state = state
+        self.register_buffer('lora_A', lora_A)
+        self.register_buffer('lora_B', lora_B)
+
+    def forward(self, x):
+        output = self.base(x)
+        adapter_ids = self.state.adapter_ids
+        if isinstance(adapter_ids, int):
+            if adapter_ids == 0: return output
+            return output + torch.matmul(torch.matmul(x, self.lora_A[adapter_ids]), self.lora_B[adapter_ids])
+
+        return output + torch.bmm(torch.bmm(x, self.lora_A[adapter_ids]), self.lora_B[adapter_ids])
+
+class _AdapterEmbedding(torch.nn.Module):
+    '''
+    The token embeddings of the base model, followed by the embeddings of the
+    special tokens added to the vocabulary by each adapter.
+
+    '''
+
+    def __init__(self, base, state, extra_embeddings, extra_counts):
+        '''
+        Initializes an instance of :class:`_AdapterEmbedding`.
+
+        :param extra_embeddings:
+            A tensor of shape (num_adapters + 1, max_extra_tokens, embedding_size).
+        :param extra_counts:
+            A list of the number of special tokens added by each adapter.
+
+        '''
+
+        super().__init__()
+        self.base = base
+        self.state = state
+        self.register_buffer('extra_embeddings', extra_embeddings)
+
+        # The logits of the tokens that an adapter does not have are always masked.
+        extra_logits_mask = torch.zeros(extra_embeddings.shape[:2])
+        for i, count in enumerate(extra_counts):
+            extra_logits_mask[i, count:] = -float('inf')
+
+        self.register_buffer('extra_logits_mask', extra_logits_mask)
+
+    def forward(self, input_ids):
+        if self.extra_embeddings.size(1) == 0:
+            return self.base(input_ids)
+
+        base_vocab_size = self.base.num_embeddings
+        is_extra = input_ids >= base_vocab_size
+        embeddings = self.base(input_ids.masked_fill(is_extra, 0))
+
+        extra_ids = (input_ids - base_vocab_size).clamp(min=0)
+        adapter_ids = self.state.adapter_ids
+        if isinstance(adapter_ids, int):
+            extra_embeddings = self.extra_embeddings[adapter_ids][extra_ids]
+        else:
+            extra_embeddings = self.extra_embeddings[adapter_ids.unsqueeze(-1), extra_ids]
+
+        return torch.where(is_extra.unsqueeze(-1), extra_embeddings.to(embeddings.dtype), embeddings)
+
+class _AdapterLMHead(torch.nn.Module):
+    '''
+    The language modelling head of the base model, tied to the token embeddings
+    of the base model and of each adapter.
+
+    '''
+
+    def __init__(self, embedding):
+        super().__init__()
+        # Not registered as a submodule, so that the weights of the embeddings
+        # are not listed twice in the state of the model.
+        object.__setattr__(self, 'embedding', embedding)
+
+    def forward(self, hidden_states):
+        embedding = self.embedding
+        logits = torch.nn.functional.linear(hidden_states, embedding.base.weight)
+
+        adapter_ids = embedding.state.adapter_ids
+        if isinstance(adapter_ids, int):
+            extra_logits = torch.nn.functional.linear(hidden_states, embedding.extra_embeddings[adapter_ids]) + \
+                embedding.extra_logits_mask[adapter_ids]
+        else:
+            extra_logits = torch.bmm(hidden_states, embedding.extra_embeddings[adapter_ids].transpose(1, 2)) + \
+                embedding.extra_logits_mask[adapter_ids].unsqueeze(1)
+
+        return torch.cat([logits, extra_logits.to(logits.dtype)], dim=-1)
+
+def load_adapters(model, adapter_paths):
+    '''
+    Installs adapters on a base model, in place. The adapters are kept separate from the
+    weights of the base model, which run unchanged for the rows without an adapter.
+
+    :param model:
+        A :class:`transformers.GPT2LMHeadModel` to use as the base model.
+    :param adapter_paths:
+        A list of paths to adapter directories trained on the base model.
+    :returns:
+        A list of the index of each adapter, used to select it (see :func:`use_adapters`).
+
+    '''
+
+    if hasattr(model, 'adapter_state'):
+        raise ValueError('The model already has adapters.')
+
+    adapters = [read_adapter(path) for path in adapter_paths]
+    base_vocab_size = model.transformer.wte.num_embeddings
+    for path, (config, _) in zip(adapter_paths, adapters):
+        if config['base_vocab_size'] != base_vocab_size:
+            raise ValueError('The adapter \'{}\' was not trained on a model with a vocabulary of {} tokens.'.format(
+                path, base_vocab_size
+            ))
+
+    state = _AdapterState()
+    modules = dict(model.named_modules())
+    dtype, device = model.transformer.wte.weight.dtype, model.transformer.wte.weight.device
+    target_modules = sorted(set(name for config, _ in adapters for name in config['target_modules']))
+    # Adapters of a lower rank are padded with zeros to the highest rank.
+    max_rank = max((config['rank'] for config, _ in adapters), default=0)
+
+    for name in target_modules:
+        base = modules[name]
+        in_features, out_features = base.weight.shape
+        lora_A = torch.zeros(len(adapters) + 1, in_features, max_rank)
+        lora_B = torch.zeros(len(adapters) + 1, max_rank, out_features)
+        for i, (config, weights) in enumerate(adapters, 1):
+            if name not in config['target_modules']: continue
+
+            rank = config['rank']
+            lora_A[i, :, :rank] = weights['{}.lora_A'.format(name)]
+            lora_B[i, :rank, :] = weights['{}.lora_B'.format(name)] * (config['alpha'] / rank)
+
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(modules[parent_name], child_name, _LoRAConv1D(
+            base, state, lora_A.to(device, dtype), lora_B.to(device, dtype)
+        ))
+
+    extra_counts = [0] + [weights['extra_token_embeddings'].size(0) for _, weights in adapters]
+    extra_embeddings = torch.zeros(len(adapters) + 1, max(extra_counts), model.config.n_embd)
+    for i, (_, weights) in enumerate(adapters, 1):
+        extra_embeddings[i, :extra_counts[i]] = weights['extra_token_embeddings']
+
+    embedding = _AdapterEmbedding(model.transformer.wte, state, extra_embeddings.to(device, dtype), extra_counts)
+    model.transformer.wte = embedding
+    model.lm_head = _AdapterLMHead(embedding)
+    model.config.vocab_size = base_vocab_size + max(extra_counts)
+    model.adapter_state = state
+
+    return list(range(1, len(adapters) + 1))
+
+@contextmanager
+def use_adapters(model, adapter_ids):
+    '''
+    Selects the adapters of the forward passes of the model in the current thread.
+
+    :param model:
+        A base model with adapters (see :func:`load_adapters`).
+    :param adapter_ids:
+        The index of the adapter of every row of the batch, or a 1-dimensional
+        tensor of the index of the adapter of each row. The index 0 is the base model.
+
+    '''
+
+    state = model.adapter_state
+    previous_adapter_ids = state.adapter_ids
+    state.adapter_ids = adapter_ids
+    try:
+        yield
+    finally:
+        state.adapter_ids = previous_adapter_ids
+
+class AdapterView:
+    '''
+    A base model with adapters that runs every forward pass with one of its adapters.
+    Every other attribute is the attribute of the base model.
+
+    '''
+
+    def __init__(self, model, adapter_id):
+        '''
+        Initializes an instance of :class:`AdapterView`.
+
+        :param model:
+            A base model with adapters (see :func:`load_adapters`).
+        :param adapter_id:
+            The index of the adapter.
+
+        '''
+
+        self.model = model
+        self.adapter_id = adapter_id
+
+        # Keep the signature of the forward method of the model, which is inspected for its keywords.
+        @functools.wraps(model.forward)
+        def forward(*args, **kwargs):
+            with use_adapters(model, adapter_id):
+                return model(*args, **kwargs)
+
+        self.forward = forward
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+def merge_adapter(model_path, adapter_path, output_path):
+    '''
+    Merges an adapter into its base model, and saves the result (along with the
+    tokenizer of the adapter) as a standalone model checkpoint.
+
+    :param model_path:
+        The path to the base model checkpoint.
+    :param adapter_path:
+        The path to the adapter directory.
+    :param output_path:
+        The directory to save the merged model in.
+
+    '''
+
+    from transformers import AutoModelWithLMHead, AutoTokenizer
+
+    config, weights = read_adapter(adapter_path)
+    model = AutoModelWithLMHead.from_pretrained(str(model_path))
+    if config['base_vocab_size'] != model.config.vocab_size:
+        raise ValueError('The adapter \'{}\' was not trained on \'{}\'.'.format(adapter_path, model_path))
+
+    extra_token_embeddings = weights['extra_token_embeddings']
+    model.resize_token_embeddings(config['base_vocab_size'] + extra_token_embeddings.size(0))
+
+    modules = dict(model.named_modules())
+    with torch.no_grad():
+        model.transformer.wte.weight[config['base_vocab_size']:] = extra_token_embeddings
+        for name in config['target_modules']:
+            modules[name].weight += torch.matmul(
+                weights['{}.lora_A'.format(name)], weights['{}.lora_B'.format(name)]
+            ) * (config['alpha'] / config['rank'])
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(str(output_path))
+    AutoTokenizer.from_pretrained(str(adapter_path)).save_pretrained(str(output_path))
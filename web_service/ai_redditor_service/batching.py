@@ -0,0 +1,124 @@
+'''
+Cross-request batching of GPT2 generation.
+
+Requests for the same model are collected for a short window and then served
+by a single :func:`ai_redditor_service.gpt2.generate_batch` call (or, for the record
+types of a shared base model, :func:`ai_redditor_service.gpt2.generate_groups`). This requires
+the worker to execute several tasks concurrently in one process (for example,
+a Celery worker started with ``--pool threads``); with the prefork pool every
+process only ever sees a single pending request.
+
+'''
+
+import time
+import threading
+
+class _PendingRequest:
+    '''
+    A generation request waiting on the result of a batched generation.
+
+    '''
+
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+class BatchScheduler:
+    '''
+    Coalesces concurrent generation requests for a single model into batches.
+
+    There is no background thread: the first request to arrive in a window
+    becomes the leader, waits for the window to elapse (or the batch to fill),
+    and then runs the batch on behalf of every request collected so far. This
+    keeps the scheduler safe to create before a worker forks.
+
+    '''
+
+    def __init__(self, generate_batch_func, window=0.05, max_batch_size=8):
+        '''
+        Initializes an instance of :class:`BatchScheduler`.
+
+        :param generate_batch_func:
+            A function that takes a list of the submitted requests and returns
+            a list containing the results of each request.
+        :param window:
+            The time, in seconds, to wait for other requests before running a batch.
+            Defaults to 0.05 seconds.
+        :param max_batch_size:
+            The maximum number of requests in a single batch. Defaults to 8.
+
+        '''
+
+        self.generate_batch_func = generate_batch_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        self._pending = []
+        self._condition = threading.Condition()
+        # Only one batch runs on the model at a time; requests that arrive
+        # while a batch is running are collected into the next one.
+        self._run_lock = threading.Lock()
+
+    def submit(self, request):
+        '''
+        Submits a generation request and blocks until its batch has been generated.
+
+        :param request:
+            A generation request, such as a record type and its
+            :class:`ai_redditor_service.gpt2.GenerationRequest`.
+        :returns:
+            The result of the request (a list of :class:`ai_redditor_service.gpt2.RawRecord`).
+
+        '''
+
+        pending = _PendingRequest(request)
+        with self._condition:
+            self._pending.append(pending)
+            is_leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch_size:
+                self._condition.notify_all()
+
+        if is_leader:
+            self._lead()
+
+        while not pending.done.is_set():
+            # A follower whose leader only took part of the queue (because the
+            # batch was full) may need to lead the next batch itself.
+            if pending.done.wait(self.window) or not self._claim_leadership(pending): continue
+            self._lead()
+
+        if pending.exception is not None:
+            raise pending.exception
+
+        return pending.result
+
+    def _claim_leadership(self, pending):
+        with self._condition:
+            return len(self._pending) > 0 and self._pending[0] is pending
+
+    def _lead(self):
+        deadline = time.time() + self.window
+        with self._condition:
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                self._condition.wait(remaining)
+
+        with self._run_lock:
+            with self._condition:
+                batch = self._pending[:self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size:]
+
+            if len(batch) == 0: return
+            try:
+                results = self.generate_batch_func([pending.request for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as exception:
+                for pending in batch:
+                    pending.exception = exception
+            finally:
+                for pending in batch:
+                    pending.done.set()
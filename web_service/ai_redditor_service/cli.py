@@ -2,9 +2,11 @@ import tqdm
 import json
 import click
 from pathlib import Path
+from flask import current_app
 from flask.cli import with_appcontext
 from ai_redditor_service.extensions import db
 from ai_redditor_service.models import TIFURecord, WPRecord, PHCRecord
+from ai_redditor_service.field_completion import FieldDistribution
 
 def init_app(app):
     '''
@@ -18,6 +20,11 @@ def init_app(app):
     app.cli.add_command(_init_db_command)
     app.cli.add_command(_load_fixture_command)
     app.cli.add_command(_build_record_refs)
+    app.cli.add_command(_convert_weights_command)
+    app.cli.add_command(_export_engine_command)
+    app.cli.add_command(_build_draft_model_command)
+    app.cli.add_command(_compute_field_distribution_command)
+    app.cli.add_command(_merge_adapter_command)
 
 @click.command('init-db')
 @with_appcontext
@@ -112,4 +119,97 @@ def _build_record_refs(record_type):
             record_ref = record._dataset_record_ref_class(record_id=record.id)
 
         db.session.add(record_ref)
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+
+@click.command('convert-weights')
+@click.argument('model_path', type=Path)
+@click.option('--output-path', type=Path, default=None,
+              help='The directory to save the weight file in. Defaults to the model directory.')
+def _convert_weights_command(model_path, output_path):
+    # Imported here so that torch is only loaded by the commands that need it.
+    from ai_redditor_service.weights import convert_model
+
+    if not model_path.is_dir():
+        raise ValueError('\'{}\' is not a directory!'.format(
+            model_path.resolve()
+        ))
+
+    filepath = convert_model(model_path, output_path)
+    click.echo('Converted the weights of \'{}\' to \'{}\'.'.format(model_path, filepath))
+
+@click.command('export-engine')
+@click.argument('model_path', type=Path)
+@click.option('--engine', type=click.Choice(['torchscript', 'onnx']), required=True,
+              help='The inference engine to export the model for.')
+@click.option('--output-path', type=Path, default=None,
+              help='The directory to save the exported model in. Defaults to the model directory.')
+def _export_engine_command(model_path, engine, output_path):
+    # Imported here so that torch is only loaded by the commands that need it.
+    from ai_redditor_service.engines import export_engine
+
+    if not model_path.is_dir():
+        raise ValueError('\'{}\' is not a directory!'.format(
+            model_path.resolve()
+        ))
+
+    filepath = export_engine(model_path, engine, output_path)
+    click.echo('Exported \'{}\' for the {} engine to \'{}\'.'.format(model_path, engine, filepath))
+
+@click.command('build-draft-model')
+@click.argument('model_path', type=Path)
+@click.argument('output_path', type=Path)
+@click.option('--num-layers', type=int, required=True, help='The number of transformer blocks in the draft model.')
+@click.option('--strategy', type=click.Choice(['spread', 'first']), default='spread',
+              help='Keep blocks evenly spaced through the model (spread) or its first blocks (first).')
+def _build_draft_model_command(model_path, output_path, num_layers, strategy):
+    # Imported here so that torch is only loaded by the commands that need it.
+    from ai_redditor_service.draft import build_draft_model
+
+    if not model_path.is_dir():
+        raise ValueError('\'{}\' is not a directory!'.format(
+            model_path.resolve()
+        ))
+
+    layers = build_draft_model(model_path, output_path, num_layers, strategy=strategy)
+    click.echo('Built a draft model of \'{}\' with blocks {} in \'{}\'.'.format(
+        model_path, ', '.join(str(x) for x in layers), output_path
+    ))
+
+@click.command('merge-adapter')
+@click.argument('model_path', type=Path)
+@click.argument('adapter_path', type=Path)
+@click.argument('output_path', type=Path)
+def _merge_adapter_command(model_path, adapter_path, output_path):
+    # Imported here so that torch is only loaded by the commands that need it.
+    from ai_redditor_service.adapters import merge_adapter
+
+    if not adapter_path.is_dir():
+        raise ValueError('\'{}\' is not a directory!'.format(
+            adapter_path.resolve()
+        ))
+
+    merge_adapter(model_path, adapter_path, output_path)
+    click.echo('Merged the adapter \'{}\' into \'{}\' in \'{}\'.'.format(adapter_path, model_path, output_path))
+
+@click.command('compute-field-distribution')
+@click.option('--output-path', type=Path, default=None,
+              help='The file to save the distribution in. Defaults to "GPT2_PHC_FIELD_DISTRIBUTION_FILENAME" '
+              'in the instance folder.')
+@click.option('--max-authors', type=int, default=10000, help='The number of most frequent authors to keep.')
+@with_appcontext
+def _compute_field_distribution_command(output_path, max_authors):
+    if output_path is None:
+        output_path = Path(current_app.instance_path) / current_app.config.get(
+            'GPT2_PHC_FIELD_DISTRIBUTION_FILENAME', 'phc_field_distribution.json'
+        )
+
+    records = PHCRecord.query.filter_by(is_generated=False).with_entities(
+        PHCRecord.likes, PHCRecord.author_username
+    ).yield_per(1000)
+
+    distribution = FieldDistribution.from_records(records, max_authors=max_authors)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    distribution.save(output_path)
+    click.echo('Saved the distribution of {} likes values and {} authors to \'{}\'.'.format(
+        len(distribution.likes), len(distribution.authors), output_path
+    ))
@@ -1,12 +1,112 @@
 # GPT2 model configuration
 GPT2_NO_CUDA = False
 GPT2_QUANTIZE = False
+# Memory map the model weights from the weight file in each model directory (created
+# with the "convert-weights" command), so that all the workers on a node share them.
+# Models without a weight file are loaded normally.
+GPT2_MMAP_WEIGHTS = True
+# The engine that runs the models: 'torch' (eager PyTorch), or 'torchscript' or 'onnx'
+# to run the model exported to each model directory (with the "export-engine" command).
+# The engine of a record type can be overridden with '{TYPE}_MODEL_ENGINE' (e.g. PHC_MODEL_ENGINE).
+GPT2_ENGINE = 'torch'
+# The precision of the models run by the 'torch' engine: 'float32', or 'bfloat16' to halve
+# the memory and bandwidth of the weights and key/value cache on CPU devices (this requires
+# torch 1.10 or later; the pinned torch 1.5.1 only runs 'float32'). The precision of a
+# record type can be overridden with '{TYPE}_MODEL_PRECISION' (e.g. WP_MODEL_PRECISION).
+GPT2_PRECISION = 'float32'
+# Restrict the language modelling head of the models run by the 'torch' engine to the
+# restricted vocabulary file in each model directory (created with "ai_redditor/gpt2/restrict_vocab.py"),
+# so that only the logits of the tokens of its training corpus are computed at each step.
+# Models without a vocabulary file keep the full head. This can be overridden per record
+# type with '{TYPE}_MODEL_RESTRICTED_VOCAB' (e.g. PHC_MODEL_RESTRICTED_VOCAB).
+GPT2_RESTRICTED_VOCAB = True
+# Serve every record type from a single base model (e.g. the pretrained GPT2 model) with the
+# low-rank adapter of the record type (trained with "train.py --lora-rank" and set with
+# '{TYPE}_ADAPTER_PATH', e.g. PHC_ADAPTER_PATH), whose directory also holds its tokenizer.
+# With batching enabled, the requests of all the record types are sampled in the same forward
+# passes. An adapter can instead be merged into a standalone model with the "merge-adapter" command.
+GPT2_BASE_MODEL_PATH = None
+# Sample with speculative decoding: a small draft model of a record type (built with the
+# "build-draft-model" command and set with '{TYPE}_DRAFT_MODEL_PATH', e.g. PHC_DRAFT_MODEL_PATH)
+# proposes this many tokens per step, which its model verifies in a single forward pass.
+GPT2_NUM_DRAFT_TOKENS = 4
+# The maximum number of sequences decoded at once. Sequences leave the decode batch as soon
+# as they finish, and the sequences that are still waiting take their slots. A value of 0
+# means that all the sequences sampled in an iteration are decoded at once.
+GPT2_MAX_DECODE_BATCH_SIZE = 0
+# The maximum length (in tokens) of the records of a record type can be set with '{TYPE}_MAX_LENGTH'
+# (defaults to the maximum length of the record type, which fits in the context of the model).
+# With a maximum length longer than the context of the model (1024 tokens for GPT2), e.g.
+# WP_MAX_LENGTH = 2048 for long-form stories, records keep decoding past it with a sliding window
+# of the key/value cache, which keeps the prompt and drops GPT2_CONTEXT_WINDOW_SHIFT of the
+# oldest tokens when it is full.
+GPT2_CONTEXT_WINDOW_SHIFT = 256
+# The time budget, in seconds, of a record generation requested through the API without
+# one (including the time spent waiting in the queue). Once it runs out, generation stops
+# and the records generated so far are served. A value of 0 means that there is no budget.
+GPT2_DEFAULT_TIME_BUDGET_SECONDS = 0
+# Serve a random dataset record when the time budget of a request with an empty prompt
+# runs out and there is no record in the reservoir; otherwise, the request fails.
+GPT2_TIME_BUDGET_DATASET_FALLBACK = True
+# How the fields missing from a PHC prompt (the likes and author preceding a prompted
+# author or comment) are completed: 'generate' a whole record and take its fields,
+# 'decode' only the missing fields, or sample them from their 'empirical' distribution
+# in the dataset records (computed with the "compute-field-distribution" command).
+GPT2_PHC_FIELD_COMPLETION = 'decode'
+# The maximum number of tokens decoded to complete the missing fields of a prompt.
+GPT2_FIELD_COMPLETION_MAX_TOKENS = 32
+# The file (relative to the instance folder) of the distribution of the PHC dataset fields.
+GPT2_PHC_FIELD_DISTRIBUTION_FILENAME = 'phc_field_distribution.json'
 GPT2_BOS_TOKEN = '<|bos|>'
 GPT2_TRANSLATE_TOKEN = '<|eq_tok|>'
 GPT2_END_OF_LIKES_TOKEN = '<|eol|>'
+# The memory cap, per model, of the cache of encoded prompts (key/value states)
+# that are reused across generations. Set to 0 to disable prompt caching.
+GPT2_PROMPT_CACHE_MAX_MB = 256
+# Abort sequences mid-decode as soon as they can no longer produce a valid record.
+GPT2_STREAMING_VALIDATION = True
+# Constrain sampling to the decode format of each model (special token order,
+# non-empty fields, digit-only likes and no links in PHC comments).
+GPT2_CONSTRAINED_DECODING = True
+# Choose the number of sequences sampled per iteration from the measured acceptance
+# rate of each model, decode format and prompt class (empty or custom).
+GPT2_ADAPTIVE_OVERSAMPLING = True
+# The target probability of generating all requested samples in a single iteration.
+GPT2_ACCEPTANCE_TARGET_PROBABILITY = 0.9
+# The number of sampled sequences after which the weight of an observation is halved.
+GPT2_ACCEPTANCE_RATES_HALF_LIFE = 500
+# The file (relative to the instance folder) that the acceptance rates are persisted to. The
+# workers merge their observations into it (under the lock file next to it) when saving.
+GPT2_ACCEPTANCE_RATES_FILENAME = 'acceptance_rates.json'
+# Reject (and resample) generated records whose content hash matches a record that
+# is already in the database, so that no two identical generated records are stored.
+GPT2_DEDUP_ENABLED = True
+
+# Models are loaded the first time they are used. Once the total size of the loaded
+# models would exceed this budget, the least recently used models are evicted.
+# A value of 0 means that there is no budget.
+GPT2_MODEL_MEMORY_BUDGET_MB = 0
+
+# Load and warm up the models when a worker starts, rather than on its first task.
+GPT2_WARMUP_ENABLED = True
+# Load the models in the parent worker process, before it forks its child processes,
+# so that they share the model weights copy-on-write (CPU devices only).
+GPT2_WARMUP_PRELOAD = True
+# The batch size of the dummy forward passes run by each worker process.
+GPT2_WARMUP_BATCH_SIZE = 4
+# The time that a worker process has to start (and warm up) before it is killed.
+GPT2_WARMUP_TIMEOUT_SECONDS = 300
+# A file created once a worker is warm, and removed when it shuts down
+# (e.g. for a readiness probe). Set to None to disable it.
+GPT2_WARMUP_READY_FILEPATH = None
 
 # Show debug information in the record generation task
 RECORD_GENERATION_LOG_DEBUG_INFO = False
+# Stream the text of records to the client (as "generate_record_progress"
+# SocketIO events) while they are being generated.
+RECORD_GENERATION_STREAM_PROGRESS = True
+# The minimum time between two progress events of a generation task.
+RECORD_GENERATION_PROGRESS_INTERVAL_MS = 100
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
@@ -16,4 +116,39 @@ ENGINEIO_ENABLE_LOGGING = False
 
 # The client will send an AJAX request every 2.5 seconds
 # asking about the status of the text generation task.
-TASK_STATUS_TIMEOUT_MS = 2500 
\ No newline at end of file
+TASK_STATUS_TIMEOUT_MS = 2500 
+# Batch concurrent generation requests for the same model into a single
+# decode loop. This only has an effect when the worker runs several tasks
+# concurrently in a single process (e.g. "celery worker --pool threads").
+GPT2_BATCHING_ENABLED = False
+# The time to wait for other requests before running a batch.
+GPT2_BATCH_WINDOW_MS = 50
+# The maximum number of requests in a single batch.
+GPT2_BATCH_MAX_SIZE = 8
+
+# Keep a reservoir of records generated from an empty prompt, so that requests
+# without a prompt are served without running the model. The reservoirs are
+# refilled periodically by Celery beat (e.g. "celery -A ai_redditor_service.worker beat")
+# and after every request served from them.
+GPT2_RESERVOIR_ENABLED = False
+# The number of unserved records kept in the reservoir of each record type.
+GPT2_RESERVOIR_DEPTH = 16
+# The maximum number of records generated for a reservoir at once.
+GPT2_RESERVOIR_REFILL_BATCH_SIZE = 8
+# A request served from the reservoir schedules a refill once fewer records than this are left.
+GPT2_RESERVOIR_LOW_WATER_MARK = 8
+# A single refill of each reservoir runs at a time; a refill that has not finished after this
+# long is assumed to have failed (e.g. its worker was killed), so that another one can start.
+GPT2_RESERVOIR_REFILL_TIMEOUT_SECONDS = 600
+# The time between two periodic refills of the reservoirs.
+GPT2_RESERVOIR_REFILL_INTERVAL_SECONDS = 60
+
+# The URL of the inference server (e.g. 'http://127.0.0.1:5100'), started with
+# "python -m ai_redditor_service.inference_server". If set, the record generation
+# tasks send their generations to it instead of loading the models themselves.
+GPT2_INFERENCE_SERVER_URL = None
+# The timeout of each request to the inference server.
+GPT2_INFERENCE_SERVER_TIMEOUT_SECONDS = 300
+# The host and port that the inference server listens on.
+GPT2_INFERENCE_SERVER_HOST = '127.0.0.1'
+GPT2_INFERENCE_SERVER_PORT = 5100
@@ -0,0 +1,258 @@
+'''
+Content hashes of generated records, and indices of the hashes of the
+records that were already generated, used to avoid duplicate records.
+
+This module only depends on the standard library, so that it can be shared
+with the bulk generation script (``ai_redditor/gpt2/generate.py``), which
+imports it with the web service directory on the Python path but without
+the web service dependencies (e.g. flask) installed.
+
+'''
+
+import re
+import math
+import mmap
+import struct
+import hashlib
+import threading
+import unicodedata
+from pathlib import Path
+from collections import deque
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_text(text):
+    '''
+    Normalizes the text of a group so that records that only differ in their unicode
+    representation or in whitespace have the same content hash.
+
+    '''
+
+    text = unicodedata.normalize('NFKC', str(text))
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def content_hash(groups, digest_size=8):
+    '''
+    Computes the content hash of a record.
+
+    :param groups:
+        A dictionary mapping the name of each group to its data.
+    :param digest_size:
+        The size of the hash, in bytes. Defaults to 8 (i.e. a 64-bit hash).
+        Use 16 for a 128-bit hash.
+    :returns:
+        The hash as a non-negative integer.
+
+    '''
+
+    data = '\x1e'.join(
+        '{}\x1f{}'.format(key, normalize_text(groups[key])) for key in sorted(groups)
+    )
+
+    digest = hashlib.blake2b(data.encode('utf-8'), digest_size=digest_size).digest()
+    return int.from_bytes(digest, 'big')
+
+def to_signed64(value):
+    '''
+    Converts a 64-bit content hash to a signed integer (e.g. to store it in a
+    database BIGINT column).
+
+    '''
+
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+class HashSet:
+    '''
+    An in-memory set of content hashes with a bounded footprint.
+
+    Once the set holds the maximum number of hashes, the oldest ones are
+    forgotten first.
+
+    '''
+
+    def __init__(self, max_size=1000000):
+        '''
+        Initializes an instance of :class:`HashSet`.
+
+        :param max_size:
+            The maximum number of hashes in the set. Defaults to 1000000.
+
+        '''
+
+        self.max_size = max_size
+        self._hashes = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, value):
+        return value in self._hashes
+
+    def add(self, value):
+        '''
+        Adds a hash to the set.
+
+        :returns:
+            True if the hash was not in the set.
+
+        '''
+
+        with self._lock:
+            if value in self._hashes: return False
+            while len(self._hashes) >= self.max_size:
+                self._hashes.discard(self._order.popleft())
+
+            self._hashes.add(value)
+            self._order.append(value)
+            return True
+
+class BloomFilter:
+    '''
+    A Bloom filter of content hashes, optionally backed by a memory mapped file
+    so that it persists across runs.
+
+    A Bloom filter never forgets a hash, and uses a fixed number of bits regardless
+    of how many hashes it holds, at the cost of a small rate of false positives
+    (i.e. hashes that were never added but are reported as present).
+
+    '''
+
+    _MAGIC = b'ARBF'
+    _HEADER_FORMAT = '>4sQI'
+    _HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+
+    def __init__(self, filepath=None, capacity=10000000, error_rate=1e-4):
+        '''
+        Initializes an instance of :class:`BloomFilter`.
+
+        :param filepath:
+            The path of the file backing the filter. If the file exists, the filter
+            (and its parameters) are loaded from it. Defaults to None, meaning that
+            the filter is kept in memory.
+        :param capacity:
+            The number of hashes that the filter is sized for. Defaults to 10000000.
+        :param error_rate:
+            The false positive rate of the filter once it holds ``capacity`` hashes.
+            Defaults to 0.0001.
+
+        '''
+
+        self.filepath = Path(filepath) if filepath is not None else None
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+
+        self._file = None
+        self._lock = threading.Lock()
+        if self.filepath is None:
+            self._bits = bytearray(self._num_bytes)
+            return
+
+        if self.filepath.is_file():
+            with open(self.filepath, 'rb') as file:
+                magic, num_bits, num_hashes = struct.unpack(
+                    self._HEADER_FORMAT, file.read(self._HEADER_SIZE)
+                )
+
+            if magic != self._MAGIC:
+                raise ValueError('\'{}\' is not a Bloom filter file.'.format(self.filepath))
+
+            self.num_bits, self.num_hashes = num_bits, num_hashes
+        else:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.filepath, 'wb') as file:
+                file.write(struct.pack(self._HEADER_FORMAT, self._MAGIC, self.num_bits, self.num_hashes))
+                file.truncate(self._HEADER_SIZE + self._num_bytes)
+
+        self._file = open(self.filepath, 'r+b')
+        self._bits = mmap.mmap(self._file.fileno(), 0)
+
+    @property
+    def _num_bytes(self):
+        return (self.num_bits + 7) // 8
+
+    def _positions(self, value):
+        # Derive all the bit positions from two 64-bit hashes (double hashing).
+        digest = hashlib.blake2b(
+            value.to_bytes((value.bit_length() + 7) // 8 or 1, 'big'), digest_size=16
+        ).digest()
+
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        offset = self._HEADER_SIZE if self._file is not None else 0
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % self.num_bits
+            yield offset + position // 8, 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self._bits[index] & mask for index, mask in self._positions(value))
+
+    def add(self, value):
+        '''
+        Adds a hash to the filter.
+
+        :returns:
+            True if the hash was not (reported as) present in the filter.
+
+        '''
+
+        with self._lock:
+            is_new = False
+            for index, mask in self._positions(value):
+                if not self._bits[index] & mask:
+                    self._bits[index] |= mask
+                    is_new = True
+
+            return is_new
+
+    def flush(self):
+        '''
+        Writes the filter to its file.
+
+        '''
+
+        if self._file is not None:
+            self._bits.flush()
+
+    def close(self):
+        '''
+        Writes the filter to its file and closes it.
+
+        '''
+
+        if self._file is None: return
+
+        self._bits.flush()
+        self._bits.close()
+        self._file.close()
+        self._file = None
+
+class DatabaseHashIndex:
+    '''
+    An index of the content hashes stored in the ``content_hash`` column
+    of a Flask-SQLAlchemy model (e.g. :class:`ai_redditor_service.models.PHCRecord`).
+
+    Hashes are added to the index by inserting the records themselves. The check
+    and the insertion are not atomic, so two workers may both find a hash missing;
+    the unique index on the column rejects the second record when it is inserted.
+
+    '''
+
+    def __init__(self, model_class):
+        '''
+        Initializes an instance of :class:`DatabaseHashIndex`.
+
+        :param model_class:
+            The model class whose ``content_hash`` column holds 64-bit hashes
+            (see :func:`to_signed64`).
+
+        '''
+
+        self.model_class = model_class
+
+    def __contains__(self, value):
+        return self.model_class.query.filter_by(content_hash=to_signed64(value)) \
+            .with_entities(self.model_class.id).first() is not None
+
+    def add(self, value):
+        return value not in self
@@ -0,0 +1,75 @@
+'''
+Draft models for speculative decoding (see :func:`ai_redditor_service.gpt2.generate`).
+
+A draft model is built from a fine-tuned GPT2 checkpoint by keeping a subset of its
+transformer blocks, along with its embeddings, final layer norm and tokenizer, so that
+it shares the vocabulary and special tokens of the model and already approximates its
+distribution. The draft can be fine-tuned further (e.g. with ``ai_redditor/gpt2/train.py``
+on the same corpus) to raise the rate at which its proposals are accepted.
+
+'''
+
+import torch
+from pathlib import Path
+
+def select_layers(num_model_layers, num_layers, strategy='spread'):
+    '''
+    Selects the indices of the transformer blocks kept in a draft model.
+
+    :param num_model_layers:
+        The number of transformer blocks in the model.
+    :param num_layers:
+        The number of transformer blocks to keep.
+    :param strategy:
+        ``spread`` to keep blocks evenly spaced through the model (including its first
+        and last blocks), or ``first`` to keep its first blocks. Defaults to ``spread``.
+    :returns:
+        A sorted list of block indices.
+
+    '''
+
+    if not 0 < num_layers <= num_model_layers:
+        raise ValueError('The number of layers must be between 1 and {}.'.format(num_model_layers))
+
+    if strategy == 'first' or num_layers == 1:
+        return list(range(num_layers))
+    elif strategy == 'spread':
+        return sorted(set(
+            round(i * (num_model_layers - 1) / (num_layers - 1)) for i in range(num_layers)
+        ))
+    else:
+        raise ValueError('Unknown layer selection strategy \'{}\'.'.format(strategy))
+
+def build_draft_model(model_path, output_path, num_layers, strategy='spread'):
+    '''
+    Builds a draft model from a pretrained model checkpoint by keeping a
+    subset of its transformer blocks.
+
+    :param model_path:
+        The path to the pretrained model checkpoint.
+    :param output_path:
+        The directory to save the draft model (and the tokenizer) in.
+    :param num_layers:
+        The number of transformer blocks in the draft model.
+    :param strategy:
+        The strategy used to select the blocks to keep (see :func:`select_layers`).
+        Defaults to ``spread``.
+    :returns:
+        The indices of the blocks that were kept.
+
+    '''
+
+    from transformers import AutoModelWithLMHead, AutoTokenizer
+
+    model = AutoModelWithLMHead.from_pretrained(str(model_path))
+    layers = select_layers(model.config.n_layer, num_layers, strategy=strategy)
+
+    model.transformer.h = torch.nn.ModuleList([model.transformer.h[i] for i in layers])
+    model.config.n_layer = len(layers)
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(str(output_path))
+    AutoTokenizer.from_pretrained(str(model_path)).save_pretrained(str(output_path))
+
+    return layers
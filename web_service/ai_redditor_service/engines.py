@@ -0,0 +1,325 @@
+'''
+Inference engines that run an exported GPT2 model in place of the eager
+PyTorch model (see :func:`ai_redditor_service.gpt2.load_model`).
+
+An engine runs a single forward pass with key/value caching, like the
+eager model, so the decode loop (and its sampling semantics) is the same
+for every engine. Models are exported with :func:`export_engine` (or the
+"export-engine" command):
+
+- ``torchscript``: a traced TorchScript module (``model.torchscript.pt``);
+- ``onnx``: an ONNX graph with key/value cache inputs and outputs (``model.onnx``),
+  run with ONNX Runtime.
+
+'''
+
+import inspect
+import torch
+from pathlib import Path
+
+# The file that each engine is exported to, in a model directory.
+ENGINE_FILENAMES = {
+    'torchscript': 'model.torchscript.pt',
+    'onnx': 'model.onnx'
+}
+
+def _get_past_keyword(model):
+    # The key/value cache keyword was renamed from 'past' to 'past_key_values'
+    # in later versions of transformers.
+    return 'past_key_values' if 'past_key_values' in \
+        inspect.signature(model.forward).parameters else 'past'
+
+class _ExportWrapper(torch.nn.Module):
+    '''
+    Wraps a model so that its forward pass takes and returns the key/value
+    cache as a tuple containing the (key, value) pair of each layer.
+
+    '''
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.past_keyword = _get_past_keyword(model)
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        outputs = self.model(
+            input_ids, attention_mask=attention_mask,
+            position_ids=position_ids, use_cache=True,
+            **{self.past_keyword: past}
+        )
+
+        # The key and value of each layer are stacked into a single tensor
+        # in earlier versions of transformers.
+        presents = tuple(
+            (layer[0], layer[1]) for layer in outputs[1]
+        )
+
+        return outputs[0], presents
+
+class InferenceEngine:
+    '''
+    Base class of the inference engines.
+
+    Engines are called like a model: with the token ids, key/value cache
+    (``past``), attention mask and position ids of a batch, they return the
+    language modelling logits and the updated key/value cache.
+
+    '''
+
+    def __init__(self, filepath, config):
+        '''
+        Initializes an instance of :class:`InferenceEngine`.
+
+        :param filepath:
+            The path of the exported model.
+        :param config:
+            The :class:`transformers.PretrainedConfig` of the model.
+
+        '''
+
+        self.filepath = Path(filepath)
+        self.config = config
+        self.num_layers = config.n_layer
+        self.num_heads = config.n_head
+        self.head_dim = config.n_embd // config.n_head
+        self.device = torch.device('cpu')
+
+    @property
+    def nbytes(self):
+        '''
+        The size of the exported model, in bytes.
+
+        '''
+
+        return self.filepath.stat().st_size
+
+    def eval(self):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+    def forward(self, input_ids, past=None, attention_mask=None, position_ids=None, use_cache=True):
+        batch_size, length = input_ids.shape
+        past_length = past[0][0].size(-2) if past is not None else 0
+        if past is None:
+            empty = input_ids.new_zeros((batch_size, self.num_heads, 0, self.head_dim), dtype=torch.float)
+            past = tuple((empty, empty) for _ in range(self.num_layers))
+
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones((batch_size, past_length + length))
+
+        if position_ids is None:
+            position_ids = torch.arange(
+                past_length, past_length + length, device=input_ids.device
+            ).unsqueeze(0).expand(batch_size, -1)
+
+        return self._run(input_ids, attention_mask.long(), position_ids.long(), past)
+
+    def _run(self, input_ids, attention_mask, position_ids, past):
+        raise NotImplementedError()
+
+class TorchScriptEngine(InferenceEngine):
+    '''
+    Runs a traced TorchScript module.
+
+    '''
+
+    def __init__(self, filepath, config):
+        super().__init__(filepath, config)
+        self.module = torch.jit.load(str(filepath), map_location='cpu').eval()
+
+    def _run(self, input_ids, attention_mask, position_ids, past):
+        return self.module(input_ids, attention_mask, position_ids, past)
+
+class OnnxEngine(InferenceEngine):
+    '''
+    Runs an ONNX graph with ONNX Runtime.
+
+    '''
+
+    def __init__(self, filepath, config, num_threads=None):
+        '''
+        Initializes an instance of :class:`OnnxEngine`.
+
+        :param num_threads:
+            The number of threads used by each operator. Defaults to None,
+            meaning the number of threads used by torch.
+
+        '''
+
+        super().__init__(filepath, config)
+
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('Please install onnxruntime (pip install onnxruntime) to use the onnx engine.')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            str(filepath), options, providers=['CPUExecutionProvider']
+        )
+
+    def _run(self, input_ids, attention_mask, position_ids, past):
+        inputs = {
+            'input_ids': input_ids.numpy(),
+            'attention_mask': attention_mask.numpy(),
+            'position_ids': position_ids.numpy()
+        }
+
+        for i, (key, value) in enumerate(past):
+            inputs['past.{}.key'.format(i)] = key.contiguous().numpy()
+            inputs['past.{}.value'.format(i)] = value.contiguous().numpy()
+
+        outputs = [torch.from_numpy(x) for x in self.session.run(None, inputs)]
+        presents = tuple(
+            (outputs[1 + 2 * i], outputs[2 + 2 * i]) for i in range(self.num_layers)
+        )
+
+        return outputs[0], presents
+
+_ENGINE_CLASSES = {
+    'torchscript': TorchScriptEngine,
+    'onnx': OnnxEngine
+}
+
+def load_engine(model_path, engine):
+    '''
+    Loads an exported model.
+
+    :param model_path:
+        The path to the model directory (containing its configuration
+        and the exported model).
+    :param engine:
+        The name of the engine (``torchscript`` or ``onnx``).
+    :returns:
+        An :class:`InferenceEngine`.
+
+    '''
+
+    from transformers import AutoConfig
+
+    if engine not in _ENGINE_CLASSES:
+        raise ValueError('Unknown inference engine \'{}\'.'.format(engine))
+
+    filepath = Path(model_path) / ENGINE_FILENAMES[engine]
+    if not filepath.is_file():
+        raise ValueError('\'{}\' has no {} model; export it with the "export-engine" command.'.format(
+            model_path, engine
+        ))
+
+    return _ENGINE_CLASSES[engine](filepath, AutoConfig.from_pretrained(str(model_path)))
+
+def save_engine(model, engine, output_path, opset_version=12):
+    '''
+    Exports a model for an inference engine.
+
+    :param model:
+        The :class:`transformers.PreTrainedModel` to export. Models whose layers
+        were quantized can only be exported for the ``torchscript`` engine.
+    :param engine:
+        The name of the engine (``torchscript`` or ``onnx``).
+    :param output_path:
+        The directory to save the exported model in.
+    :param opset_version:
+        The ONNX operator set version. Defaults to 12 (the latest supported by torch 1.5).
+    :returns:
+        The path of the exported model.
+
+    '''
+
+    if engine not in ENGINE_FILENAMES:
+        raise ValueError('Unknown inference engine \'{}\'.'.format(engine))
+
+    config = model.config
+    head_dim = config.n_embd // config.n_head
+
+    # Example inputs with a non-empty key/value cache and more than one token,
+    # so that neither size is specialized.
+    batch_size, length, past_length = 2, 3, 4
+    input_ids = torch.randint(config.vocab_size, (batch_size, length))
+    attention_mask = torch.ones((batch_size, past_length + length), dtype=torch.long)
+    position_ids = torch.arange(past_length, past_length + length).unsqueeze(0).expand(batch_size, -1)
+    past = tuple(
+        (
+            torch.randn(batch_size, config.n_head, past_length, head_dim),
+            torch.randn(batch_size, config.n_head, past_length, head_dim)
+        ) for _ in range(config.n_layer)
+    )
+
+    wrapper = _ExportWrapper(model.eval())
+    filepath = Path(output_path) / ENGINE_FILENAMES[engine]
+    with torch.no_grad():
+        if engine == 'torchscript':
+            module = torch.jit.trace(wrapper, (input_ids, attention_mask, position_ids, past), check_trace=False)
+            torch.jit.save(module, str(filepath))
+            return filepath
+
+        past_names = []
+        for i in range(config.n_layer):
+            past_names += ['past.{}.key'.format(i), 'past.{}.value'.format(i)]
+
+        present_names = [name.replace('past', 'present') for name in past_names]
+        dynamic_axes = {
+            'input_ids': {0: 'batch_size', 1: 'length'},
+            'attention_mask': {0: 'batch_size', 1: 'total_length'},
+            'position_ids': {0: 'batch_size', 1: 'length'},
+            'logits': {0: 'batch_size', 1: 'length'}
+        }
+
+        for name in past_names:
+            dynamic_axes[name] = {0: 'batch_size', 2: 'past_length'}
+
+        for name in present_names:
+            dynamic_axes[name] = {0: 'batch_size', 2: 'total_length'}
+
+        # Later versions of torch export with TorchDynamo by default.
+        export_kwargs = {'dynamo': False} if 'dynamo' in \
+            inspect.signature(torch.onnx.export).parameters else {}
+
+        torch.onnx.export(
+            wrapper, (input_ids, attention_mask, position_ids, past), str(filepath),
+            input_names=['input_ids', 'attention_mask', 'position_ids'] + past_names,
+            output_names=['logits'] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            **export_kwargs
+        )
+
+    return filepath
+
+def export_engine(model_path, engine, output_path=None, opset_version=12):
+    '''
+    Exports a pretrained model checkpoint for an inference engine.
+
+    :param model_path:
+        The path to the pretrained model checkpoint.
+    :param engine:
+        The name of the engine (``torchscript`` or ``onnx``).
+    :param output_path:
+        The directory to save the exported model in. Defaults to None, meaning the
+        model checkpoint directory. If this is another directory, the model
+        configuration is saved along with the exported model.
+    :param opset_version:
+        The ONNX operator set version. Defaults to 12 (the latest supported by torch 1.5).
+    :returns:
+        The path of the exported model.
+
+    '''
+
+    from transformers import AutoModelWithLMHead
+
+    if engine not in ENGINE_FILENAMES:
+        raise ValueError('Unknown inference engine \'{}\'.'.format(engine))
+
+    model_path = Path(model_path)
+    output_path = Path(output_path) if output_path is not None else model_path
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    model = AutoModelWithLMHead.from_pretrained(str(model_path))
+    if output_path != model_path:
+        model.config.save_pretrained(str(output_path))
+
+    return save_engine(model, engine, output_path, opset_version=opset_version)
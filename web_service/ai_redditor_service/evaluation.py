@@ -0,0 +1,65 @@
+'''
+Evaluation of models on the samples of their preprocessed dataset files, shared by
+the model tools (e.g. ``ai_redditor/gpt2/quantize.py`` and ``ai_redditor/gpt2/restrict_vocab.py``).
+
+'''
+
+import math
+import time
+import torch
+import random
+from ai_redditor_service.gpt2 import score, _model_forward
+
+def read_samples(filepath, samples=None, seed=None):
+    '''
+    Reads the samples (one per line) of a preprocessed dataset file.
+
+    :param filepath:
+        The path to the dataset file.
+    :param samples:
+        The number of samples to randomly select. Defaults to None, meaning all samples.
+    :param seed:
+        The seed used to select the samples. Defaults to None.
+    :returns:
+        A list of strings.
+
+    '''
+
+    with open(filepath, 'r', encoding='utf-8') as file:
+        lines = [line.rstrip('\n') for line in file if line.strip()]
+
+    if samples is not None and samples < len(lines):
+        lines = random.Random(seed).sample(lines, samples)
+
+    return lines
+
+def get_perplexity(model, tokenizer, samples, batch_size=8):
+    '''
+    Computes the perplexity of a model on samples.
+
+    '''
+
+    scores = score(model, tokenizer, samples, batch_size=batch_size)
+    num_tokens = sum(x['num_tokens'] for x in scores)
+    return math.exp(-sum(x['log_likelihood'] for x in scores) / max(num_tokens, 1))
+
+@torch.no_grad()
+def get_throughput(model, vocab_size, batch_size=8, prompt_length=32, steps=64, runs=3):
+    '''
+    Measures the decode throughput of a model (with key/value caching), in tokens per second.
+
+    '''
+
+    input_ids = torch.randint(vocab_size, (batch_size, prompt_length))
+    timings = []
+    # The first run warms up the model.
+    for _ in range(runs + 1):
+        logits, past = _model_forward(model, input_ids)
+        start_time = time.time()
+        for _ in range(steps):
+            next_tokens = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+            logits, past = _model_forward(model, next_tokens, past=past)
+
+        timings.append(time.time() - start_time)
+
+    return batch_size * steps / min(timings[1:])
@@ -45,6 +45,14 @@ def _init_celery(app):
         broker_url=app.config['CELERY_BROKER_URL']
     )
 
+    if app.config.get('GPT2_RESERVOIR_ENABLED', False):
+        celery.conf.beat_schedule = {
+            'refill-reservoirs': {
+                'task': 'ai_redditor_service.tasks.refill_reservoirs',
+                'schedule': app.config.get('GPT2_RESERVOIR_REFILL_INTERVAL_SECONDS', 60)
+            }
+        }
+
     class ContextTask(celery.Task):
         '''
         A Celery task that wraps the task execution
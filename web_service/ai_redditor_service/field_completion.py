@@ -0,0 +1,110 @@
+'''
+Completion of the fields missing from a PHC prompt.
+
+The fields of a PHC record appear in a fixed order (likes, author, then comment), so a
+prompt with an author or a comment requires the fields that precede it. The missing
+fields are completed with one of the strategies in :data:`FIELD_COMPLETION_STRATEGIES`:
+
+- ``generate``: generate a whole record from the given fields, and take the missing
+  fields from it.
+- ``decode``: only decode the missing fields, stopping at the special token that follows
+  the last of them (see :func:`ai_redditor_service.gpt2.complete_fields`).
+- ``empirical``: sample the missing fields from their distribution in the dataset
+  records (see :class:`FieldDistribution`), without running the model.
+
+This module does not import torch or transformers.
+
+'''
+
+import json
+import random
+from collections import Counter
+
+FIELD_COMPLETION_STRATEGIES = ('generate', 'decode', 'empirical')
+
+class FieldDistribution:
+    '''
+    The empirical distribution of the likes and authors of the PHC dataset records.
+
+    '''
+
+    def __init__(self, likes, authors):
+        '''
+        Initializes an instance of :class:`FieldDistribution`.
+
+        :param likes:
+            A dictionary mapping each number of likes to its number of records.
+        :param authors:
+            A dictionary mapping each author username to its number of records.
+
+        '''
+
+        self.likes = likes
+        self.authors = authors
+
+        self._values = {
+            'likes': (list(likes.keys()), list(likes.values())),
+            'author': (list(authors.keys()), list(authors.values()))
+        }
+
+    @classmethod
+    def from_records(cls, records, max_authors=10000):
+        '''
+        Computes the distribution of the fields of records.
+
+        :param records:
+            An iterable of tuples containing the likes and author username of each record.
+        :param max_authors:
+            The maximum number of author usernames to keep (the most frequent ones).
+            Defaults to 10000.
+
+        '''
+
+        likes, authors = Counter(), Counter()
+        for record_likes, author in records:
+            if record_likes is not None:
+                likes[int(record_likes)] += 1
+
+            if author:
+                authors[author] += 1
+
+        return cls(dict(likes), dict(authors.most_common(max_authors)))
+
+    @classmethod
+    def load(cls, filepath):
+        '''
+        Loads a distribution saved with :meth:`save`.
+
+        '''
+
+        with open(filepath, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+
+        # JSON object keys are strings; likes are integers.
+        return cls({int(key): value for key, value in data['likes'].items()}, data['authors'])
+
+    def save(self, filepath):
+        '''
+        Saves the distribution to a JSON file.
+
+        '''
+
+        with open(filepath, 'w+', encoding='utf-8') as file:
+            json.dump({'likes': self.likes, 'authors': self.authors}, file)
+
+    def sample(self, field, rng=random):
+        '''
+        Samples a value of a field.
+
+        :param field:
+            The name of the field (``likes`` or ``author``).
+        :param rng:
+            The :class:`random.Random` to sample with. Defaults to the :mod:`random` module.
+
+        '''
+
+        values, weights = self._values[field]
+        if len(values) == 0:
+            raise ValueError('The distribution has no values of the \'{}\' field.'.format(field))
+
+        return rng.choices(values, weights=weights)[0]
@@ -0,0 +1,42 @@
+'''
+The decode formats of the models, shared by the web service, the Celery workers
+and the inference functionality (:mod:`ai_redditor_service.gpt2`).
+
+This module only depends on the standard library, so that importing the inference
+functionality does not import flask, celery or the database models.
+
+'''
+
+import re
+from enum import IntEnum, unique
+
+@unique
+class ModelDecodeFormat(IntEnum):
+    '''
+    The decoding format of the generated text.
+        
+
+    :cvar QUERY_ANSWER:
+        This format can be thought of a pair of strings (referred to 
+        as the query and answer respectively) where the answer is a 
+        mapping of the query into some other translation space. For 
+        example, the query might be a sentence in English and the answer
+        might be the same sentence translated to German.
+
+        For example, in the case of Reddit post text generation, the 
+        query is the  title of the post (such as a writingprompt) and
+        the answer is  the corresponding post selftext or comment
+        (such as a story written from the prompt).
+
+    :cvar PHC:
+        This format is specifically for pornhub comments, where the model
+        outputs text conditioned on the number of likes and author username.
+
+    '''
+
+    QUERY_ANSWER = 0
+    PHC = 1
+
+PHC_LINK_PATTERN = re.compile(r'(?P<url>(https?://)?.*pornhub\.com*[^\s]+)')
+# The substring banned by constrained decoding so that no link can match PHC_LINK_PATTERN.
+PHC_LINK_BANNED_SUBSTRING = 'pornhub.co'
@@ -4,43 +4,42 @@ Inference functionality for GPT2 finetuned model.
 '''
 
 import re
-import json
+import time
+import inspect
 import torch
 import transformers
-from enum import IntEnum, unique
+from pathlib import Path
+from packaging import version
+from ai_redditor_service.dedup import content_hash
+from ai_redditor_service.formats import (
+    ModelDecodeFormat,
+    PHC_LINK_PATTERN,
+    PHC_LINK_BANNED_SUBSTRING
+)
+from ai_redditor_service.acceptance import AcceptanceTracker
+from ai_redditor_service.streaming import TextStreamer
+from ai_redditor_service.weights import WEIGHTS_FILENAME, load_weights_into
+from ai_redditor_service.engines import InferenceEngine, load_engine
+from ai_redditor_service.vocab import VOCAB_FILENAME, load_vocabulary, restrict_vocabulary
+from ai_redditor_service.adapters import use_adapters
+from ai_redditor_service.validators import (
+    SpecialTokenOrderValidator,
+    LinkFilterValidator
+)
+from ai_redditor_service.logits_processors import (
+    DecodeFormatProcessor,
+    BannedSubstringProcessor,
+    RowRangeProcessor,
+    get_digit_token_ids,
+    get_banned_substring_table
+)
 from transformers import (
     set_seed,
+    AutoConfig,
     AutoTokenizer,
     AutoModelWithLMHead
 )
 
-@unique
-class ModelDecodeFormat(IntEnum):
-    '''
-    The decoding format of the generated text.
-        
-
-    :cvar QUERY_ANSWER:
-        This format can be thought of a pair of strings (referred to 
-        as the query and answer respectively) where the answer is a 
-        mapping of the query into some other translation space. For 
-        example, the query might be a sentence in English and the answer
-        might be the same sentence translated to German.
-
-        For example, in the case of Reddit post text generation, the 
-        query is the  title of the post (such as a writingprompt) and
-        the answer is  the corresponding post selftext or comment
-        (such as a story written from the prompt).
-
-    :cvar PHC:
-        This format is specifically for pornhub comments, where the model
-        outputs text conditioned on the number of likes and author username.
-
-    '''
-
-    QUERY_ANSWER = 0
-    PHC = 1
-
 class RawRecord:
     '''
     Text generated by a GPT2 language model which has been split up into
@@ -48,7 +47,7 @@ class RawRecord:
 
     '''
 
-    def __init__(self, groups, raw_text):
+    def __init__(self, groups, raw_text=None, token_ids=None, tokenizer=None):
         '''
         Initializes an instance of :class:`RawRecord`.
 
@@ -56,11 +55,94 @@ class RawRecord:
             A dictionary mapping the name of each group to its data.
         :param raw_text:
             The raw output of the model, containing all special tokens.
+            If not specified, it is decoded from the ``token_ids`` when
+            it is first accessed.
+        :param token_ids:
+            A list of the token ids output by the model. Defaults to None.
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` used to decode the ``token_ids``.
+            Defaults to None.
 
         '''
 
         self.groups = groups
-        self.raw_text = raw_text
+        self._raw_text = raw_text
+        self._token_ids = token_ids
+        self._tokenizer = tokenizer
+
+    @property
+    def raw_text(self):
+        '''
+        The raw output of the model, containing all special tokens.
+
+        '''
+
+        if self._raw_text is None and self._token_ids is not None:
+            self._raw_text = self._tokenizer.decode(self._token_ids)
+
+        return self._raw_text
+
+class GenerationStats:
+    '''
+    Counters describing the work done while generating records.
+
+    :ivar iterations:
+        The number of iterations (decode loops) that were run.
+    :ivar sequences_sampled:
+        The number of sequences that were sampled.
+    :ivar sequences_accepted:
+        The number of sampled sequences that were returned as records.
+    :ivar sequences_aborted:
+        The number of sequences that were aborted mid-decode by a validator.
+    :ivar sequences_timed_out:
+        The number of sequences that were abandoned mid-decode at the deadline of their requests.
+    :ivar decode_steps:
+        The total number of rows computed by decode steps (i.e. the sum of
+        the batch size over all single-token forward passes, or over all
+        verification passes with speculative decoding).
+    :ivar draft_tokens:
+        The number of tokens proposed by the draft model (with speculative decoding).
+    :ivar draft_tokens_accepted:
+        The number of proposed tokens that were accepted (with speculative decoding).
+    :ivar decode_slots:
+        The total number of slots of the decode batch over all decode steps (i.e. the sum
+        of the maximum batch size over all forward passes). The ratio of ``decode_steps``
+        to ``decode_slots`` is the occupancy of the decode batch.
+    :ivar window_shifts:
+        The number of times the key/value cache of a sequence decoded past the context
+        of the model was re-encoded from a shifted window (see :func:`_sample_past_context`).
+
+    '''
+
+    def __init__(self):
+        '''
+        Initializes an instance of :class:`GenerationStats`.
+
+        '''
+
+        self.iterations = 0
+        self.sequences_sampled = 0
+        self.sequences_accepted = 0
+        self.sequences_aborted = 0
+        self.sequences_timed_out = 0
+        self.decode_steps = 0
+        self.draft_tokens = 0
+        self.draft_tokens_accepted = 0
+        self.decode_slots = 0
+        self.window_shifts = 0
+
+    @property
+    def occupancy(self):
+        '''
+        The fraction of the slots of the decode batch that were computing an unfinished row.
+
+        '''
+
+        return self.decode_steps / max(self.decode_slots, 1)
+
+    def __str__(self):
+        return ', '.join('{}={}'.format(key, value) for key, value in vars(self).items()) + \
+            ', occupancy={:.2f}'.format(self.occupancy)
 
 def _init_fp16(*args, opt_level='O1'):
     '''
@@ -76,6 +158,26 @@ def _init_fp16(*args, opt_level='O1'):
 
     return amp.initialize(*args, opt_level=opt_level)
 
+def get_model_nbytes(model):
+    '''
+    Gets the total size, in bytes, of the parameters and buffers of a model
+    (including the packed weights of quantized layers). The size of a model run
+    by an inference engine is the size of its exported model.
+
+    '''
+
+    if isinstance(model, InferenceEngine):
+        return model.nbytes
+
+    def _nbytes(value):
+        if isinstance(value, (tuple, list)):
+            return sum(_nbytes(x) for x in value)
+
+        if not torch.is_tensor(value): return 0
+        return value.numel() * value.element_size()
+
+    return sum(_nbytes(value) for value in model.state_dict().values())
+
 def _verify_special_tokens(tokenizer, **kwargs):
     '''
     Verifies that the specified special tokens (given as keyword arguments)
@@ -90,7 +192,45 @@ def _verify_special_tokens(tokenizer, **kwargs):
             token_name, token_value
         ))
 
-def load_model(model_path, tokenizer_path=None, no_cuda=False, quantize=False):
+def load_tokenizer(model_path, tokenizer_path=None):
+    '''
+    Loads the pretrained tokenizer of a language model.
+
+    :param model_path:
+        The name of standard pretrained model or a path
+        to a checkpoint for weights initialization.
+    :param tokenizer_path:
+        Optional pretrained tokenizer name or path if not
+        the same as the model checkpoint path.
+    :returns:
+        A :class:`transformers.PreTrainedTokenizer`.
+
+    '''
+
+    if tokenizer_path:
+        return AutoTokenizer.from_pretrained(tokenizer_path)
+    elif model_path:
+        return AutoTokenizer.from_pretrained(model_path)
+    else:
+        raise ValueError(
+            'Instantiating a new tokenizer from scratch is not support; however, it can be done from another script.'
+            'Use the tokenizer_path argument to provide it with the location of the script to load the tokenizer.'
+        )
+
+# The data type of the weights of a model loaded with each precision.
+_PRECISION_DTYPES = {
+    'float32': torch.float32,
+    'bfloat16': torch.bfloat16
+}
+
+# The earliest torch version that runs a model with each precision (older versions lack
+# the bfloat16 matrix multiplications and layer normalization of CPU devices).
+_PRECISION_MIN_TORCH_VERSIONS = {
+    'bfloat16': '1.10'
+}
+
+def load_model(model_path, tokenizer_path=None, no_cuda=False, quantize=False, mmap_weights=False,
+               engine='torch', precision='float32', restrict_vocab=False):
     '''
     Loads a pretrained language model and tokenzier.
     
@@ -105,28 +245,77 @@ def load_model(model_path, tokenizer_path=None, no_cuda=False, quantize=False):
         Disable CUDA devices even when they are available. Defaults to False.
     :param quantize:
         Indicates whether to load quantize the model.
+    :param mmap_weights:
+        Indicates whether to memory map the weights of the model from its weight
+        file (see :mod:`ai_redditor_service.weights`), if the model checkpoint has one,
+        so that processes loading the same model share its weights. Defaults to False.
+        The weights are only shared on CPU devices, when the model is not quantized.
+    :param engine:
+        The engine that runs the model: ``torch`` (eager PyTorch), or ``torchscript``
+        or ``onnx`` to run the model exported to the model checkpoint directory (see
+        :mod:`ai_redditor_service.engines`). Defaults to ``torch``. Exported models
+        only run on CPU devices, and ignore the quantize and mmap_weights arguments.
+    :param precision:
+        The precision of the weights, activations and key/value cache of the model:
+        ``float32``, or ``bfloat16`` to halve their memory and bandwidth. Defaults to
+        ``float32``. With ``bfloat16``, matrix multiplications, layer normalization and
+        softmax still accumulate in float32, and tokens are sampled from float32 logits.
+        Casting the weights copies them, so memory mapped weights are not shared.
+        The ``bfloat16`` precision requires torch 1.10 or later.
+    :param restrict_vocab:
+        Indicates whether to restrict the language modelling head of the model to the
+        vocabulary in its restricted vocabulary file (see :mod:`ai_redditor_service.vocab`),
+        if the model checkpoint has one, so that only the logits of its tokens are computed.
+        The other tokens are never sampled. Defaults to False. Only models run by the torch
+        engine are restricted.
     :returns:
-        A :class:`transformers.PreTrainedModel` and a
+        A :class:`transformers.PreTrainedModel` (or an
+        :class:`ai_redditor_service.engines.InferenceEngine`) and a
         :class:`transformers.PreTrainedTokenizer`.
 
     '''
 
+    if precision not in _PRECISION_DTYPES:
+        raise ValueError('Unknown precision \'{}\'.'.format(precision))
+
+    min_torch_version = _PRECISION_MIN_TORCH_VERSIONS.get(precision)
+    if min_torch_version is not None and version.parse(torch.__version__) < version.parse(min_torch_version):
+        raise ValueError('The {} precision requires torch {} or later (installed: {}).'.format(
+            precision, min_torch_version, torch.__version__
+        ))
+
+    if precision != 'float32' and (quantize or engine != 'torch'):
+        raise ValueError('The {} precision is only available for unquantized models run by the torch engine.'.format(precision))
+
+    tokenizer = load_tokenizer(model_path, tokenizer_path)
+    if engine != 'torch':
+        return load_engine(model_path, engine), tokenizer
+
     # Setup device
     device = torch.device('cuda' if torch.cuda.is_available() and not no_cuda else 'cpu')
-    if quantize and device != 'cpu':
+    if quantize and device.type != 'cpu':
         raise RuntimeError('Model quantization only available on CPU devices.')
 
-    if tokenizer_path:
-        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
-    elif model_path:
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
+    weights_filepath = Path(model_path) / WEIGHTS_FILENAME
+    if mmap_weights and weights_filepath.is_file():
+        model = AutoModelWithLMHead.from_config(AutoConfig.from_pretrained(model_path))
+        missing = load_weights_into(model, weights_filepath)
+        if len(missing) > 0:
+            raise ValueError('\'{}\' is missing parameters: {}'.format(weights_filepath, ', '.join(missing)))
+
+        model.eval()
     else:
-        raise ValueError(
-            'Instantiating a new tokenizer from scratch is not support; however, it can be done from another script.'
-            'Use the tokenizer_path argument to provide it with the location of the script to load the tokenizer.'
-        )
-    
-    model = AutoModelWithLMHead.from_pretrained(model_path)
+        model = AutoModelWithLMHead.from_pretrained(model_path)
+
+    vocab_filepath = Path(model_path) / VOCAB_FILENAME
+    if restrict_vocab and vocab_filepath.is_file():
+        vocab_size, token_ids = load_vocabulary(vocab_filepath)
+        if vocab_size != model.config.vocab_size:
+            raise ValueError('\'{}\' does not match the vocabulary of the model.'.format(vocab_filepath))
+
+        # Restricted before quantizing, so that the sliced head is quantized.
+        restrict_vocabulary(model, token_ids)
+
     if quantize:
         model = torch.quantization.quantize_dynamic(
             model, {
@@ -135,9 +324,35 @@ def load_model(model_path, tokenizer_path=None, no_cuda=False, quantize=False):
             }, dtype=torch.qint8
         )
 
-    return model.to(device), tokenizer
+    return model.to(device, dtype=_PRECISION_DTYPES[precision]), tokenizer
+
+def warmup_model(model, tokenizer, batch_size=1, prompt_length=16, steps=4):
+    '''
+    Runs dummy forward passes through a model (a prompt followed by decode steps
+    with key/value caching) so that its kernels and memory allocator are warm
+    before serving the first request.
+
+    :param model:
+        The :class:`transformers.PreTrainedModel` (or
+        :class:`ai_redditor_service.engines.InferenceEngine`) to warm up.
+    :param tokenizer:
+        The :class:`transformers.PreTrainedTokenizer` of the model.
+    :param batch_size:
+        The number of sequences in the dummy batch. Defaults to 1.
+    :param prompt_length:
+        The number of tokens in the dummy prompt. Defaults to 16.
+    :param steps:
+        The number of decode steps after the prompt. Defaults to 4.
 
-PHC_LINK_PATTERN = re.compile(r'(?P<url>(https?://)?.*pornhub\.com*[^\s]+)')
+    '''
+
+    device = model.device
+    token_id = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else 0
+    input_ids = torch.full((batch_size, prompt_length), token_id, dtype=torch.long, device=device)
+    with torch.no_grad():
+        _, past = _model_forward(model, input_ids)
+        for _ in range(steps):
+            _, past = _model_forward(model, input_ids[:, -1:], past=past)
 
 def _get_decode_regex_mapping(strict, bos_token, eos_token, translate_token, end_of_likes_token):
     '''
@@ -204,16 +419,1638 @@ def _get_decode_special_tokens_mapping(bos_token, eos_token, translate_token, en
         ]
     }
 
+
+class GenerationRequest:
+    '''
+    A prompt, and the sampling constraints that are specific to it,
+    submitted to :func:`generate_batch`.
+
+    '''
+
+    def __init__(self, prompt=None, samples=1, use_link_filter=True, no_duplicates=False,
+                 is_custom=None, stream_callback=None, deadline=None):
+        '''
+        Initializes an instance of :class:`GenerationRequest`.
+
+        :param prompt:
+            A prompt for the model. Defaults to None, meaning no prompt is given.
+        :param samples:
+            The number of samples to generate. Defaults to 1.
+        :param use_link_filter:
+            Filter for links in the generated output; if a link is found, the sample is skipped.
+            Defaults to True.
+        :param no_duplicates:
+            Don't generate any duplicate records. Defaults to False.
+        :param is_custom:
+            Whether the prompt is a custom (user provided) prompt, as opposed to the
+            default prompt of the model. Used to classify the prompt when tracking
+            acceptance rates. Defaults to None, meaning that any given prompt is custom.
+        :param stream_callback:
+            A function called with the text of the sequences sampled for the request
+            while they are being generated. See :class:`ai_redditor_service.streaming.TextStreamer`
+            for a description of the events it is called with. Defaults to None.
+        :param deadline:
+            The time (in seconds since the epoch, as returned by :func:`time.time`) by which
+            the request must be served. Once it has passed, no more sequences are sampled for
+            the request, and the records generated so far are returned. Defaults to None,
+            meaning that there is no deadline.
+
+        '''
+
+        self.prompt = prompt
+        self.samples = samples
+        self.use_link_filter = use_link_filter
+        self.no_duplicates = no_duplicates
+        self.is_custom = is_custom if is_custom is not None else prompt is not None
+        self.stream_callback = stream_callback
+        self.deadline = deadline
+
+    @property
+    def is_expired(self):
+        '''
+        Whether the deadline of the request has passed.
+
+        '''
+
+        return self.deadline is not None and time.time() >= self.deadline
+
+class GenerationGroup:
+    '''
+    Requests that are sampled with the same tokenizer, decode format, lengths and
+    adapter, submitted to :func:`generate_groups`.
+
+    '''
+
+    def __init__(self, tokenizer, decode_format, requests, adapter_id=None, min_length=250, max_length=1024,
+                 decode_strict_regex_mapping=None, prompt_cache=None, model_name=None, dedup_index=None,
+                 stats=None):
+        '''
+        Initializes an instance of :class:`GenerationGroup`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` of the requests.
+        :param decode_format:
+            A :class:`ModelDecodeFormat` representing the format of the model output.
+        :param requests:
+            A list of :class:`GenerationRequest` objects.
+        :param adapter_id:
+            The index of the adapter that samples the requests, when the model is a base
+            model with adapters (see :func:`ai_redditor_service.adapters.load_adapters`).
+            Defaults to None, meaning that the model runs as is.
+        :param prompt_cache:
+            A :class:`ai_redditor_service.prompt_cache.PromptCache` of the prompts of the
+            group (with its adapter). Only used when the batch has a single group. Defaults to None.
+        :param stats:
+            A :class:`GenerationStats` that the sequences sampled and accepted for the requests
+            of the group are counted in. Defaults to None, meaning that they are counted in the
+            stats of the batch (see :func:`generate_groups`).
+
+        See :func:`generate_batch` for a description of the other parameters.
+
+        '''
+
+        self.tokenizer = tokenizer
+        self.decode_format = decode_format
+        self.requests = requests
+        self.adapter_id = adapter_id
+        self.min_length = min_length
+        self.max_length = max_length
+        self.decode_strict_regex_mapping = decode_strict_regex_mapping
+        self.prompt_cache = prompt_cache
+        self.model_name = model_name
+        self.dedup_index = dedup_index
+        self.stats = stats
+
+def _model_forward(model, input_ids, past=None, attention_mask=None, position_ids=None, adapter_ids=None):
+    '''
+    Runs a single forward pass of the model with key/value caching enabled.
+
+    :param adapter_ids:
+        The index of the adapter of every row, or a 1-dimensional tensor of the index
+        of the adapter of each row, when the model is a base model with adapters (see
+        :func:`ai_redditor_service.adapters.use_adapters`). Defaults to None, meaning
+        that the model runs as is.
+    :returns:
+        A tuple containing the language modelling logits and the
+        key/value cache (past) of the model.
+
+    '''
+
+    if adapter_ids is not None:
+        with use_adapters(model, adapter_ids):
+            return _model_forward(model, input_ids, past, attention_mask, position_ids)
+
+    # The key/value cache keyword was renamed from 'past' to 'past_key_values'
+    # in later versions of transformers.
+    past_keyword = 'past_key_values' if 'past_key_values' in \
+        inspect.signature(model.forward).parameters else 'past'
+
+    outputs = model(
+        input_ids, attention_mask=attention_mask,
+        position_ids=position_ids, use_cache=True,
+        **{past_keyword: past}
+    )
+
+    return outputs[0], outputs[1]
+
+def _map_past(func, *pasts):
+    '''
+    Applies a function to the corresponding key and value tensors of one or
+    more key/value caches, each of shape (batch_size, num_heads, sequence_length,
+    head_features).
+
+    :returns:
+        A key/value cache in the same layout as the given ones.
+
+    '''
+
+    mapped = []
+    for layers in zip(*pasts):
+        if torch.is_tensor(layers[0]):
+            # The key and value of each layer are stacked into a single tensor.
+            mapped.append(torch.stack([
+                func(*(layer[j] for layer in layers)) for j in range(2)
+            ]))
+        else:
+            mapped.append(tuple(func(*tensors) for tensors in zip(*layers)))
+
+    return tuple(mapped)
+
+@torch.no_grad()
+def _prefill(model, prompt_ids, prompt_cache=None, adapter_id=None):
+    '''
+    Encodes a prompt, reusing the cached state of the longest cached prefix.
+
+    :param prompt_ids:
+        A 1-dimensional tensor of prompt token ids.
+    :param prompt_cache:
+        A :class:`ai_redditor_service.prompt_cache.PromptCache`. Defaults to None,
+        meaning that the prompt is always encoded from scratch.
+    :param adapter_id:
+        The index of the adapter that encodes the prompt (see :func:`_model_forward`).
+        Defaults to None.
+    :returns:
+        A tuple containing the key/value cache of the model after encoding
+        the prompt (with a batch size of 1) and the logits of the last token.
+
+    '''
+
+    key = tuple(prompt_ids.tolist())
+    cached = prompt_cache.get(key) if prompt_cache is not None else None
+    if cached is not None:
+        prefix, past, logits = cached
+        if len(prefix) == len(key): return past, logits
+
+        # Only encode the part of the prompt that follows the cached prefix.
+        logits, past = _model_forward(
+            model, prompt_ids[len(prefix):].unsqueeze(0), past=past,
+            attention_mask=prompt_ids.new_ones((1, len(key))),
+            position_ids=torch.arange(len(prefix), len(key), device=prompt_ids.device).unsqueeze(0),
+            adapter_ids=adapter_id
+        )
+    else:
+        logits, past = _model_forward(model, prompt_ids.unsqueeze(0), adapter_ids=adapter_id)
+
+    logits = logits[0, -1, :]
+    if prompt_cache is not None:
+        prompt_cache.put(key, past, logits)
+
+    return past, logits
+
+def _filter_top_k_top_p(scores, top_k=0, top_p=1.0):
+    '''
+    Filters a distribution of logits using top-k and/or nucleus (top-p) filtering.
+    Filtered logits are set to negative infinity.
+
+    '''
+
+    if top_k > 0:
+        top_k = min(top_k, scores.size(-1))
+        # Remove all tokens with a probability less than the last token of the top-k
+        kth_largest = torch.topk(scores, top_k)[0][..., -1, None]
+        scores = scores.masked_fill(scores < kth_largest, -float('inf'))
+
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(scores, descending=True)
+        cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+        # Remove tokens with cumulative probability above the threshold,
+        # shifting right to keep the first token above the threshold.
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        scores = scores.masked_fill(indices_to_remove, -float('inf'))
+
+    return scores
+
+class _TopKSampler:
+    '''
+    Samples the next token of each row from its top-k (and top-p) filtered scores,
+    without materializing the filtered distribution over the whole vocabulary.
+
+    The ``top_k`` highest scores of each row are selected (in descending order) into a
+    buffer, where they are exponentiated, filtered with top-p and sampled from in place;
+    the sampled positions are then mapped back to token ids. The buffers are allocated
+    once per batch size and reused across decode steps. This samples from the same
+    distribution as :func:`_filter_top_k_top_p` followed by a softmax over the whole
+    vocabulary, except that exactly ``top_k`` tokens are kept when several tokens are
+    tied with the k-th highest score.
+
+    '''
+
+    def __init__(self, top_k=300, top_p=1):
+        '''
+        Initializes an instance of :class:`_TopKSampler`.
+
+        :param top_k:
+            The number of highest scores to sample from. If 0 (or at least the size of the
+            vocabulary), every token is kept and the sampler falls back to the reference
+            implementation (see :func:`_filter_top_k_top_p`).
+        :param top_p:
+            The cumulative probability of the highest probability tokens to sample from.
+
+        '''
+
+        self.top_k = top_k
+        self.top_p = top_p
+        # Maps each (batch size, device) to the buffers of its decode steps.
+        self._buffers = {}
+
+    def _get_buffers(self, batch_size, device):
+        key = (batch_size, device)
+        if key not in self._buffers:
+            self._buffers[key] = (
+                torch.empty((batch_size, self.top_k), device=device),
+                torch.empty((batch_size, self.top_k), dtype=torch.long, device=device),
+                torch.empty((batch_size, 1), dtype=torch.long, device=device)
+            )
+
+        return self._buffers[key]
+
+    def sample(self, scores):
+        '''
+        Samples the next token of each row.
+
+        :param scores:
+            A tensor of shape (batch_size, vocab_size) containing the unfiltered scores.
+        :returns:
+            A 1-dimensional tensor of the sampled token id of each row.
+
+        '''
+
+        scores = scores.float()
+        if self.top_k <= 0 or self.top_k >= scores.size(-1):
+            scores = _filter_top_k_top_p(scores, top_k=self.top_k, top_p=self.top_p)
+            return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+
+        values, indices, positions = self._get_buffers(scores.size(0), scores.device)
+        torch.topk(scores, self.top_k, out=(values, indices))
+
+        # The values are sorted, so the first one of each row is its maximum.
+        values.sub_(values[:, :1].clone()).exp_()
+        if self.top_p < 1.0:
+            cumulative_probs = values.cumsum(dim=-1)
+            cumulative_probs.div_(cumulative_probs[:, -1:].clone())
+            # Remove tokens with cumulative probability above the threshold,
+            # shifting right to keep the first token above the threshold.
+            values[:, 1:].masked_fill_(cumulative_probs[:, :-1] > self.top_p, 0)
+
+        # The weights need not be normalized.
+        torch.multinomial(values, num_samples=1, out=positions)
+        return indices.gather(1, positions).squeeze(1)
+
+@torch.no_grad()
+def _prefill_batch(model, prompt_ids, prompt_cache=None, adapter_ids=None):
+    '''
+    Encodes the prompts of a batch. Each distinct prompt is encoded once (or taken from
+    the ``prompt_cache``), and the resulting key/value caches are left-padded into a
+    single batch.
+
+    :param prompt_ids:
+        A list of 1-dimensional prompt token id tensors, one for each row of the batch.
+    :param adapter_ids:
+        A list of the index of the adapter of each row (see :func:`_model_forward`).
+        Defaults to None. Prompts are only shared by the rows of the same adapter.
+    :returns:
+        A tuple containing the key/value cache of the batch, the logits of the last
+        prompt token of each row, the prompt length of each row and the attention mask.
+
+    '''
+
+    if adapter_ids is None:
+        adapter_ids = [None] * len(prompt_ids)
+
+    unique_keys = {}
+    row_states = []
+    for ids, adapter_id in zip(prompt_ids, adapter_ids):
+        row_states.append(unique_keys.setdefault((adapter_id, tuple(ids.tolist())), len(unique_keys)))
+
+    states = [
+        _prefill(model, torch.tensor(key, device=prompt_ids[0].device), prompt_cache, adapter_id=adapter_id)
+        for adapter_id, key in unique_keys
+    ]
+
+    state_lengths = [len(key) for _, key in unique_keys]
+    max_prompt_length = max(state_lengths)
+
+    # Left-pad the key/value cache of each distinct prompt and gather them into the batch.
+    row_states = torch.tensor(row_states, device=prompt_ids[0].device)
+    past = _map_past(
+        lambda *tensors: torch.cat([
+            torch.nn.functional.pad(tensor, (0, 0, max_prompt_length - length, 0))
+            for tensor, length in zip(tensors, state_lengths)
+        ]).index_select(0, row_states),
+        *(past for past, _ in states)
+    )
+
+    next_token_logits = torch.stack([logits for _, logits in states]).index_select(0, row_states)
+    prompt_lengths = torch.tensor(state_lengths, device=row_states.device).index_select(0, row_states)
+    attention_mask = (
+        torch.arange(max_prompt_length, device=row_states.device).unsqueeze(0) >= \
+            (max_prompt_length - prompt_lengths).unsqueeze(-1)
+    ).long()
+
+    return past, next_token_logits, prompt_lengths, attention_mask
+
+def _concat_batches(pasts, attention_mask, other_pasts, other_attention_mask):
+    '''
+    Concatenates the rows of two decode batches, left-padding the key/value caches
+    and attention mask of the shorter batch to the length of the other.
+
+    :param pasts:
+        A list of key/value caches sharing the ``attention_mask``.
+    :param other_pasts:
+        A list of key/value caches (in the same order as ``pasts``) sharing the
+        ``other_attention_mask``.
+    :returns:
+        A tuple containing the list of concatenated key/value caches and the
+        concatenated attention mask.
+
+    '''
+
+    length = max(attention_mask.size(1), other_attention_mask.size(1))
+    def _pad(tensor, dim):
+        padding = [0, 0] * (tensor.dim() - dim - 1) + [length - tensor.size(dim), 0]
+        return torch.nn.functional.pad(tensor, padding)
+
+    pasts = [
+        _map_past(lambda tensor, other: torch.cat([_pad(tensor, 2), _pad(other, 2)]), past, other_past)
+        for past, other_past in zip(pasts, other_pasts)
+    ]
+
+    return pasts, torch.cat([_pad(attention_mask, 1), _pad(other_attention_mask, 1)])
+
+def _compact_batch(pasts, attention_mask, keep):
+    '''
+    Keeps the specified rows of a decode batch, then drops the leading positions of
+    its key/value caches that are masked in every remaining row (e.g. the padding of
+    a longer prompt whose row was dropped).
+
+    :param pasts:
+        A list of key/value caches sharing the ``attention_mask``.
+    :param keep:
+        A 1-dimensional tensor of the indices of the rows to keep. It must not be empty.
+    :returns:
+        A tuple containing the list of compacted key/value caches and the compacted
+        attention mask.
+
+    '''
+
+    attention_mask = attention_mask.index_select(0, keep)
+    start = (attention_mask.cumsum(-1) == 0).sum(-1).min().item()
+    pasts = [
+        _map_past(lambda tensor: tensor.index_select(0, keep)[:, :, start:], past)
+        for past in pasts
+    ]
+
+    return pasts, attention_mask[:, start:]
+
+def _next_token_scores(scores, lengths, rows, eos_token_id, min_length, top_k=0, top_p=1,
+                       logits_processors=None):
+    '''
+    Computes the scores that the next token of each row is sampled from.
+
+    :param scores:
+        A tensor of shape (len(rows), vocab_size) containing the next token logits.
+    :param lengths:
+        A 1-dimensional tensor of the current length of each row.
+    :param rows:
+        A 1-dimensional tensor of the indices of the rows (in the original batch).
+    :param min_length:
+        The minimum length of every row, or a 1-dimensional tensor of the minimum length of each row.
+    :param top_k:
+        The top-k filtering of the scores. Defaults to 0, meaning that the scores are
+        not filtered (e.g. when sampling with a :class:`_TopKSampler`).
+    :returns:
+        The filtered scores, as float32.
+
+    '''
+
+    scores = scores.float()
+    if eos_token_id is not None:
+        # Prevent the end of sentence token from being sampled before the minimum length
+        scores[lengths < min_length, eos_token_id] = -float('inf')
+
+    for processor in logits_processors or []:
+        scores = processor.process(rows, scores)
+
+    return _filter_top_k_top_p(scores, top_k=top_k, top_p=top_p)
+
+def _abandon_rows(rows, is_valid, stats=None, step_callback=None):
+    '''
+    Abandons rows (admitted to the decode batch or not) once their deadline has passed.
+
+    :param rows:
+        A 1-dimensional tensor of the indices of the rows to abandon.
+    :param is_valid:
+        A boolean tensor indicating which rows were not aborted. It is updated in place.
+
+    '''
+
+    is_valid[rows] = False
+    if stats is not None:
+        stats.sequences_timed_out += rows.size(0)
+
+    if step_callback is not None and rows.size(0) > 0:
+        step_callback([], [], rows.tolist())
+
+def _get_row_deadlines(deadline, batch_size, device):
+    '''
+    Gets a float64 tensor of the deadline of each row of a batch, given a single deadline
+    or a list of the deadline of each row (None for no deadline), or None if no row has one.
+
+    '''
+
+    if deadline is None: return None
+    if not isinstance(deadline, (list, tuple)):
+        deadline = [deadline] * batch_size
+    elif all(row_deadline is None for row_deadline in deadline):
+        return None
+
+    return torch.tensor([
+        float('inf') if row_deadline is None else row_deadline for row_deadline in deadline
+    ], dtype=torch.float64, device=device)
+
+def _get_sink_length(token_ids, prompt_length, context_length, sink_token_ids=None):
+    '''
+    Gets the number of leading tokens of a row that are kept as the attention sink of
+    its sliding window (see :func:`_sample_past_context`): its prompt, extended up to
+    and including the first of the ``sink_token_ids`` (e.g. the query/answer separator,
+    so that a generated query is kept), and capped at half the context of the model.
+
+    '''
+
+    sink_length = prompt_length
+    if sink_token_ids:
+        sink_length = next((
+            i + 1 for i in range(prompt_length, len(token_ids)) if token_ids[i] in sink_token_ids
+        ), prompt_length)
+
+    return min(sink_length, context_length // 2)
+
+@torch.no_grad()
+def _sample_past_context(model, token_ids, prompt_length, eos_token_id, context_length,
+                         window_shift=256, sink_token_ids=None, top_k=300, top_p=1,
+                         min_length=250, max_length=1024, row=0, validators=None,
+                         logits_processors=None, stats=None, step_callback=None,
+                         deadline=None, adapter_id=None):
+    '''
+    Continues sampling a row that reached the context of the model, with a sliding window
+    of its key/value cache. The window holds the attention sink of the row (see
+    :func:`_get_sink_length`) followed by its latest tokens; once it fills the context,
+    the ``window_shift`` oldest tokens after the sink are dropped. Since GPT2 has learned
+    absolute positions, which are part of the cached keys and values, the shifted window
+    is re-encoded with contiguous positions in a single forward pass.
+
+    :param token_ids:
+        A list of the token ids of the row (its prompt and the tokens sampled so far),
+        the last of which has not been encoded yet. It is updated in place.
+    :param prompt_length:
+        The number of tokens of the prompt of the row.
+    :param row:
+        The index of the row (in the original batch), which the ``validators``,
+        ``logits_processors`` and ``step_callback`` see.
+    :param validators:
+        A list of the validators of the batch of the row, including its ``logits_processors``
+        (see :func:`_sample`), which have already seen the tokens of the row.
+    :param adapter_id:
+        The index of the adapter that samples the row. Defaults to None.
+    :returns:
+        The reason that decoding stopped: ``finished`` (the row sampled the end of sentence
+        token or reached the ``max_length``), ``aborted`` (the row failed a validator) or
+        ``timed_out`` (the ``deadline`` passed).
+
+    '''
+
+    device = model.device
+    validators = validators or []
+    rows = torch.tensor([row], device=device)
+    sampler = _TopKSampler(top_k, top_p)
+
+    past, past_length = None, 0
+    while True:
+        if deadline is not None and time.time() >= deadline:
+            return 'timed_out'
+
+        if past is None or past_length == context_length:
+            sink_length = _get_sink_length(token_ids, prompt_length, context_length, sink_token_ids)
+            window = token_ids[:sink_length] + token_ids[-(context_length - window_shift - sink_length):]
+            logits, past = _model_forward(
+                model, torch.tensor([window], device=device), adapter_ids=adapter_id
+            )
+
+            past_length = len(window)
+            if stats is not None:
+                stats.window_shifts += 1
+        else:
+            logits, past = _model_forward(
+                model, torch.tensor([[token_ids[-1]]], device=device), past=past,
+                position_ids=torch.tensor([[past_length]], device=device), adapter_ids=adapter_id
+            )
+
+            past_length += 1
+            if stats is not None:
+                stats.decode_steps += 1
+                stats.decode_slots += 1
+
+        scores = _next_token_scores(
+            logits[:, -1, :], torch.tensor([len(token_ids)], device=device), rows,
+            eos_token_id, min_length, logits_processors=logits_processors
+        )
+
+        next_token = sampler.sample(scores).item()
+        token_ids.append(next_token)
+
+        is_aborted = any(not validator.step([row], [next_token])[0] for validator in validators)
+        if step_callback is not None:
+            step_callback([row], [next_token], [row] if is_aborted else [])
+
+        if is_aborted:
+            if stats is not None:
+                stats.sequences_aborted += 1
+
+            return 'aborted'
+
+        if next_token == eos_token_id or len(token_ids) >= max_length:
+            return 'finished'
+
+@torch.no_grad()
+def _sample(model, prompt_ids, eos_token_id, pad_token_id, top_k=300, top_p=1,
+            min_length=250, max_length=1024, prompt_cache=None, validators=None,
+            logits_processors=None, stats=None, step_callback=None, draft_model=None,
+            num_draft_tokens=4, max_batch_size=None, deadline=None, adapter_ids=None,
+            context_length=None, window_shift=256, sink_token_ids=None):
+    '''
+    Samples a continuation for each prompt in a batch.
+
+    This follows the semantics of :meth:`transformers.PreTrainedModel.generate`
+    with ``do_sample=True``. Each distinct prompt is encoded once (or taken from
+    the ``prompt_cache``), and the resulting key/value caches are left-padded into
+    a single batch with position ids offset for the padding, so that every row
+    decodes exactly as it would in a batch of its own. The ``min_length`` and
+    ``max_length`` are measured per row and include the prompt; either can also be
+    given as a list of the length of each row.
+
+    Rows are dropped from the decode batch (along with their key/value caches) as
+    soon as they finish, so that every decode step only computes the unfinished rows.
+    At most ``max_batch_size`` rows are decoded at once; the remaining rows are
+    admitted, in order, into the slots freed by finished rows.
+
+    :param prompt_ids:
+        A list of 1-dimensional prompt token id tensors, one for each row of the batch.
+    :param validators:
+        A list of :class:`ai_redditor_service.validators.SequenceValidator` objects.
+        Rows that fail any validator are aborted and dropped from the decode batch.
+    :param logits_processors:
+        A list of :class:`ai_redditor_service.logits_processors.LogitsProcessor` objects
+        applied on the next token scores of each row before top-k/top-p filtering.
+    :param stats:
+        A :class:`GenerationStats` object to update. Defaults to None.
+    :param step_callback:
+        A function called after every decode step with a list of the indices of the rows
+        that sampled a token, a list of the sampled token ids, and a list of the indices of
+        the rows that were aborted. Defaults to None.
+    :param draft_model:
+        A smaller model used to sample with speculative decoding (see :func:`_speculative_sample`).
+        Defaults to None, meaning that the model samples one token per forward pass.
+    :param num_draft_tokens:
+        The number of tokens proposed by the draft model per step. Defaults to 4.
+    :param max_batch_size:
+        The maximum number of rows in the decode batch. Defaults to None,
+        meaning that every row is decoded at once.
+    :param deadline:
+        The time (as returned by :func:`time.time`) at which decoding stops, or a list of
+        the deadline of each row (None for no deadline). The rows that have not finished
+        by their deadline are abandoned, even mid-decode (and reported to the ``step_callback``
+        as aborted), while the other rows keep decoding. Defaults to None, meaning that
+        there is no deadline.
+    :param adapter_ids:
+        A list of the index of the adapter that samples each row, when the model is a base
+        model with adapters (see :mod:`ai_redditor_service.adapters`), so that the rows of
+        several adapters are decoded in the same forward passes. The ``prompt_cache`` is
+        only used when every row has the same adapter. Defaults to None.
+    :param context_length:
+        The number of positions of the model (e.g. 1024 for GPT2). The rows that reach it
+        before their ``max_length`` leave the decode batch, and continue decoding one at a
+        time with a sliding window of their key/value cache once the batch is done (see
+        :func:`_sample_past_context`). Defaults to None, meaning that the ``max_length``
+        must not exceed the context of the model.
+    :param window_shift:
+        The number of tokens dropped from the sliding window each time it fills the
+        context. Must be less than half the ``context_length``. Defaults to 256.
+    :param sink_token_ids:
+        A list of token ids up to which the attention sink of the sliding window extends
+        past the prompt (see :func:`_get_sink_length`). Defaults to None.
+    :returns:
+        A tensor of shape (batch_size, sequence_length) containing the prompt
+        and generated token ids of each row, right-padded with the ``pad_token_id``,
+        and a boolean tensor indicating which rows were not aborted.
+
+    '''
+
+    if context_length is not None and not 0 < window_shift < context_length // 2:
+        raise ValueError('The window shift must be between 1 and half the context length.')
+
+    if draft_model is not None:
+        if adapter_ids is not None or not isinstance(min_length, int) or not isinstance(max_length, int):
+            raise ValueError('Speculative decoding is not available with adapters or per-row lengths.')
+
+        if context_length is not None:
+            raise ValueError('Speculative decoding is not available past the context of the model.')
+
+        return _speculative_sample(
+            model, draft_model, prompt_ids, eos_token_id, pad_token_id,
+            num_draft_tokens=num_draft_tokens, top_k=top_k, top_p=top_p,
+            min_length=min_length, max_length=max_length, prompt_cache=prompt_cache,
+            validators=validators, logits_processors=logits_processors,
+            stats=stats, step_callback=step_callback, max_batch_size=max_batch_size,
+            deadline=deadline
+        )
+
+    device = prompt_ids[0].device
+    batch_size = len(prompt_ids)
+    max_batch_size = min(max_batch_size or batch_size, batch_size)
+    is_valid = torch.ones(batch_size, dtype=torch.bool, device=device)
+    input_lengths = torch.tensor([ids.size(0) for ids in prompt_ids], device=device)
+    min_lengths = torch.as_tensor(min_length, device=device).expand(batch_size)
+    max_lengths = torch.as_tensor(max_length, device=device).expand(batch_size)
+    generated = input_lengths.new_full(
+        (batch_size, max(max_lengths.max().item() - input_lengths.min().item(), 0)), pad_token_id
+    )
+
+    output_lengths = input_lengths.clone()
+
+    is_single_adapter = adapter_ids is not None and len(set(adapter_ids)) == 1
+    if adapter_ids is not None and not is_single_adapter:
+        # The cached prompt states are those of a single adapter.
+        prompt_cache = None
+        row_adapter_ids = torch.tensor(adapter_ids, device=device)
+
+    def _get_adapter_ids(rows):
+        if adapter_ids is None: return None
+        # A batch of a single adapter selects it once for all its rows.
+        if is_single_adapter: return adapter_ids[0]
+
+        return row_adapter_ids.index_select(0, rows)
+
+    logits_processors = logits_processors or []
+    validators = (validators or []) + logits_processors
+    for validator in validators:
+        validator.start(prompt_ids)
+
+    # The indices (in the original batch) of the rows that are in the decode batch.
+    active = input_lengths.new_empty((0,))
+    lengths, prompt_lengths = active.clone(), active.clone()
+    past, attention_mask, next_token_logits = None, None, None
+    # The indices of the rows (in order) that have not been admitted to the decode batch.
+    pending = torch.arange(batch_size, device=device)
+    row_deadlines = _get_row_deadlines(deadline, batch_size, device)
+    # The indices of the rows that reached the context of the model, which continue
+    # decoding past it once the decode batch is done.
+    overflow_rows = []
+    sampler = _TopKSampler(top_k, top_p)
+
+    while True:
+        if row_deadlines is not None:
+            # Abandon the rows whose deadline has passed, without prefilling those that
+            # were not admitted, and drop them from the decode batch.
+            now = time.time()
+            expired = row_deadlines[active] <= now
+            is_pending_expired = row_deadlines[pending] <= now
+            _abandon_rows(torch.cat([active[expired], pending[is_pending_expired]]), is_valid, stats, step_callback)
+            pending = pending[~is_pending_expired]
+
+            if expired.any():
+                keep = (~expired).nonzero().squeeze(1)
+                active, lengths, prompt_lengths, next_token_logits = (
+                    x.index_select(0, keep) for x in (active, lengths, prompt_lengths, next_token_logits)
+                )
+
+                if keep.size(0) == 0:
+                    past, attention_mask, next_token_logits = None, None, None
+                else:
+                    (past,), attention_mask = _compact_batch([past], attention_mask, keep)
+
+        if active.size(0) < max_batch_size and pending.size(0) > 0:
+            # Admit the next rows into the free slots of the decode batch.
+            rows, pending = pending[:max_batch_size - active.size(0)], pending[max_batch_size - active.size(0):]
+            row_past, row_logits, row_lengths, row_attention_mask = _prefill_batch(
+                model, [prompt_ids[i] for i in rows.tolist()], prompt_cache,
+                adapter_ids=[adapter_ids[i] for i in rows.tolist()] if adapter_ids is not None else None
+            )
+
+            if past is None:
+                past, attention_mask, next_token_logits = row_past, row_attention_mask, row_logits
+            else:
+                (past,), attention_mask = _concat_batches([past], attention_mask, [row_past], row_attention_mask)
+                next_token_logits = torch.cat([next_token_logits, row_logits])
+
+            active, lengths, prompt_lengths = (torch.cat(x) for x in (
+                (active, rows), (lengths, row_lengths), (prompt_lengths, row_lengths)
+            ))
+
+        if active.size(0) == 0: break
+
+        unfinished = lengths < max_lengths[active]
+        scores = _next_token_scores(
+            next_token_logits, lengths, active, eos_token_id, min_lengths[active],
+            logits_processors=logits_processors
+        )
+
+        next_tokens = sampler.sample(scores)
+        next_tokens = next_tokens.masked_fill(~unfinished, pad_token_id)
+        generated[active[unfinished], (lengths - prompt_lengths)[unfinished]] = next_tokens[unfinished]
+
+        # Abort the sequences that can no longer produce a valid record.
+        aborted = torch.zeros_like(unfinished)
+        for validator in validators:
+            aborted[unfinished] |= ~validator.step(
+                active[unfinished].tolist(), next_tokens[unfinished].tolist()
+            ).to(aborted.device)
+
+        if step_callback is not None:
+            step_callback(
+                active[unfinished].tolist(), next_tokens[unfinished].tolist(),
+                active[aborted].tolist()
+            )
+
+        lengths += unfinished.long()
+        output_lengths[active] = lengths
+        if eos_token_id is not None:
+            unfinished &= next_tokens != eos_token_id
+
+        unfinished &= (lengths < max_lengths[active]) & ~aborted
+        is_valid[active[aborted]] = False
+        if stats is not None:
+            stats.sequences_aborted += aborted.sum().item()
+
+        if context_length is not None:
+            # The rows whose last token no longer fits in the context of the model.
+            overflowed = unfinished & (lengths > context_length)
+            overflow_rows.extend(active[overflowed].tolist())
+            unfinished &= ~overflowed
+
+        if not unfinished.all():
+            # Drop the finished and aborted rows from the decode batch, so that their
+            # slots can be taken by the next rows.
+            keep = unfinished.nonzero().squeeze(1)
+            active, lengths, prompt_lengths, next_tokens = (
+                x.index_select(0, keep) for x in (active, lengths, prompt_lengths, next_tokens)
+            )
+
+            if keep.size(0) == 0:
+                past, attention_mask, next_token_logits = None, None, None
+                continue
+
+            (past,), attention_mask = _compact_batch([past], attention_mask, keep)
+
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.size(0), 1))], dim=-1)
+        logits, past = _model_forward(
+            model, next_tokens.unsqueeze(-1), past=past,
+            attention_mask=attention_mask,
+            position_ids=(lengths - 1).unsqueeze(-1),
+            adapter_ids=_get_adapter_ids(active)
+        )
+
+        next_token_logits = logits[:, -1, :]
+        if stats is not None:
+            stats.decode_steps += next_tokens.size(0)
+            stats.decode_slots += max_batch_size
+
+    for row in overflow_rows:
+        token_ids = torch.cat([prompt_ids[row], generated[row, :output_lengths[row] - input_lengths[row]]]).tolist()
+        status = _sample_past_context(
+            model, token_ids, input_lengths[row].item(), eos_token_id, context_length,
+            window_shift=window_shift, sink_token_ids=sink_token_ids, top_k=top_k, top_p=top_p,
+            min_length=min_lengths[row].item(), max_length=max_lengths[row].item(), row=row,
+            validators=validators, logits_processors=logits_processors, stats=stats,
+            step_callback=step_callback,
+            deadline=row_deadlines[row].item() if row_deadlines is not None else None,
+            adapter_id=adapter_ids[row] if adapter_ids is not None else None
+        )
+
+        generated[row, :len(token_ids) - input_lengths[row]] = torch.tensor(
+            token_ids[input_lengths[row]:], device=device
+        )
+
+        output_lengths[row] = len(token_ids)
+
+        if status == 'aborted':
+            is_valid[row] = False
+        elif status == 'timed_out':
+            # The deadline of the row passed before it finished.
+            _abandon_rows(torch.tensor([row], device=device), is_valid, stats, step_callback)
+
+    output = torch.nn.utils.rnn.pad_sequence([
+        torch.cat([prompt_ids[i], generated[i, :output_lengths[i] - input_lengths[i]]])
+        for i in range(batch_size)
+    ], batch_first=True, padding_value=pad_token_id)
+
+    return output, is_valid
+
+def _shift_past_right(pasts, attention_mask, shifts):
+    '''
+    Shifts each row of one or more key/value caches (sharing an attention mask) right
+    by a number of positions, dropping its last positions and masking the positions
+    shifted in, then drops the leading positions that are masked in every row.
+
+    :param pasts:
+        A list of key/value caches.
+    :param attention_mask:
+        A tensor of shape (batch_size, sequence_length).
+    :param shifts:
+        A 1-dimensional tensor of the number of positions to shift each row by.
+    :returns:
+        A tuple containing the list of shifted key/value caches and the shifted attention mask.
+
+    '''
+
+    index = torch.arange(attention_mask.size(1), device=attention_mask.device).unsqueeze(0) - shifts.unsqueeze(-1)
+    is_shifted_in = index < 0
+    index = index.clamp(min=0)
+    attention_mask = attention_mask.gather(1, index).masked_fill(is_shifted_in, 0)
+
+    start = (attention_mask.cumsum(-1) == 0).sum(-1).min().item()
+    index, attention_mask = index[:, start:], attention_mask[:, start:]
+
+    def _shift(tensor):
+        return tensor.gather(2, index[:, None, :, None].expand(-1, tensor.size(1), -1, tensor.size(3)))
+
+    return [_map_past(_shift, past) for past in pasts], attention_mask
+
+@torch.no_grad()
+def _speculative_sample(model, draft_model, prompt_ids, eos_token_id, pad_token_id, num_draft_tokens=4,
+                        top_k=300, top_p=1, min_length=250, max_length=1024, prompt_cache=None,
+                        validators=None, logits_processors=None, stats=None, step_callback=None,
+                        max_batch_size=None, deadline=None):
+    '''
+    Samples a continuation for each prompt in a batch with speculative decoding.
+
+    At each step, the draft model proposes ``num_draft_tokens`` tokens for every row,
+    one at a time, and the model scores all of them in a single forward pass. Each
+    proposal is accepted with probability min(1, p / q), where p and q are the
+    probabilities of the proposed token under the model and the draft model; the first
+    rejected proposal of a row is replaced by a sample of the residual distribution
+    max(0, p - q), and a row that accepts every proposal samples one more token from
+    the model. The tokens of each row are thus distributed exactly as with :func:`_sample`.
+
+    The proposals are sampled with top-k/top-p filtering but without the logits processors,
+    whose state only advances with the tokens that are kept; proposals that a processor
+    bans are always rejected. The validators and logits processors are stepped, and the
+    ``step_callback`` called, once per kept token.
+
+    The draft model must share the vocabulary of the model. See :func:`_sample` for a
+    description of the other parameters.
+
+    '''
+
+    device = prompt_ids[0].device
+    batch_size = len(prompt_ids)
+    max_batch_size = min(max_batch_size or batch_size, batch_size)
+    is_valid = torch.ones(batch_size, dtype=torch.bool, device=device)
+    input_lengths = torch.tensor([ids.size(0) for ids in prompt_ids], device=device)
+    generated = input_lengths.new_full((batch_size, max(max_length - input_lengths.min().item(), 0)), pad_token_id)
+    output_lengths = input_lengths.clone()
+
+    logits_processors = logits_processors or []
+    validators = (validators or []) + logits_processors
+    for validator in validators:
+        validator.start(prompt_ids)
+
+    # The indices (in the original batch) of the rows that are in the decode batch.
+    active = input_lengths.new_empty((0,))
+    lengths, prompt_lengths = active.clone(), active.clone()
+    # The last token of each row, which is not yet in the key/value caches.
+    next_tokens = active.clone()
+    unfinished = torch.zeros(0, dtype=torch.bool, device=device)
+    past, draft_past, attention_mask = None, None, None
+    # The indices of the rows (in order) that have not been admitted to the decode batch.
+    pending = torch.arange(batch_size, device=device)
+    row_deadlines = _get_row_deadlines(deadline, batch_size, device)
+
+    def _sample_scores(rows, logits):
+        return _next_token_scores(
+            logits, lengths[rows], active[rows], eos_token_id, min_length,
+            top_k=top_k, top_p=top_p, logits_processors=logits_processors
+        )
+
+    def _keep_tokens(rows, tokens):
+        # Rows are indices in the decode batch of unfinished rows.
+        generated[active[rows], lengths[rows] - prompt_lengths[rows]] = tokens
+
+        # Abort the sequences that can no longer produce a valid record.
+        aborted = torch.zeros(rows.size(0), dtype=torch.bool, device=device)
+        for validator in validators:
+            aborted |= ~validator.step(active[rows].tolist(), tokens.tolist()).to(device)
+
+        if step_callback is not None:
+            step_callback(active[rows].tolist(), tokens.tolist(), active[rows[aborted]].tolist())
+
+        lengths[rows] += 1
+        output_lengths[active[rows]] = lengths[rows]
+        next_tokens[rows] = tokens
+
+        finished = aborted | (lengths[rows] >= max_length)
+        if eos_token_id is not None:
+            finished |= tokens == eos_token_id
+
+        unfinished[rows] = ~finished
+        is_valid[active[rows[aborted]]] = False
+        if stats is not None:
+            stats.sequences_aborted += aborted.sum().item()
+
+    positions = torch.arange(num_draft_tokens + 1, device=device).unsqueeze(0)
+    while True:
+        if row_deadlines is not None:
+            # Abandon the rows whose deadline has passed, without prefilling those that
+            # were not admitted; the unfinished ones are dropped from the decode batch below.
+            now = time.time()
+            expired = unfinished & (row_deadlines[active] <= now)
+            is_pending_expired = row_deadlines[pending] <= now
+            _abandon_rows(torch.cat([active[expired], pending[is_pending_expired]]), is_valid, stats, step_callback)
+            pending = pending[~is_pending_expired]
+            unfinished &= ~expired
+
+        if active.size(0) < max_batch_size and pending.size(0) > 0:
+            # Admit the next rows into the free slots of the decode batch.
+            rows, pending = pending[:max_batch_size - active.size(0)], pending[max_batch_size - active.size(0):]
+            row_prompt_ids = [prompt_ids[i] for i in rows.tolist()]
+            row_past, row_logits, row_lengths, row_attention_mask = _prefill_batch(model, row_prompt_ids, prompt_cache)
+            # The prompt cache holds the state of the model, so the draft model encodes the prompts itself.
+            row_draft_past, _, _, _ = _prefill_batch(draft_model, row_prompt_ids)
+
+            if past is None:
+                past, draft_past, attention_mask = row_past, row_draft_past, row_attention_mask
+            else:
+                (past, draft_past), attention_mask = _concat_batches(
+                    [past, draft_past], attention_mask, [row_past, row_draft_past], row_attention_mask
+                )
+
+            offset = active.size(0)
+            active, lengths, prompt_lengths, next_tokens, unfinished = (torch.cat(x) for x in (
+                (active, rows), (lengths, row_lengths), (prompt_lengths, row_lengths),
+                (next_tokens, row_lengths.new_full(rows.size(), pad_token_id)),
+                (unfinished, row_lengths < max_length)
+            ))
+
+            # The first token of each admitted row is sampled from the logits of its prompt.
+            first_rows = unfinished[offset:].nonzero().squeeze(1)
+            if first_rows.size(0) > 0:
+                scores = _sample_scores(first_rows + offset, row_logits[first_rows])
+                _keep_tokens(first_rows + offset, torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1))
+
+        if not unfinished.all():
+            # Drop the finished and aborted rows from the decode batch, so that their
+            # slots can be taken by the next rows.
+            keep = unfinished.nonzero().squeeze(1)
+            active, lengths, prompt_lengths, unfinished, next_tokens = (
+                x.index_select(0, keep) for x in (active, lengths, prompt_lengths, unfinished, next_tokens)
+            )
+
+            if keep.size(0) == 0:
+                past, draft_past, attention_mask = None, None, None
+                continue
+
+            (past, draft_past), attention_mask = _compact_batch([past, draft_past], attention_mask, keep)
+
+        if active.size(0) == 0: break
+
+        # Positions past the maximum length are only fed for rows that finish before
+        # using their logits; they are clamped to stay within the position embeddings.
+        position_ids = ((lengths - 1).unsqueeze(-1) + positions).clamp(max=max_length - 1)
+        attention_mask = torch.cat([
+            attention_mask, attention_mask.new_ones((attention_mask.size(0), num_draft_tokens + 1))
+        ], dim=-1)
+
+        # Propose tokens with the draft model. The last proposal is also fed to it, so
+        # that its cache is complete if every proposal is accepted.
+        draft_tokens, draft_probs = [], []
+        input_ids = next_tokens
+        for i in range(num_draft_tokens + 1):
+            logits, draft_past = _model_forward(
+                draft_model, input_ids.unsqueeze(-1), past=draft_past,
+                attention_mask=attention_mask[:, :attention_mask.size(1) - num_draft_tokens + i],
+                position_ids=position_ids[:, i:i + 1]
+            )
+
+            if i == num_draft_tokens: break
+            scores = _next_token_scores(
+                logits[:, -1, :], lengths + i, active, eos_token_id, min_length,
+                top_k=top_k, top_p=top_p
+            )
+
+            draft_probs.append(torch.softmax(scores, dim=-1))
+            input_ids = torch.multinomial(draft_probs[-1], num_samples=1).squeeze(1)
+            draft_tokens.append(input_ids)
+
+        draft_tokens = torch.stack(draft_tokens, dim=1)
+        logits, past = _model_forward(
+            model, torch.cat([next_tokens.unsqueeze(-1), draft_tokens], dim=-1), past=past,
+            attention_mask=attention_mask, position_ids=position_ids
+        )
+
+        if stats is not None:
+            stats.decode_steps += next_tokens.size(0)
+            stats.decode_slots += max_batch_size
+            stats.draft_tokens += draft_tokens.numel()
+
+        kept = torch.zeros_like(lengths)
+        verifying = unfinished.clone()
+        for i in range(num_draft_tokens + 1):
+            rows = verifying.nonzero().squeeze(1)
+            if rows.size(0) == 0: break
+
+            probs = torch.softmax(_sample_scores(rows, logits[rows, i, :]), dim=-1)
+            if i == num_draft_tokens:
+                tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                proposals = draft_tokens[rows, i]
+                draft_row_probs = draft_probs[i][rows]
+                is_accepted = torch.rand(rows.size(0), device=device) * \
+                    draft_row_probs.gather(1, proposals.unsqueeze(-1)).squeeze(1) <= \
+                    probs.gather(1, proposals.unsqueeze(-1)).squeeze(1)
+
+                residual = (probs - draft_row_probs).clamp(min=0)
+                # The residual is empty when both distributions are the same.
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, probs)
+                tokens = torch.where(is_accepted, proposals, torch.multinomial(residual, num_samples=1).squeeze(1))
+                verifying[rows[~is_accepted]] = False
+                if stats is not None:
+                    stats.draft_tokens_accepted += is_accepted.sum().item()
+
+            _keep_tokens(rows, tokens)
+            kept[rows] += 1
+            verifying &= unfinished
+
+        # The caches hold the fed tokens of each row up to its last kept token; drop
+        # the rest (the rejected proposals) by right-aligning the rows.
+        (past, draft_past), attention_mask = _shift_past_right(
+            [past, draft_past], attention_mask, num_draft_tokens + 1 - kept
+        )
+
+    output = torch.nn.utils.rnn.pad_sequence([
+        torch.cat([prompt_ids[i], generated[i, :output_lengths[i] - input_lengths[i]]])
+        for i in range(batch_size)
+    ], batch_first=True, padding_value=pad_token_id)
+
+    return output, is_valid
+
+def _split_record(raw_text, decode_format, decode_strict_regex, use_link_filter=True):
+    '''
+    Splits the decoded model output into groups of data based on the decode format.
+
+    :returns:
+        A dictionary mapping the name of each group to its data, or None
+        if the decoded output is not a valid record.
+
+    '''
+
+    if decode_format == ModelDecodeFormat.PHC and use_link_filter:
+        # Filter out for pornhub links contained in the comment.
+        # Comments that contain links are often not very interesting (just advertisement).
+        urls = PHC_LINK_PATTERN.findall(raw_text)
+        if len(urls) > 0: return None
+
+    match = decode_strict_regex.match(raw_text)
+    # Check if the decode regex matched the decoded string
+    if not match: return None
+
+    if decode_format == ModelDecodeFormat.QUERY_ANSWER:
+        groups = {
+            'prompt': match.group('prompt'),
+            'response': match.group('response')
+        }
+    elif decode_format == ModelDecodeFormat.PHC:
+        groups = {
+            'likes': match.group('likes'),
+            'author': match.group('author'),
+            'comment_body': match.group('comment_body'),
+        }
+
+    # Check if generated sequence has missing matching groups
+    if any(value is None for value in groups.values()): return None
+    # Strip all match groups of trailing whitespace
+    return {key: value.strip() for key, value in groups.items()}
+
+# The names of the match groups of each decode format, in order of appearance.
+_DECODE_FORMAT_GROUP_NAMES = {
+    ModelDecodeFormat.QUERY_ANSWER: ['prompt', 'response'],
+    ModelDecodeFormat.PHC: ['likes', 'author', 'comment_body']
+}
+
+def _split_records(output, rows, tokenizer, decode_format, decode_strict_regex,
+                   special_token_ids, use_link_filters):
+    '''
+    Splits the output of several rows into groups of data based on the decode format.
+
+    The special tokens of every row are located on the token ids of the whole batch at
+    once. Rows whose special tokens (up to the first end of sentence token) appear once
+    each and in the order of the decode format, and that are only padded after the end of
+    sentence token, are split on those positions and only the token spans of their groups
+    are decoded, each along with the special tokens around it, so that the spaces that the
+    tokenizer adds (and cleans up) around special tokens are the same as in the decoded row.
+    Constrained decoding always produces such rows. Any other row is decoded in full and
+    split by :func:`_split_record`. In both cases, the groups are the same as the ones given
+    by :func:`_split_record`, provided that the text of the special tokens is never produced
+    by other tokens.
+
+    :param output:
+        A tensor of shape (batch_size, sequence_length) containing the token ids of each row.
+    :param rows:
+        A list of the indices of the rows to split.
+    :param special_token_ids:
+        The ids of the special tokens, in order of appearance in the decode format.
+    :param use_link_filters:
+        A list indicating, for each row in ``rows``, whether to filter out links.
+    :returns:
+        A list containing, for each row in ``rows``, a dictionary mapping the name of each
+        group to its data, or None if the row is not a valid record.
+
+    '''
+
+    if len(rows) == 0: return []
+
+    output = output.index_select(0, torch.tensor(rows, dtype=torch.long, device=output.device))
+    special_token_ids = torch.tensor(special_token_ids, dtype=output.dtype, device=output.device)
+    num_special_tokens, length = special_token_ids.size(0), output.size(1)
+
+    is_split = torch.zeros(len(rows), dtype=torch.bool)
+    if length >= num_special_tokens:
+        positions = torch.arange(length, device=output.device).expand_as(output)
+        is_eos = output == special_token_ids[-1]
+        # The position of the first end of sentence token of each row (or the length of the row)
+        eos_positions = positions.masked_fill(~is_eos, length).min(dim=-1)[0]
+        is_special = (output.unsqueeze(-1) == special_token_ids).any(dim=-1) & \
+            (positions <= eos_positions.unsqueeze(-1))
+
+        # The positions of the first special tokens of each row, in order.
+        special_positions = positions.masked_fill(~is_special, length) \
+            .sort(dim=-1)[0][:, :num_special_tokens]
+
+        # The link filter of the regex path also searches the text after the end of sentence token.
+        has_trailing_tokens = ((output != tokenizer.pad_token_id) & \
+            (positions > eos_positions.unsqueeze(-1))).any(dim=-1)
+
+        is_split = is_eos.any(dim=-1) & ~has_trailing_tokens & \
+            (is_special.sum(dim=-1) == num_special_tokens) & \
+            (special_positions[:, 0] == 0) & (
+                output.gather(1, special_positions.clamp(max=length - 1)) == special_token_ids
+            ).all(dim=-1)
+
+        is_split = is_split.cpu()
+        special_positions = special_positions.cpu()
+
+    group_names = _DECODE_FORMAT_GROUP_NAMES[decode_format]
+    output_ids = output.tolist()
+
+    # Decode the groups of all the rows that can be split on their special tokens at once.
+    split_rows = is_split.nonzero().view(-1).tolist()
+    spans = []
+    for i in split_rows:
+        row_positions = special_positions[i].tolist()
+        spans.extend(
+            output_ids[i][start:end + 1]
+            for start, end in zip(row_positions[:-1], row_positions[1:])
+        )
+
+    span_texts = tokenizer.batch_decode(spans) if len(spans) > 0 else []
+    special_tokens = tokenizer.convert_ids_to_tokens(special_token_ids.tolist())
+
+    results = [None] * len(rows)
+    for k, i in enumerate(split_rows):
+        texts = span_texts[k * len(group_names):(k + 1) * len(group_names)]
+        if not all(
+            len(text) >= len(start_token) + len(end_token) and
+            text.startswith(start_token) and text.endswith(end_token)
+            for text, start_token, end_token in zip(texts, special_tokens[:-1], special_tokens[1:])
+        ):
+            # The special tokens are not decoded as is; split the row with the decode regex instead.
+            is_split[i] = False
+            continue
+
+        # The text of each group, followed by the special token after it.
+        texts = [text[len(start_token):] for text, start_token in zip(texts, special_tokens[:-1])]
+        groups = [text[:len(text) - len(end_token)] for text, end_token in zip(texts, special_tokens[1:])]
+        # The strict regex needs at least one character in each group.
+        if any(len(group) == 0 for group in groups): continue
+
+        # A link may end with the first character of the special token after the group.
+        if decode_format == ModelDecodeFormat.PHC and use_link_filters[i] and any(
+            PHC_LINK_PATTERN.search(text) is not None for text in texts
+        ): continue
+
+        results[i] = {name: group.strip() for name, group in zip(group_names, groups)}
+
+    for i in range(len(rows)):
+        if is_split[i]: continue
+        results[i] = _split_record(
+            tokenizer.decode(output_ids[i]), decode_format,
+            decode_strict_regex, use_link_filter=use_link_filters[i]
+        )
+
+    return results
+
+def generate_batch(model, tokenizer, decode_format, requests, top_k=300, top_p=1,
+                   num_return_sequences=10, max_iterations=10, min_length=250, max_length=1024,
+                   translate_token='<|eq_tok|>', end_of_likes_token='<|eol|>',
+                   fp16=False, fp16_opt_level='O1', decode_strict_regex_mapping=None,
+                   prompt_cache=None, use_streaming_validation=True, use_constrained_decoding=True,
+                   stats=None, acceptance_tracker=None, model_name=None, target_probability=0.9,
+                   dedup_index=None, draft_model=None, num_draft_tokens=4, max_batch_size=None,
+                   window_shift=256):
+    '''
+    Generate text for several prompts at once from a model with a language modelling head.
+
+    The prompts of all the requests that still need samples are left-padded into a
+    single batch, so that each iteration runs one decode loop regardless of how many
+    requests are being served.
+
+    :param model:
+        A :class:`transformers.PreTrainedModel` (or :class:`ai_redditor_service.engines.InferenceEngine`)
+        to use for inference.
+    :param tokenizer:
+        A :class:`transformers.PreTrainedTokenizer` to use to encode
+        input sequences to token and to decode output sequences to text.
+    :param decode_format:
+        A :class:`ModelDecodeFormat` representing the format of the model output.
+    :param requests:
+        A list of :class:`GenerationRequest` objects.
+    :param num_return_sequences:
+        The maximum number of sequences to return per request per iteration. Defaults to 10.
+    :param acceptance_tracker:
+        A :class:`ai_redditor_service.acceptance.AcceptanceTracker` of the acceptance rates
+        of sampled sequences, kept per model, decode format and prompt class (empty or custom).
+        If specified, the number of sequences sampled for each request is the smallest number
+        that yields the remaining samples with the ``target_probability``, given the measured
+        acceptance rate; otherwise, a fixed oversampling factor is used. Defaults to None.
+    :param model_name:
+        The name of the model used in the keys of the ``acceptance_tracker``. Defaults to None.
+    :param target_probability:
+        The target probability of generating all the remaining samples of a request in a single
+        iteration. Only used with an ``acceptance_tracker``. Defaults to 0.9.
+    :param dedup_index:
+        An index of the content hashes (see :func:`ai_redditor_service.dedup.content_hash`)
+        of records that must not be generated again, such as
+        :class:`ai_redditor_service.dedup.DatabaseHashIndex`. Sequences whose records are in
+        the index, or were already accepted for another request, are rejected. Defaults to
+        None, meaning that only the requests with ``no_duplicates`` are deduplicated.
+    :returns:
+        A list containing, for each request (in the same order as ``requests``),
+        a list of :class:`RawRecord` objects.
+
+    See :func:`generate` for a description of the other parameters.
+
+    '''
+
+    group = GenerationGroup(
+        tokenizer, decode_format, requests, min_length=min_length, max_length=max_length,
+        decode_strict_regex_mapping=decode_strict_regex_mapping, prompt_cache=prompt_cache,
+        model_name=model_name, dedup_index=dedup_index
+    )
+
+    return generate_groups(
+        model, [group], top_k=top_k, top_p=top_p, num_return_sequences=num_return_sequences,
+        max_iterations=max_iterations, translate_token=translate_token,
+        end_of_likes_token=end_of_likes_token, fp16=fp16, fp16_opt_level=fp16_opt_level,
+        use_streaming_validation=use_streaming_validation,
+        use_constrained_decoding=use_constrained_decoding, stats=stats,
+        acceptance_tracker=acceptance_tracker, target_probability=target_probability,
+        draft_model=draft_model, num_draft_tokens=num_draft_tokens, max_batch_size=max_batch_size,
+        window_shift=window_shift
+    )[0]
+
+def generate_groups(model, groups, top_k=300, top_p=1, num_return_sequences=10, max_iterations=10,
+                    translate_token='<|eq_tok|>', end_of_likes_token='<|eol|>', fp16=False,
+                    fp16_opt_level='O1', use_streaming_validation=True, use_constrained_decoding=True,
+                    stats=None, acceptance_tracker=None, target_probability=0.9, draft_model=None,
+                    num_draft_tokens=4, max_batch_size=None, window_shift=256):
+    '''
+    Generate text for the requests of several groups at once, each group having its own
+    tokenizer, decode format, lengths and (with a base model shared by several adapters)
+    adapter, so that the requests of different record types are sampled in the same
+    forward passes.
+
+    Every iteration samples the rows of all the groups in a single decode loop; the
+    validators and logits processors of each group only see the rows of the group.
+    The tokenizers of the groups must share their end of sentence and padding tokens.
+
+    The sequences sampled and accepted for the requests of a group are counted in the
+    stats of the group, if it has any; the other counters (e.g. the decode steps) describe
+    the decode loops shared by the groups, so they are counted in ``stats``.
+
+    :param model:
+        A :class:`transformers.PreTrainedModel` (or :class:`ai_redditor_service.engines.InferenceEngine`)
+        to use for inference, or a base model with adapters (see :mod:`ai_redditor_service.adapters`).
+    :param groups:
+        A list of :class:`GenerationGroup` objects.
+    :returns:
+        A list containing, for each group (in the same order as ``groups``), a list
+        containing, for each of its requests, a list of :class:`RawRecord` objects.
+
+    See :func:`generate_batch` for a description of the other parameters.
+
+    '''
+
+    if fp16:
+        model = _init_fp16(model, opt_level=fp16_opt_level)
+
+    if draft_model is not None and num_draft_tokens < 1:
+        raise ValueError('The number of draft tokens must be at least 1.')
+
+    if max_batch_size is not None and max_batch_size < 1:
+        raise ValueError('The maximum batch size must be at least 1.')
+
+    # Sequences longer than the context of the model are decoded past it with a sliding window.
+    context_length = getattr(model.config, 'n_positions', None)
+    if context_length is not None and all(group.max_length <= context_length for group in groups):
+        context_length = None
+
+    if context_length is not None and draft_model is not None:
+        # The draft model only speeds up sequences that fit in the context of the model.
+        draft_model = None
+
+    eos_token_id, pad_token_id = groups[0].tokenizer.eos_token_id, groups[0].tokenizer.pad_token_id
+    if any(group.tokenizer.eos_token_id != eos_token_id or group.tokenizer.pad_token_id != pad_token_id for group in groups):
+        raise ValueError('The tokenizers of the groups must share their end of sentence and padding tokens.')
+
+    decode_strict_regexes, special_token_ids = [], []
+    for group in groups:
+        tokenizer, decode_format = group.tokenizer, group.decode_format
+        provided_special_tokens = {
+            'translate': translate_token,
+        }
+
+        if decode_format == ModelDecodeFormat.PHC:
+            provided_special_tokens['end_of_likes'] = end_of_likes_token
+
+        decode_strict_regex_mapping = group.decode_strict_regex_mapping
+        if decode_strict_regex_mapping is None:
+            # Strict regex patterns (i.e. matching groups cannot be empty) for splitting
+            # the model output into groups of data based on the decode format.
+            decode_strict_regex_mapping = _get_decode_regex_mapping(
+                True, tokenizer.bos_token, tokenizer.eos_token,
+                translate_token, end_of_likes_token
+            )
+
+        _verify_special_tokens(tokenizer,  **provided_special_tokens)   
+        if decode_format not in decode_strict_regex_mapping:
+            raise ValueError('{} is invalid. Must be one of: {}.'.format(
+                decode_format, list(decode_strict_regex_mapping.keys())
+            ))
+
+        decode_strict_regexes.append(decode_strict_regex_mapping[decode_format])
+        special_token_ids.append(tokenizer.convert_tokens_to_ids(_get_decode_special_tokens_mapping(
+            tokenizer.bos_token, tokenizer.eos_token, translate_token, end_of_likes_token
+        )[decode_format]))
+
+    # Every sequence sampled with constrained decoding is structurally valid, so there
+    # is no need to sample more sequences than the number of remaining samples.
+    oversample_factor = 1 if use_constrained_decoding else 1.5
+
+    # Encode the prompts using the tokenizer. If no prompt is specified, the default is the BOS token.
+    prompt_ids = [
+        [
+            group.tokenizer.encode(request.prompt or group.tokenizer.bos_token, return_tensors='pt')[0].to(model.device)
+            for request in group.requests
+        ] for group in groups
+    ]
+
+    results = [[[] for _ in group.requests] for group in groups]
+    visited = [[set() for _ in group.requests] for group in groups]
+    accepted_hashes = [set() for _ in groups]
+    # The number of sequences sampled for each request so far
+    sequence_counts = [[0 for _ in group.requests] for group in groups]
+    stream_callbacks = [[request.stream_callback for request in group.requests] for group in groups]
+    acceptance_keys = [
+        [
+            AcceptanceTracker.get_key(
+                group.model_name, ModelDecodeFormat(group.decode_format).name,
+                'custom' if request.is_custom else 'empty'
+            ) for request in group.requests
+        ] for group in groups
+    ]
+
+    current_iteration = 0
+
+    while True:
+        pending = [
+            [
+                i for i, request in enumerate(group.requests)
+                if len(results[g][i]) < request.samples and not request.is_expired
+            ] for g, group in enumerate(groups)
+        ]
+
+        if all(len(group_pending) == 0 for group_pending in pending): break
+        if max_iterations != -1 and current_iteration > max_iterations: break
+
+        current_iteration += 1
+        batch_ids, validators, logits_processors = [], [], []
+        # The index of the request that owns each row of each group, and the range of rows of each group.
+        batch_owners, row_ranges = [[] for _ in groups], []
+        streamers = [None for _ in groups]
+        for g, group in enumerate(groups):
+            requests, tokenizer, decode_format = group.requests, group.tokenizer, group.decode_format
+            owners = batch_owners[g]
+            for i in pending[g]:
+                remaining_samples = requests[i].samples - len(results[g][i])
+                if acceptance_tracker is not None:
+                    request_return_sequences = acceptance_tracker.num_sequences(
+                        acceptance_keys[g][i], remaining_samples,
+                        target_probability=target_probability,
+                        max_sequences=num_return_sequences
+                    )
+                else:
+                    # Multiply by some 'arbitrary' scale factor to pad the next attempt in case there are
+                    # any failed attempts. We use 1.5 as an approximation under the assumption that 50% of
+                    # the samples in iteration are failed (this is an overestimation for safety).
+                    request_return_sequences = min(int(remaining_samples * oversample_factor), num_return_sequences)
+
+                owners.extend([i] * request_return_sequences)
+
+            row_ranges.append((len(batch_ids), len(batch_ids) + len(owners)))
+            batch_ids.extend(prompt_ids[g][i] for i in owners)
+            if len(owners) == 0: continue
+
+            group_validators = []
+            if use_streaming_validation:
+                group_validators.append(SpecialTokenOrderValidator(special_token_ids[g]))
+                if decode_format == ModelDecodeFormat.PHC:
+                    group_validators.append(LinkFilterValidator(tokenizer, PHC_LINK_PATTERN, rows=[
+                        row for row, i in enumerate(owners) if requests[i].use_link_filter
+                    ]))
+
+            group_logits_processors = []
+            if use_constrained_decoding:
+                field_token_ids = {}
+                if decode_format == ModelDecodeFormat.PHC:
+                    # The likes field (following the BOS token) only consists of digits.
+                    field_token_ids[0] = get_digit_token_ids(tokenizer)
+
+                group_logits_processors.append(DecodeFormatProcessor(
+                    special_token_ids[g], group.max_length, field_token_ids=field_token_ids,
+                    banned_token_ids=[
+                        token_id for token_id in tokenizer.all_special_ids
+                        if token_id not in special_token_ids[g]
+                    ]
+                ))
+
+                if decode_format == ModelDecodeFormat.PHC:
+                    group_logits_processors.append(BannedSubstringProcessor(
+                        tokenizer, get_banned_substring_table(tokenizer, PHC_LINK_BANNED_SUBSTRING),
+                        rows=[row for row, i in enumerate(owners) if requests[i].use_link_filter]
+                    ))
+
+            if len(groups) > 1:
+                # The validators and logits processors of the group only see its rows.
+                group_validators, group_logits_processors = (
+                    [RowRangeProcessor(processor, *row_ranges[g]) for processor in processors]
+                    for processors in (group_validators, group_logits_processors)
+                )
+
+            validators.extend(group_validators)
+            logits_processors.extend(group_logits_processors)
+
+            if any(stream_callbacks[g][i] is not None for i in pending[g]):
+                streamers[g] = TextStreamer(tokenizer, stream_callbacks[g], owners, sequence_counts[g])
+
+            for i in owners:
+                sequence_counts[g][i] += 1
+
+        def _step_callback(rows, next_tokens, aborted_rows):
+            # Stream the tokens of each group to its streamer, indexing its rows from the start of the group.
+            for streamer, (start, stop) in zip(streamers, row_ranges):
+                if streamer is None: continue
+
+                is_member = [start <= row < stop for row in rows]
+                streamer.step(
+                    [row - start for row, member in zip(rows, is_member) if member],
+                    [token for token, member in zip(next_tokens, is_member) if member],
+                    [row - start for row in aborted_rows if start <= row < stop]
+                )
+
+        # The lengths, adapter and deadline of each row, which are passed per row only when they
+        # differ, so that the rows of an expired request are abandoned while the others keep decoding.
+        row_groups = [g for g, (start, stop) in enumerate(row_ranges) for _ in range(start, stop)]
+        deadlines = [groups[g].requests[i].deadline for g, owners in enumerate(batch_owners) for i in owners]
+        min_lengths = [groups[g].min_length for g in row_groups]
+        max_lengths = [groups[g].max_length for g in row_groups]
+        adapter_ids = [groups[g].adapter_id or 0 for g in row_groups]
+
+        output, is_valid = _sample(
+            model, batch_ids, eos_token_id, pad_token_id,
+            top_k=top_k, top_p=top_p,
+            min_length=min_lengths[0] if len(set(min_lengths)) == 1 else min_lengths,
+            max_length=max_lengths[0] if len(set(max_lengths)) == 1 else max_lengths,
+            prompt_cache=groups[0].prompt_cache if len(groups) == 1 else None,
+            validators=validators, logits_processors=logits_processors, stats=stats,
+            step_callback=_step_callback if any(streamer is not None for streamer in streamers) else None,
+            draft_model=draft_model, num_draft_tokens=num_draft_tokens,
+            max_batch_size=max_batch_size,
+            deadline=deadlines[0] if len(set(deadlines)) == 1 else deadlines,
+            adapter_ids=adapter_ids if any(group.adapter_id is not None for group in groups) else None,
+            context_length=context_length, window_shift=window_shift,
+            sink_token_ids=list(set(group.tokenizer.convert_tokens_to_ids(translate_token) for group in groups))
+        )
+
+        if stats is not None:
+            stats.iterations += 1
+
+        for g, group in enumerate(groups):
+            requests, owners, (start, stop) = group.requests, batch_owners[g], row_ranges[g]
+            if len(owners) == 0: continue
+
+            group_stats = group.stats if group.stats is not None else stats
+            if group_stats is not None:
+                group_stats.sequences_sampled += len(owners)
+
+            valid_rows = [row for row in range(len(owners)) if is_valid[start + row]]
+            split_groups = dict(zip(valid_rows, _split_records(
+                output, [start + row for row in valid_rows], group.tokenizer, group.decode_format,
+                decode_strict_regexes[g], special_token_ids[g],
+                [requests[owners[row]].use_link_filter for row in valid_rows]
+            )))
+
+            evaluated_counts = {i: 0 for i in pending[g]}
+            accepted_counts = {i: 0 for i in pending[g]}
+            accepted_rows = set()
+            for row, i in enumerate(owners):
+                request = requests[i]
+                if len(results[g][i]) >= request.samples: continue
+
+                evaluated_counts[i] += 1
+                if not is_valid[start + row]: continue
+
+                record_groups = split_groups[row]
+                if record_groups is None: continue
+                if request.no_duplicates or group.dedup_index is not None:
+                    groups_hash = content_hash(record_groups)
+                    if groups_hash in visited[g][i]: continue
+                    if group.dedup_index is not None and (
+                        groups_hash in accepted_hashes[g] or groups_hash in group.dedup_index
+                    ): continue
+
+                    if request.no_duplicates:
+                        visited[g][i].add(groups_hash)
+
+                    accepted_hashes[g].add(groups_hash)
+
+                results[g][i].append(RawRecord(
+                    record_groups, token_ids=output[start + row, :].tolist(), tokenizer=group.tokenizer
+                ))
+
+                accepted_rows.add(row)
+                accepted_counts[i] += 1
+                if group_stats is not None:
+                    group_stats.sequences_accepted += 1
+
+            if streamers[g] is not None:
+                # Aborted rows have already been rejected while decoding.
+                streamers[g].finish(sorted(accepted_rows), [
+                    row for row in range(len(owners))
+                    if is_valid[start + row] and row not in accepted_rows
+                ])
+
+            if acceptance_tracker is not None:
+                for i in pending[g]:
+                    acceptance_tracker.update(acceptance_keys[g][i], evaluated_counts[i], accepted_counts[i])
+
+    return results
+
 def generate(model, tokenizer, decode_format, prompt=None, samples=1, top_k=300,
              top_p=1, num_return_sequences=10, max_iterations=10, min_length=250,
              max_length=1024, translate_token='<|eq_tok|>', end_of_likes_token='<|eol|>',
              fp16=False, fp16_opt_level='O1', no_duplicates=False, use_link_filter=True,
-             decode_strict_regex_mapping=None):
+             decode_strict_regex_mapping=None, prompt_cache=None,
+             use_streaming_validation=True, use_constrained_decoding=True, stats=None,
+             stream_callback=None, draft_model=None, num_draft_tokens=4, max_batch_size=None,
+             deadline=None, window_shift=256):
     '''
     Generate text from a model with a language modelling head.
 
     :param model:
-        A :class:`transformers.PreTrainedModel` to use for inference.
+        A :class:`transformers.PreTrainedModel` (or :class:`ai_redditor_service.engines.InferenceEngine`)
+        to use for inference.
     :param tokenizer:
         A :class:`transformers.PreTrainedTokenizer` to use to encode
         input sequences to token and to decode output sequences to text.
@@ -235,18 +2072,28 @@ def generate(model, tokenizer, decode_format, prompt=None, samples=1, top_k=300,
         Maximum number of iterations. Defaults to 10.
         
         If -1, there is no maximum number of iterations; the function will wait until all
-        samples have been generated. This can potentially be very slow and thread-blocking.
+        samples have been generated. This can potentially be very slow and thread-blocking,
+        unless a ``deadline`` is given.
     :param min_length:
         Minimum number of tokens to generate in a single iteration. Defaults to 250 tokens.
     :param max_length:
         Maximum number of tokens to generate in a single iteration. Defaults to 1024 tokens.
+
+        Sequences longer than the context of the model (``n_positions``, i.e. 1024 tokens
+        for GPT2) keep decoding past it with a sliding window of their key/value cache,
+        which keeps the prompt (up to the ``translate_token``) as an attention sink and
+        drops the oldest tokens that follow it. They are streamed and stop on the end
+        of sentence token like any other sequence, but are decoded one at a time (and
+        without the ``draft_model``) once they leave the context.
     :param translate_token:
         The query/answer separator token (translation separator token). Used for both 
         :var:`ModelDecodeFormat.QUERY_ANSWER` and :var:`ModelDecodeFormat.PHC` decoding.
     :param end_of_likes_token:
         The special token specifying the end of likes. Used for :var:`ModelDecodeFormat.PHC` decoding.
     :param fp16:
-        Use 16-bit (mixed) precision floats (note: requires NVIDIA Apex!). Defaults to False.
+        Use 16-bit (mixed) precision floats (note: requires NVIDIA Apex and a CUDA device!).
+        Defaults to False. On CPU devices, load the model with the ``bfloat16`` precision
+        instead (see :func:`load_model`).
     :param fp16_opt_level:
         Apex AMP optimization level. See https://nvidia.github.io/apex/amp.html. Defaults to O1.
     :param no_duplicates:
@@ -258,100 +2105,201 @@ def generate(model, tokenizer, decode_format, prompt=None, samples=1, top_k=300,
         Strict regex patterns for decoding model output mapped by decode format. If not specified
         or None, this mapping is computed using the :func:`ai_redditor_service.gpt2._get_decode_regex_mapping`
         function; otherwise, the provided mapping is used.
+    :param prompt_cache:
+        A :class:`ai_redditor_service.prompt_cache.PromptCache` used to reuse the encoded
+        state of prompts (and their prefixes) across generations. Defaults to None, meaning
+        that prompts are encoded from scratch on every iteration.
+    :param use_streaming_validation:
+        Validate sequences while they are being decoded, aborting them as soon as they
+        contain a link (if the link filter is used) or their special tokens deviate from
+        the order of the decode format. Defaults to True.
+    :param use_constrained_decoding:
+        Constrain sampling to the decode format (special token order, non-empty fields,
+        digit-only likes and no links for :var:`ModelDecodeFormat.PHC`), so that every
+        sampled sequence is structurally valid. Defaults to True.
+    :param stats:
+        A :class:`GenerationStats` object that is updated with counters describing
+        the work done. Defaults to None.
+    :param stream_callback:
+        A function called with the incremental text of every sampled sequence while
+        it is being generated, and with the outcome of each sequence once it is accepted
+        or rejected. See :class:`ai_redditor_service.streaming.TextStreamer` for a
+        description of the events. Defaults to None, meaning that nothing is streamed.
+    :param draft_model:
+        A smaller model sharing the tokenizer of the model (e.g. built with
+        :func:`ai_redditor_service.draft.build_draft_model`), used to sample with
+        speculative decoding: it proposes ``num_draft_tokens`` tokens that the model
+        verifies in a single forward pass, without changing the distribution of the
+        sampled sequences. Defaults to None, meaning no speculative decoding.
+    :param num_draft_tokens:
+        The number of tokens proposed by the draft model per step. Defaults to 4.
+    :param max_batch_size:
+        The maximum number of sequences decoded at once. Finished sequences leave the
+        decode batch after every step, and the remaining sequences take their slots.
+        Defaults to None, meaning that all the sequences of an iteration are decoded at once.
+    :param deadline:
+        The time (in seconds since the epoch, as returned by :func:`time.time`) at which
+        generation stops, returning the records generated so far (possibly fewer than
+        ``samples``). Defaults to None, meaning that there is no deadline.
+    :param window_shift:
+        The number of tokens dropped from the sliding window of a sequence longer than
+        the context of the model each time the window is full. Every shift re-encodes
+        the window in a single forward pass. Defaults to 256.
     :returns:
         A list of :class:`RawRecord` objects.
 
     '''
 
-    if fp16:
-        model = _init_fp16(model, opt_levl=fp16_opt_level)
+    return generate_batch(
+        model, tokenizer, decode_format, [
+            GenerationRequest(
+                prompt=prompt, samples=samples,
+                use_link_filter=use_link_filter,
+                no_duplicates=no_duplicates,
+                stream_callback=stream_callback,
+                deadline=deadline
+            )
+        ], top_k=top_k, top_p=top_p,
+        num_return_sequences=num_return_sequences,
+        max_iterations=max_iterations,
+        min_length=min_length, max_length=max_length,
+        translate_token=translate_token,
+        end_of_likes_token=end_of_likes_token,
+        fp16=fp16, fp16_opt_level=fp16_opt_level,
+        decode_strict_regex_mapping=decode_strict_regex_mapping,
+        prompt_cache=prompt_cache,
+        use_streaming_validation=use_streaming_validation,
+        use_constrained_decoding=use_constrained_decoding,
+        stats=stats, draft_model=draft_model,
+        num_draft_tokens=num_draft_tokens,
+        max_batch_size=max_batch_size,
+        window_shift=window_shift
+    )[0]
 
-    provided_special_tokens = {
-        'translate': translate_token,
-    }
+@torch.no_grad()
+def complete_fields(model, tokenizer, decode_format, prompt, stop_token, num_sequences=1, max_new_tokens=32,
+                    top_k=300, top_p=1, translate_token='<|eq_tok|>', end_of_likes_token='<|eol|>',
+                    prompt_cache=None, use_constrained_decoding=True, stats=None, deadline=None):
+    '''
+    Samples the fields that follow a prompt, up to (and excluding) a special token of the
+    decode format, rather than a whole record. For example, the likes and author of a PHC
+    record are completed by decoding from the BOS token up to the translate token.
 
-    if decode_format == ModelDecodeFormat.PHC:
-        provided_special_tokens['end_of_likes'] = end_of_likes_token
+    :param decode_format:
+        A :class:`ModelDecodeFormat` representing the format of the model output.
+    :param prompt:
+        The prompt, starting with the BOS token.
+    :param stop_token:
+        The special token of the decode format that follows the last field to complete.
+    :param num_sequences:
+        The number of sequences to sample. Defaults to 1.
+    :param max_new_tokens:
+        The maximum number of tokens to sample per sequence. Defaults to 32. With constrained
+        decoding, the special tokens of the format are forced in time to reach the ``stop_token``.
+    :returns:
+        A list of the completions (the text between the prompt and the ``stop_token``,
+        including the special tokens between the fields) of the sequences that reached
+        the ``stop_token`` by the ``deadline``.
 
-    if decode_strict_regex_mapping is None:
-        # Strict regex patterns (i.e. matching groups cannot be empty) for splitting
-        # the model output into groups of data based on the decode format.
-        decode_strict_regex_mapping = _get_decode_regex_mapping(
-            True, tokenizer.bos_token, tokenizer.eos_token,
-            translate_token, end_of_likes_token
-        )
+    See :func:`generate` for a description of the other parameters.
+
+    '''
+
+    special_token_ids = tokenizer.convert_tokens_to_ids(_get_decode_special_tokens_mapping(
+        tokenizer.bos_token, tokenizer.eos_token, translate_token, end_of_likes_token
+    )[decode_format])
 
-    _verify_special_tokens(tokenizer,  **provided_special_tokens)   
-    if decode_format not in decode_strict_regex_mapping:
-        ValueError('{} is invalid. Must be one of: {}.'.format(
-            decode_format, list(decode_strict_regex_mapping.keys())
+    stop_token_id = tokenizer.convert_tokens_to_ids(stop_token)
+    if stop_token_id not in special_token_ids[1:]:
+        raise ValueError('The stop token (\'{}\') must be a special token of the {} decode format.'.format(
+            stop_token, ModelDecodeFormat(decode_format).name
         ))
-    
-    # If no prompt is specified, the default is the BOS token.
-    prompt = prompt or tokenizer.bos_token
-    # Encode the prompt using the tokenizer
-    prompt_ids = tokenizer.encode(prompt, return_tensors='pt').to(model.device)
 
-    results = []
-    visited = set()
-    current_iteration = 0
-    
-    while len(results) < samples:
-        if max_iterations != -1 and current_iteration > max_iterations: break
+    prompt_ids = tokenizer.encode(prompt, return_tensors='pt')[0].to(model.device)
+    max_length = prompt_ids.size(0) + max_new_tokens
 
-        current_iteration += 1
-        remaining_samples = samples - len(results)
-        # Multiply by some 'arbitrary' scale factor to pad the next attempt in case there are
-        # any failed attempts. We use 1.5 as an approximation under the assumption that 50% of
-        # the samples in iteration are failed (this is an overestimation for safety).
-        num_return_sequences = min(int(remaining_samples * 1.5), num_return_sequences)
-        output = model.generate(
-            prompt_ids,
-            bos_token_id=tokenizer.bos_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.pad_token_id,
-            top_k=top_k, top_p=top_p,
-            num_return_sequences=num_return_sequences,
-            min_length=min_length, max_length=max_length,
-            do_sample=True
+    logits_processors = []
+    if use_constrained_decoding:
+        field_token_ids = {}
+        if decode_format == ModelDecodeFormat.PHC:
+            # The likes field (following the BOS token) only consists of digits.
+            field_token_ids[0] = get_digit_token_ids(tokenizer)
+
+        logits_processors.append(DecodeFormatProcessor(
+            special_token_ids, max_length, field_token_ids=field_token_ids,
+            banned_token_ids=[
+                token_id for token_id in tokenizer.all_special_ids
+                if token_id not in special_token_ids
+            ]
+        ))
+
+    # The stop token ends each sequence in place of the end of sentence token.
+    output, is_valid = _sample(
+        model, [prompt_ids] * num_sequences, stop_token_id, tokenizer.pad_token_id,
+        top_k=top_k, top_p=top_p, min_length=0, max_length=max_length,
+        prompt_cache=prompt_cache, logits_processors=logits_processors,
+        stats=stats, deadline=deadline
+    )
+
+    if stats is not None:
+        stats.sequences_sampled += num_sequences
+
+    completions = []
+    for row in is_valid.nonzero().view(-1).tolist():
+        token_ids = output[row, prompt_ids.size(0):].tolist()
+        if stop_token_id not in token_ids: continue
+        completions.append(tokenizer.decode(token_ids[:token_ids.index(stop_token_id)]))
+
+    return completions
+
+def score(model, tokenizer, texts, batch_size=8):
+    '''
+    Computes the log-likelihood of texts under a model.
+
+    :param model:
+        The :class:`transformers.PreTrainedModel` to score the texts with.
+    :param tokenizer:
+        The :class:`transformers.PreTrainedTokenizer` of the model.
+    :param texts:
+        A list of the texts to score, including their special tokens.
+    :param batch_size:
+        The maximum number of texts per forward pass. Defaults to 8.
+    :returns:
+        A list of dictionaries containing the log-likelihood of each text (i.e. the
+        sum of the log-probabilities of its tokens, given the preceding tokens) and
+        the number of tokens that were scored (all but the first).
+
+    '''
+
+    device = model.device
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    scores = []
+    for i in range(0, len(texts), batch_size):
+        token_ids = [tokenizer.encode(text, add_special_tokens=False) for text in texts[i:i + batch_size]]
+        # Texts without tokens are all padding, so they score 0.
+        max_length = max(max(len(x) for x in token_ids), 1)
+        input_ids = torch.tensor(
+            [x + [pad_token_id] * (max_length - len(x)) for x in token_ids],
+            dtype=torch.long, device=device
+        )
+
+        attention_mask = torch.tensor(
+            [[1] * len(x) + [0] * (max_length - len(x)) for x in token_ids],
+            dtype=torch.long, device=device
         )
 
-        for i in range(output.size()[0]):
-            if len(results) >= samples: break
-
-            raw_text = tokenizer.decode(output[i, :].tolist())
-            if decode_format == ModelDecodeFormat.PHC and use_link_filter:
-                # Filter out for pornhub links contained in the comment.
-                # Comments that contain links are often not very interesting (just advertisement).
-                urls = PHC_LINK_PATTERN.findall(raw_text)
-                if len(urls) > 0: continue
-            
-            match = decode_strict_regex_mapping[decode_format].match(raw_text)
-            # Check if the decode regex matched the decoded string
-            if not match: continue
-
-            if decode_format == ModelDecodeFormat.QUERY_ANSWER:
-                groups = {
-                    'prompt': match.group('prompt'),
-                    'response': match.group('response')
-                }
-            elif decode_format == ModelDecodeFormat.PHC:
-                groups = {
-                    'likes': match.group('likes'),
-                    'author': match.group('author'),
-                    'comment_body': match.group('comment_body'),
-                }
-
-            # Check if generated sequence has missing matching groups
-            if any(value is None for value in groups.values()): continue
-            # Strip all match groups of trailing whitespace
-            groups = {key: value.strip() for key, value in groups.items()}
-            if no_duplicates:
-                # Convert the groups dict to JSON and use it as a unique identifier
-                groups_id = json.dumps(groups, sort_keys=True)
-                if groups_id in visited: continue
-                visited.add(groups_id)
-
-            results.append(RawRecord(groups, raw_text))
-
-    return results
\ No newline at end of file
+        with torch.no_grad():
+            logits = model(input_ids, attention_mask=attention_mask)[0]
+
+        log_probs = torch.log_softmax(logits[:, :-1].float(), dim=-1).gather(
+            -1, input_ids[:, 1:].unsqueeze(-1)
+        ).squeeze(-1) * attention_mask[:, 1:]
+
+        for j, x in enumerate(token_ids):
+            scores.append({
+                'log_likelihood': log_probs[j].sum().item(),
+                'num_tokens': max(len(x) - 1, 0)
+            })
+
+    return scores
@@ -0,0 +1,170 @@
+'''
+Client of the inference server (see :mod:`ai_redditor_service.inference_server`).
+
+This module does not import torch or transformers.
+
+'''
+
+import json
+import requests
+
+class InferenceServerError(Exception):
+    '''
+    Raised when the inference server fails to handle a request.
+
+    '''
+
+    pass
+
+class GeneratedRecord:
+    '''
+    A record generated by the inference server.
+
+    '''
+
+    def __init__(self, groups):
+        '''
+        Initializes an instance of :class:`GeneratedRecord`.
+
+        :param groups:
+            A dictionary mapping the name of each group to its text.
+
+        '''
+
+        self.groups = groups
+
+class InferenceClient:
+    '''
+    Sends generate and score requests to an inference server over HTTP.
+
+    '''
+
+    def __init__(self, url, timeout=300):
+        '''
+        Initializes an instance of :class:`InferenceClient`.
+
+        :param url:
+            The base URL of the inference server (e.g. ``http://127.0.0.1:5100``).
+        :param timeout:
+            The timeout of each request, in seconds. Defaults to 300.
+
+        '''
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def _request(self, method, path, data=None, stream=False):
+        try:
+            response = self._session.request(
+                method, self.url + path, json=data,
+                timeout=self.timeout, stream=stream
+            )
+        except requests.RequestException as exception:
+            raise InferenceServerError('Could not reach the inference server: {}'.format(exception))
+
+        if response.status_code != 200:
+            try:
+                message = response.json()['error']
+            except (ValueError, KeyError):
+                message = response.text
+
+            raise InferenceServerError('The inference server failed ({}): {}'.format(response.status_code, message))
+
+        return response
+
+    def generate(self, record_type, prompt, samples=1, use_link_filter=True, no_duplicates=False,
+                 is_custom=None, stream_callback=None, **kwargs):
+        '''
+        Generates records from the model of the specified record type.
+
+        :param stream_callback:
+            A function called with the stream events of the generation (see
+            :class:`ai_redditor_service.streaming.TextStreamer`). Defaults to None,
+            meaning that nothing is streamed.
+        :param kwargs:
+            Other keyword arguments passed to :func:`ai_redditor_service.gpt2.generate_batch`.
+        :returns:
+            A list of :class:`GeneratedRecord` objects.
+
+        '''
+
+        data = {
+            'record_type': int(record_type),
+            'prompt': prompt,
+            'samples': samples,
+            'use_link_filter': use_link_filter,
+            'no_duplicates': no_duplicates,
+            'is_custom': is_custom,
+            'stream': stream_callback is not None,
+            'kwargs': kwargs
+        }
+
+        response = self._request('POST', '/generate', data, stream=stream_callback is not None)
+        if stream_callback is None:
+            result = response.json()
+        else:
+            # The response is a line of JSON per stream event, followed by the result.
+            result = None
+            for line in response.iter_lines():
+                if not line: continue
+
+                message = json.loads(line.decode('utf-8'))
+                if 'event' in message:
+                    event = message['event']
+                    # JSON object keys are strings; sequence numbers are integers.
+                    event['chunks'] = {int(key): value for key, value in event['chunks'].items()}
+                    stream_callback(event)
+                else:
+                    result = message
+
+            if result is None:
+                raise InferenceServerError('The inference server closed the stream without a result.')
+
+        if 'error' in result:
+            raise InferenceServerError('The inference server failed: {}'.format(result['error']))
+
+        return [GeneratedRecord(record['groups']) for record in result['records']]
+
+    def complete_fields(self, record_type, prompt, stop_token, **kwargs):
+        '''
+        Samples the fields that follow a prompt, up to a special token, with the
+        model of the specified record type.
+
+        :param kwargs:
+            Other keyword arguments of the completion (e.g. the ``deadline``).
+        :returns:
+            A list of completions (see :func:`ai_redditor_service.gpt2.complete_fields`).
+
+        '''
+
+        return self._request('POST', '/complete', {
+            'record_type': int(record_type),
+            'prompt': prompt,
+            'stop_token': stop_token,
+            'kwargs': kwargs
+        }).json()['completions']
+
+    def score(self, record_type, texts):
+        '''
+        Computes the log-likelihood of texts under the model of the specified record type.
+
+        :returns:
+            A list of dictionaries containing the ``log_likelihood`` and ``num_tokens``
+            of each text (see :func:`ai_redditor_service.gpt2.score`).
+
+        '''
+
+        return self._request('POST', '/score', {'record_type': int(record_type), 'texts': texts}).json()['scores']
+
+    def info(self, record_type):
+        '''
+        Gets the special tokens of the model of the specified record type.
+
+        :returns:
+            A dictionary containing the ``bos_token``, ``eos_token`` and
+            ``all_special_tokens`` of the tokenizer of the model.
+
+        '''
+
+        return self._request('GET', '/info/{}'.format(int(record_type))).json()
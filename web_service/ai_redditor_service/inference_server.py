@@ -0,0 +1,400 @@
+'''
+A standalone inference server that owns the GPT2 models and serves generate
+and score requests over HTTP, so that model memory and batching scale
+independently of the number of Celery workers.
+
+Concurrent generate requests for the same model are coalesced into batches
+(see :class:`ai_redditor_service.batching.BatchScheduler`), whether or not
+``GPT2_BATCHING_ENABLED`` is set. Run the server with::
+
+    python -m ai_redditor_service.inference_server [--host HOST] [--port PORT] [--stub]
+
+and set ``GPT2_INFERENCE_SERVER_URL`` so that the record generation tasks
+use it through :class:`ai_redditor_service.inference_client.InferenceClient`.
+
+Endpoints:
+
+- ``POST /generate``: generates records. The request is a JSON object with the
+  ``record_type``, ``prompt``, ``samples``, ``use_link_filter``, ``no_duplicates``,
+  ``is_custom`` and ``kwargs`` (other generation arguments) of the generation.
+  The response is a JSON object with the generated ``records``; if ``stream`` is
+  true, it is preceded by a line of JSON per stream event.
+- ``POST /complete``: samples the fields that follow the ``prompt`` of a request,
+  up to its ``stop_token`` (see :func:`ai_redditor_service.gpt2.complete_fields`),
+  with the ``kwargs`` (e.g. the ``deadline``) of the completion.
+- ``POST /score``: computes the log-likelihood of the ``texts`` of a request
+  under the model of its ``record_type``.
+- ``GET /info/<record_type>``: gets the special tokens of a model.
+- ``GET /health`` and ``GET /stats``: get the status of the server.
+
+'''
+
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from ai_redditor_service import create_app
+from ai_redditor_service.extensions import db
+from ai_redditor_service.models import RecordType
+from ai_redditor_service.shared import ModelDecodeFormat, _RECORD_GENERATE_CONFIGS
+
+logger = logging.getLogger(__name__)
+
+class ModelBackend:
+    '''
+    Serves requests with the models of the record generation task.
+
+    '''
+
+    def __init__(self, app):
+        '''
+        Initializes an instance of :class:`ModelBackend`.
+
+        :param app:
+            The Flask app.
+
+        '''
+
+        # Imported here so that the stub backend does not import torch.
+        from ai_redditor_service import tasks
+
+        self.app = app
+        self.tasks = tasks
+        # This process is the inference server, so the task has to generate locally, and
+        # the requests of the handler threads are coalesced into batches.
+        app.config['GPT2_INFERENCE_SERVER_URL'] = None
+        app.config['GPT2_BATCHING_ENABLED'] = True
+
+    @property
+    def _task(self):
+        return self.tasks.generate_record
+
+    def warmup(self):
+        '''
+        Loads the models and runs dummy forward passes through them.
+
+        '''
+
+        from ai_redditor_service.gpt2 import warmup_model
+
+        start_time = time.time()
+        batch_size = self.app.config.get('GPT2_WARMUP_BATCH_SIZE', 4)
+        with self.app.app_context():
+            for record_type in RecordType:
+                model, tokenizer = self._task.models[record_type]
+                warmup_model(model, tokenizer, batch_size=batch_size)
+
+        logger.info('Warmed up GPT2 models ({} seconds)'.format(round(time.time() - start_time, 2)))
+
+    def info(self, record_type):
+        with self.app.app_context():
+            tokenizer = self._task.tokenizers[record_type]
+
+        return {
+            'bos_token': tokenizer.bos_token,
+            'eos_token': tokenizer.eos_token,
+            'all_special_tokens': list(tokenizer.all_special_tokens)
+        }
+
+    def generate(self, record_type, prompt, stream_callback=None, **kwargs):
+        with self.app.app_context():
+            try:
+                outputs = self.tasks._generate(record_type, prompt, stream_callback=stream_callback, **kwargs)
+            finally:
+                db.session.remove()
+
+        return [output.groups for output in outputs]
+
+    def complete_fields(self, record_type, prompt, stop_token, deadline=None):
+        with self.app.app_context():
+            return self.tasks._complete_fields(record_type, prompt, stop_token, deadline=deadline)
+
+    def score(self, record_type, texts):
+        from ai_redditor_service.gpt2 import score
+
+        with self.app.app_context():
+            model, tokenizer = self._task.models[record_type]
+            return score(model, tokenizer, texts)
+
+    def stats(self):
+        return {
+            'models': self._task.models.stats(),
+            'generation': {
+                record_type.name: str(self._task.generation_stats[record_type])
+                for record_type in RecordType
+            },
+            'mixed_generation': str(self._task.mixed_generation_stats)
+        }
+
+class StubBackend:
+    '''
+    Serves canned records without loading any model (e.g. for tests and development).
+
+    The fields of a generated record are the ones in its prompt, if any, or
+    placeholder text otherwise.
+
+    '''
+
+    def __init__(self, app):
+        '''
+        Initializes an instance of :class:`StubBackend`.
+
+        :param app:
+            The Flask app.
+
+        '''
+
+        self.bos_token = app.config.get('GPT2_BOS_TOKEN', '<|bos|>')
+        self.eos_token = '<|eos|>'
+        self.translate_token = app.config.get('GPT2_TRANSLATE_TOKEN', '<|eq_tok|>')
+        self.end_of_likes_token = app.config.get('GPT2_END_OF_LIKES_TOKEN', '<|eol|>')
+        self.requests = 0
+
+    def warmup(self):
+        pass
+
+    def info(self, record_type):
+        return {
+            'bos_token': self.bos_token,
+            'eos_token': self.eos_token,
+            'all_special_tokens': [self.bos_token, self.eos_token, self.translate_token, self.end_of_likes_token]
+        }
+
+    def _get_groups(self, record_type, prompt):
+        prompt = prompt or ''
+        if prompt.startswith(self.bos_token):
+            prompt = prompt[len(self.bos_token):]
+
+        head, _, body = prompt.partition(self.translate_token)
+        if _RECORD_GENERATE_CONFIGS[record_type].decode_format == ModelDecodeFormat.PHC:
+            likes, _, author = head.partition(self.end_of_likes_token)
+            return {
+                'likes': likes or '0',
+                'author': author or 'stub_author',
+                'comment_body': body + ' This is a stub comment.'
+            }
+
+        return {
+            'prompt': head or 'This is a stub prompt.',
+            'response': body + ' This is a stub response.'
+        }
+
+    def generate(self, record_type, prompt, samples=1, stream_callback=None, **kwargs):
+        self.requests += 1
+        records = [self._get_groups(record_type, prompt) for _ in range(samples)]
+        if stream_callback is not None:
+            for i, groups in enumerate(records):
+                text = ' '.join(groups.values())
+                stream_callback({'chunks': {i: text}, 'tokens': len(text.split()), 'rejected': [], 'accepted': [i]})
+
+        return records
+
+    def complete_fields(self, record_type, prompt, stop_token, deadline=None):
+        self.requests += 1
+        completion = '' if self.end_of_likes_token in prompt else '0'
+        if stop_token == self.translate_token:
+            completion += (self.end_of_likes_token if len(completion) > 0 else '') + 'stub_author'
+
+        return [completion]
+
+    def score(self, record_type, texts):
+        return [{'log_likelihood': 0.0, 'num_tokens': 0} for _ in texts]
+
+    def stats(self):
+        return {'requests': self.requests}
+
+class InferenceServer(ThreadingHTTPServer):
+    '''
+    An HTTP server handling each request in its own thread.
+
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, backend):
+        '''
+        Initializes an instance of :class:`InferenceServer`.
+
+        :param address:
+            A tuple containing the host and port to listen on.
+        :param backend:
+            The backend serving the requests (a :class:`ModelBackend` or :class:`StubBackend`).
+
+        '''
+
+        super().__init__(address, _RequestHandler)
+        self.backend = backend
+
+_INFO_PATH_PATTERN = re.compile(r'^/info/(?P<record_type>\d+)$')
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between the requests of a client, and allow chunked responses.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        data = json.dumps(data).encode('utf-8') + b'\n'
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _get_record_type(self, value):
+        try:
+            return RecordType(int(value))
+        except ValueError:
+            raise ValueError('Invalid record type: {}'.format(value))
+
+    def do_GET(self):
+        backend = self.server.backend
+        if self.path == '/health':
+            self._send_json({'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(backend.stats())
+        elif _INFO_PATH_PATTERN.match(self.path):
+            try:
+                record_type = self._get_record_type(_INFO_PATH_PATTERN.match(self.path).group('record_type'))
+            except ValueError as exception:
+                self._send_json({'error': str(exception)}, status=400)
+                return
+
+            self._send_json(backend.info(record_type))
+        else:
+            self._send_json({'error': 'Not found'}, status=404)
+
+    def do_POST(self):
+        try:
+            data = self._read_json()
+            record_type = self._get_record_type(data.get('record_type'))
+        except ValueError as exception:
+            self._send_json({'error': str(exception)}, status=400)
+            return
+
+        if self.path == '/generate':
+            self._generate(record_type, data)
+        elif self.path == '/complete':
+            try:
+                completions = self.server.backend.complete_fields(
+                    record_type, data.get('prompt', None), data.get('stop_token', None),
+                    **data.get('kwargs', {})
+                )
+            except Exception as exception:
+                logger.exception('Could not complete fields')
+                self._send_json({'error': str(exception)}, status=500)
+                return
+
+            self._send_json({'completions': completions})
+        elif self.path == '/score':
+            try:
+                scores = self.server.backend.score(record_type, data.get('texts', []))
+            except Exception as exception:
+                logger.exception('Could not score texts')
+                self._send_json({'error': str(exception)}, status=500)
+                return
+
+            self._send_json({'scores': scores})
+        else:
+            self._send_json({'error': 'Not found'}, status=404)
+
+    def _generate(self, record_type, data):
+        kwargs = dict(
+            samples=data.get('samples', 1),
+            use_link_filter=data.get('use_link_filter', True),
+            no_duplicates=data.get('no_duplicates', False),
+            is_custom=data.get('is_custom', None),
+            **data.get('kwargs', {})
+        )
+
+        if not data.get('stream', False):
+            try:
+                records = self.server.backend.generate(record_type, data.get('prompt', None), **kwargs)
+            except Exception as exception:
+                logger.exception('Could not generate records')
+                self._send_json({'error': str(exception)}, status=500)
+                return
+
+            self._send_json({'records': [{'groups': groups} for groups in records]})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        # Stream events may be written from the thread of another request in the
+        # same batch; a disconnected client must not fail the rest of the batch.
+        lock = threading.Lock()
+        is_connected = [True]
+        def _stream_callback(event):
+            with lock:
+                if not is_connected[0]: return
+                try:
+                    self._write_chunk({'event': event})
+                except OSError:
+                    is_connected[0] = False
+
+        try:
+            records = self.server.backend.generate(
+                record_type, data.get('prompt', None),
+                stream_callback=_stream_callback, **kwargs
+            )
+
+            result = {'records': [{'groups': groups} for groups in records]}
+        except Exception as exception:
+            logger.exception('Could not generate records')
+            result = {'error': str(exception)}
+
+        with lock:
+            if not is_connected[0]: return
+            try:
+                self._write_chunk(result)
+                self.wfile.write(b'0\r\n\r\n')
+            except OSError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the inference server.')
+    parser.add_argument('--host', type=str, default=None,
+                        help='The host to listen on. Defaults to GPT2_INFERENCE_SERVER_HOST.')
+    parser.add_argument('--port', type=int, default=None,
+                        help='The port to listen on. Defaults to GPT2_INFERENCE_SERVER_PORT.')
+    parser.add_argument('--stub', action='store_true', help='Serve canned records without loading any model.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s: %(levelname)s/%(name)s] %(message)s')
+
+    app = create_app()
+    host = args.host or app.config.get('GPT2_INFERENCE_SERVER_HOST', '127.0.0.1')
+    port = args.port or app.config.get('GPT2_INFERENCE_SERVER_PORT', 5100)
+
+    backend = StubBackend(app) if args.stub else ModelBackend(app)
+    if app.config.get('GPT2_WARMUP_ENABLED', True):
+        backend.warmup()
+
+    server = InferenceServer((host, port), backend)
+    logger.info('Inference server listening on {}:{}{}'.format(host, port, ' (stub)' if args.stub else ''))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+'''
+Logits processors that constrain sampling to the decode format, so that
+every sampled sequence is a structurally valid record.
+
+'''
+
+import re
+import torch
+import functools
+from ai_redditor_service.validators import SequenceValidator
+
+@functools.lru_cache(maxsize=None)
+def get_token_texts(tokenizer):
+    '''
+    Gets the decoded text of every token in the vocabulary of a tokenizer.
+
+    :returns:
+        A list of strings, indexed by token id.
+
+    '''
+
+    return [tokenizer.decode([token_id]) for token_id in range(len(tokenizer))]
+
+@functools.lru_cache(maxsize=None)
+def get_digit_token_ids(tokenizer):
+    '''
+    Gets the ids of all the tokens whose text consists only of digits.
+
+    '''
+
+    return [
+        token_id for token_id, text in enumerate(get_token_texts(tokenizer))
+        if re.fullmatch('[0-9]+', text) is not None
+    ]
+
+class LogitsProcessor(SequenceValidator):
+    '''
+    The base class for all logits processors.
+
+    A logits processor is a :class:`ai_redditor_service.validators.SequenceValidator`
+    that, in addition to tracking the tokens sampled for each row, modifies the
+    scores of the next token before sampling.
+
+    '''
+
+    def process(self, rows, scores):
+        '''
+        Modifies the next token scores of the specified rows.
+
+        :param rows:
+            A 1-dimensional tensor of row indices.
+        :param scores:
+            A tensor of shape (len(rows), vocab_size) containing the next token scores.
+        :returns:
+            The modified scores.
+
+        '''
+
+        raise NotImplementedError()
+
+    def step(self, rows, next_tokens):
+        return torch.ones(len(rows), dtype=torch.bool)
+
+class DecodeFormatProcessor(LogitsProcessor):
+    '''
+    Constrains sampling to the special token order of a decode format.
+
+    Only the next special token of the format can be sampled, and only once the
+    current field is non-empty; all other special tokens are banned. The tokens of
+    a field can be restricted to a subset of the vocabulary (e.g. digits for likes),
+    and as a row approaches the maximum length, the remaining special tokens are
+    forced so that the sequence is closed by the end of sentence token in time.
+
+    '''
+
+    def __init__(self, special_token_ids, max_length, banned_token_ids=None, field_token_ids=None):
+        '''
+        Initializes an instance of :class:`DecodeFormatProcessor`.
+
+        :param special_token_ids:
+            The ids of the special tokens, in order of appearance in the decode format.
+            The last one should be the end of sentence token.
+        :param max_length:
+            The maximum length of a row, including the prompt.
+        :param banned_token_ids:
+            The ids of other tokens that can never be sampled (e.g. the padding token).
+        :param field_token_ids:
+            A dictionary mapping the index of a field to the ids of the only tokens that
+            can be sampled in it. The field with index ``i`` is the one following the
+            ``i``-th special token.
+
+        '''
+
+        self.special_token_ids = list(special_token_ids)
+        self.max_length = max_length
+        self.banned_token_ids = list(banned_token_ids or [])
+        self.field_token_ids = field_token_ids or {}
+
+        self.positions = {token_id: i for i, token_id in enumerate(self.special_token_ids)}
+        self._field_masks = {}
+        self._state = []
+
+    def _field_mask(self, field, vocab_size, device):
+        if field not in self._field_masks:
+            mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
+            mask[self.field_token_ids[field]] = False
+            self._field_masks[field] = mask
+
+        return self._field_masks[field]
+
+    def start(self, prompt_ids):
+        self._state = []
+        for ids in prompt_ids:
+            position, field_length = -1, 0
+            for token_id in ids.tolist():
+                if token_id in self.positions:
+                    position, field_length = self.positions[token_id], 0
+                else:
+                    field_length += 1
+
+            self._state.append([position, field_length, ids.size(0)])
+
+    def process(self, rows, scores):
+        vocab_size = scores.size(-1)
+        for i, row in enumerate(rows.tolist()):
+            position, field_length, length = self._state[row]
+            # The row is complete (it has already sampled the end of sentence token).
+            if position + 1 >= len(self.special_token_ids): continue
+
+            next_special_token_id = self.special_token_ids[position + 1]
+            row_scores = scores[i]
+            next_special_token_score = row_scores[next_special_token_id].item()
+            if position in self.field_token_ids:
+                row_scores.masked_fill_(self._field_mask(position, vocab_size, scores.device), -float('inf'))
+
+            row_scores[self.banned_token_ids] = -float('inf')
+            row_scores[self.special_token_ids] = -float('inf')
+
+            # Fields cannot be empty.
+            if field_length == 0: continue
+
+            # Each remaining special token takes one token, and so does each of the
+            # (non-empty) fields between them. Once the rest of the budget is needed to
+            # close the format, the next special token is forced.
+            remaining_special_tokens = len(self.special_token_ids) - position - 1
+            if self.max_length - length <= 2 * remaining_special_tokens - 1:
+                row_scores.fill_(-float('inf'))
+                row_scores[next_special_token_id] = 0
+            else:
+                row_scores[next_special_token_id] = next_special_token_score
+
+        return scores
+
+    def step(self, rows, next_tokens):
+        for row, token_id in zip(rows, next_tokens):
+            state = self._state[row]
+            if token_id in self.positions:
+                state[0], state[1] = self.positions[token_id], 0
+            else:
+                state[1] += 1
+
+            state[2] += 1
+
+        return super().step(rows, next_tokens)
+
+class BannedSubstringTable:
+    '''
+    A precomputed automaton for banning a substring of the decoded text, built
+    over the vocabulary of a tokenizer.
+
+    The state of a row is the length of the longest prefix of the substring that
+    its decoded text ends with. For every state and token, the table stores the
+    next state and whether the token would complete the substring.
+
+    '''
+
+    def __init__(self, tokenizer, substring):
+        '''
+        Initializes an instance of :class:`BannedSubstringTable`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` whose vocabulary is used.
+        :param substring:
+            The substring to ban.
+
+        '''
+
+        self.substring = substring
+
+        # The failure function of the substring (Knuth-Morris-Pratt)
+        self._failure = [0] * len(substring)
+        k = 0
+        for i in range(1, len(substring)):
+            while k > 0 and substring[i] != substring[k]:
+                k = self._failure[k - 1]
+
+            if substring[i] == substring[k]:
+                k += 1
+
+            self._failure[i] = k
+
+        token_texts = get_token_texts(tokenizer)
+        num_states = len(substring)
+        self.next_states = torch.zeros((num_states, len(token_texts)), dtype=torch.long)
+        self.completes = torch.zeros((num_states, len(token_texts)), dtype=torch.bool)
+
+        characters = set(substring)
+        for token_id, text in enumerate(token_texts):
+            # Tokens without any character of the substring always reset the state.
+            if characters.isdisjoint(text): continue
+            for state in range(num_states):
+                next_state, completes = self._advance_text(state, text)
+                self.next_states[state, token_id] = next_state
+                self.completes[state, token_id] = completes
+
+    def _advance_text(self, state, text):
+        for char in text:
+            while state > 0 and char != self.substring[state]:
+                state = self._failure[state - 1]
+
+            if char == self.substring[state]:
+                state += 1
+
+            if state == len(self.substring):
+                return 0, True
+
+        return state, False
+
+    def initial_state(self, text):
+        '''
+        Gets the state after the specified text.
+
+        '''
+
+        state, _ = self._advance_text(0, text)
+        return state
+
+@functools.lru_cache(maxsize=None)
+def get_banned_substring_table(tokenizer, substring):
+    '''
+    Gets the (cached) :class:`BannedSubstringTable` of a substring for a tokenizer.
+
+    '''
+
+    return BannedSubstringTable(tokenizer, substring)
+
+class BannedSubstringProcessor(LogitsProcessor):
+    '''
+    Bans the tokens that would make the decoded text of a row contain a substring,
+    even when the substring is spread over several tokens.
+
+    '''
+
+    def __init__(self, tokenizer, table, rows=None):
+        '''
+        Initializes an instance of :class:`BannedSubstringProcessor`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` used to decode the prompts.
+        :param table:
+            The :class:`BannedSubstringTable` of the substring to ban.
+        :param rows:
+            A collection of the row indices to constrain. Defaults to None, meaning
+            that all rows are constrained.
+
+        '''
+
+        self.tokenizer = tokenizer
+        self.table = table
+        self.rows = set(rows) if rows is not None else None
+        self._states = None
+
+    def start(self, prompt_ids):
+        self._states = torch.tensor([
+            self.table.initial_state(self.tokenizer.decode(ids.tolist()))
+            for ids in prompt_ids
+        ], dtype=torch.long)
+
+    def process(self, rows, scores):
+        banned = self.table.completes.to(scores.device)[self._states.to(scores.device)[rows]]
+        if banned.size(-1) < scores.size(-1):
+            # The model may have a larger (padded) output vocabulary than the tokenizer.
+            banned = torch.nn.functional.pad(banned, (0, scores.size(-1) - banned.size(-1)))
+
+        if self.rows is not None:
+            banned[[i for i, row in enumerate(rows.tolist()) if row not in self.rows]] = False
+
+        return scores.masked_fill(banned, -float('inf'))
+
+    def step(self, rows, next_tokens):
+        rows_tensor = torch.tensor(rows, dtype=torch.long)
+        self._states[rows_tensor] = self.table.next_states[
+            self._states[rows_tensor], torch.tensor(next_tokens, dtype=torch.long)
+        ]
+
+        return super().step(rows, next_tokens)
+
+class RowRangeProcessor(LogitsProcessor):
+    '''
+    Applies a validator or logits processor to a contiguous range of the rows of the
+    batch (e.g. the rows of one group of :func:`ai_redditor_service.gpt2.generate_groups`),
+    as though they were a batch of their own. The other rows are left unchanged.
+
+    '''
+
+    def __init__(self, processor, start, stop):
+        '''
+        Initializes an instance of :class:`RowRangeProcessor`.
+
+        :param processor:
+            A :class:`ai_redditor_service.validators.SequenceValidator` or :class:`LogitsProcessor`,
+            whose rows are indexed from the start of the range.
+        :param start:
+            The index of the first row of the range.
+        :param stop:
+            The index following the last row of the range.
+
+        '''
+
+        self.processor = processor
+        self.row_start = start
+        self.row_stop = stop
+
+    def start(self, prompt_ids):
+        self.processor.start(prompt_ids[self.row_start:self.row_stop])
+
+    def process(self, rows, scores):
+        if not isinstance(self.processor, LogitsProcessor): return scores
+
+        is_member = (rows >= self.row_start) & (rows < self.row_stop)
+        if not is_member.any(): return scores
+
+        scores[is_member] = self.processor.process(rows[is_member] - self.row_start, scores[is_member])
+        return scores
+
+    def step(self, rows, next_tokens):
+        is_valid = torch.ones(len(rows), dtype=torch.bool)
+        members = [i for i, row in enumerate(rows) if self.row_start <= row < self.row_stop]
+        if len(members) > 0:
+            is_valid[members] = self.processor.step(
+                [rows[i] - self.row_start for i in members],
+                [next_tokens[i] for i in members]
+            ).cpu()
+
+        return is_valid
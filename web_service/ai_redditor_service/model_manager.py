@@ -0,0 +1,182 @@
+'''
+Lazy loading of the GPT2 models, with a memory budget.
+
+'''
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class LazyDict(dict):
+    '''
+    A dictionary whose missing values are computed from their key on first access.
+
+    '''
+
+    def __init__(self, factory):
+        '''
+        Initializes an instance of :class:`LazyDict`.
+
+        :param factory:
+            A function that takes a key and returns its value.
+
+        '''
+
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, key):
+        value = self[key] = self.factory(key)
+        return value
+
+class ModelManager:
+    '''
+    Loads models on first use and keeps the most recently used ones resident
+    within a memory budget.
+
+    Models are accessed like a dictionary (e.g. ``manager[RecordType.PHC]``).
+    When loading a model would exceed the budget, the least recently used models
+    are evicted first; for models that were loaded before, this happens before loading
+    them again, so that the resident size never exceeds the budget. A model that is
+    larger than the whole budget is still loaded, after evicting every other model.
+    Evicted models are released once the last generation using them completes.
+
+    '''
+
+    def __init__(self, load_func, size_func, max_bytes=None, on_evict=None):
+        '''
+        Initializes an instance of :class:`ModelManager`.
+
+        :param load_func:
+            A function that takes a key and loads its model.
+        :param size_func:
+            A function that takes a loaded model and returns its size, in bytes.
+        :param max_bytes:
+            The memory budget, in bytes. Defaults to None, meaning no budget.
+        :param on_evict:
+            A function called with the key of every evicted model. Defaults to None.
+
+        '''
+
+        self.load_func = load_func
+        self.size_func = size_func
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+
+        self.nbytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        # The size of every model that was ever loaded, used to make room before reloading it.
+        self._sizes = {}
+        self._lock = threading.Lock()
+        # Serializes loads, so that concurrent first uses of a model load it once
+        # and the budget accounts for every model being loaded.
+        self._load_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        '''
+        Indicates whether the model of the specified key is resident.
+
+        '''
+
+        return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        with self._load_lock:
+            with self._lock:
+                # Another thread may have loaded the model while we waited.
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+
+            if key in self._sizes:
+                self._make_room(self._sizes[key])
+
+            start_time = time.time()
+            model = self.load_func(key)
+            nbytes = self._sizes[key] = self.size_func(model)
+            self._make_room(nbytes)
+
+            with self._lock:
+                self._entries[key] = (model, nbytes)
+                self.nbytes += nbytes
+                self.loads += 1
+
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            logger.warning('Model {} ({:.1f} MB) is larger than the memory budget ({:.1f} MB)'.format(
+                key, nbytes / 1024 ** 2, self.max_bytes / 1024 ** 2
+            ))
+
+        logger.info('Loaded model {} ({:.1f} MB) ({} seconds); {:.1f} MB resident'.format(
+            key, nbytes / 1024 ** 2, round(time.time() - start_time, 2), self.nbytes / 1024 ** 2
+        ))
+
+        return model
+
+    def _make_room(self, nbytes):
+        evicted = []
+        with self._lock:
+            while self.max_bytes is not None and len(self._entries) > 0 and \
+                self.nbytes + nbytes > self.max_bytes:
+                evicted_key, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_nbytes))
+
+        for evicted_key, evicted_nbytes in evicted:
+            logger.info('Evicted model {} ({:.1f} MB)'.format(evicted_key, evicted_nbytes / 1024 ** 2))
+            if self.on_evict is not None:
+                self.on_evict(evicted_key)
+
+    def keys(self):
+        '''
+        Gets the keys of the resident models, least recently used first.
+
+        '''
+
+        with self._lock:
+            return list(self._entries.keys())
+
+    def evict(self, key):
+        '''
+        Evicts the model of the specified key, if it is resident.
+
+        '''
+
+        with self._lock:
+            if key not in self._entries: return
+            _, nbytes = self._entries.pop(key)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+        logger.info('Evicted model {} ({:.1f} MB)'.format(key, nbytes / 1024 ** 2))
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def stats(self):
+        '''
+        Gets a dictionary describing the resident models and the load/eviction counters.
+
+        '''
+
+        with self._lock:
+            return {
+                'resident': {str(key): nbytes for key, (_, nbytes) in self._entries.items()},
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
@@ -4,4 +4,8 @@ from ai_redditor_service.models.record import (
     PHCRecord,
     RecordType,
     RECORD_MODEL_CLASSES
+)
+from ai_redditor_service.models.reservoir import (
+    ReservoirRecord,
+    ReservoirStats
 )
\ No newline at end of file
@@ -34,6 +34,11 @@ class RecordMixin(object):
         (i.e. written by a human).
     :ivar is_custom:
         Whether the record was generated with a custom prompt.
+    :ivar content_hash:
+        The signed 64-bit content hash of the groups that the record was generated
+        from (see :func:`ai_redditor_service.dedup.content_hash`), or None if the
+        record was not generated by the service. Generated records have unique hashes;
+        the unique index holds every NULL hash, since NULLs are distinct from one another.
 
     '''
 
@@ -42,8 +47,9 @@ class RecordMixin(object):
     is_generated = db.Column(db.Boolean, index=True)
     is_custom = db.Column(db.Boolean, index=True)
     creation_date = db.Column(db.DateTime, default=datetime.utcnow)
+    content_hash = db.Column(db.BigInteger, unique=True, index=True, nullable=True)
 
-    def __init__(self, uuid=None, is_custom=False, is_generated=True):
+    def __init__(self, uuid=None, is_custom=False, is_generated=True, content_hash=None):
         '''
         Base constructor for Record models.
 
@@ -54,6 +60,7 @@ class RecordMixin(object):
         
         self.uuid = uuid
         self.is_custom = is_custom
+        self.content_hash = content_hash
         self.is_generated = is_generated
 
     @abstractmethod
@@ -0,0 +1,210 @@
+from datetime import datetime, timedelta
+from ai_redditor_service.extensions import db
+
+class ReservoirRecord(db.Model):
+    '''
+    A generated record that has not been served yet.
+
+    Records generated from an empty prompt are interchangeable, so they are
+    generated ahead of time and kept in the reservoir until a request with an
+    empty prompt claims them.
+
+    :ivar record_type:
+        The :class:`ai_redditor_service.models.RecordType` of the record.
+    :ivar record_uuid:
+        The hexadecimal UUID of the record.
+
+    '''
+
+    __tablename__ = 'reservoir_record'
+    id = db.Column(db.Integer, primary_key=True)
+    record_type = db.Column(db.Integer, index=True)
+    record_uuid = db.Column(db.String(32), unique=True)
+    creation_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def depth(cls, record_type):
+        '''
+        Gets the number of unserved records of the specified type.
+
+        '''
+
+        return cls.query.filter_by(record_type=int(record_type)).count()
+
+    @classmethod
+    def pop_n(cls, record_type, count, max_attempts=3):
+        '''
+        Claims up to the specified number of records of the specified type,
+        oldest first, and removes them from the reservoir.
+
+        A record is only claimed if deleting its row succeeds, so that two
+        workers can never serve the same record.
+
+        :param record_type:
+            The :class:`ai_redditor_service.models.RecordType` of the records.
+        :param count:
+            The number of records to claim.
+        :param max_attempts:
+            The number of times to retry when other workers claim the
+            selected records first. Defaults to 3.
+        :returns:
+            A list of the UUIDs of the claimed records.
+
+        '''
+
+        record_uuids = []
+        for _ in range(max_attempts):
+            remaining = count - len(record_uuids)
+            if remaining <= 0: break
+
+            candidates = cls.query.filter_by(record_type=int(record_type)) \
+                .order_by(cls.id).limit(remaining).all()
+
+            if len(candidates) == 0: break
+            for candidate in candidates:
+                deleted = cls.query.filter_by(id=candidate.id).delete(synchronize_session=False)
+                if deleted == 1:
+                    record_uuids.append(candidate.record_uuid)
+
+            db.session.commit()
+
+        return record_uuids
+
+class ReservoirStats(db.Model):
+    '''
+    The counters of the reservoir of a record type.
+
+    :ivar record_type:
+        The :class:`ai_redditor_service.models.RecordType` of the reservoir.
+    :ivar hits:
+        The number of records requested with an empty prompt that were
+        served from the reservoir.
+    :ivar misses:
+        The number of records requested with an empty prompt that had
+        to be generated on demand since the reservoir was empty.
+    :ivar refilled:
+        The number of records added to the reservoir.
+    :ivar last_refill_date:
+        The date of the last refill that added records to the reservoir.
+    :ivar refill_start_date:
+        The date that the refill in progress started, or None if the
+        reservoir is not being refilled.
+
+    '''
+
+    __tablename__ = 'reservoir_stats'
+    record_type = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    hits = db.Column(db.BigInteger, default=0, nullable=False)
+    misses = db.Column(db.BigInteger, default=0, nullable=False)
+    refilled = db.Column(db.BigInteger, default=0, nullable=False)
+    last_refill_date = db.Column(db.DateTime, nullable=True)
+    refill_start_date = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def get(cls, record_type):
+        '''
+        Gets the counters of the specified record type, creating them if needed.
+
+        '''
+
+        stats = cls.query.get(int(record_type))
+        if stats is None:
+            stats = cls(record_type=int(record_type), hits=0, misses=0, refilled=0)
+            db.session.add(stats)
+            db.session.commit()
+
+        return stats
+
+    @classmethod
+    def increment(cls, record_type, hits=0, misses=0, refilled=0):
+        '''
+        Increments the counters of the specified record type.
+
+        The counters are incremented in the database (rather than read,
+        modified and written back) so that concurrent workers do not
+        overwrite each other's updates.
+
+        '''
+
+        values = {
+            cls.hits: cls.hits + hits,
+            cls.misses: cls.misses + misses,
+            cls.refilled: cls.refilled + refilled
+        }
+
+        if refilled > 0:
+            values[cls.last_refill_date] = datetime.utcnow()
+
+        cls.get(record_type)
+        cls.query.filter_by(record_type=int(record_type)).update(values, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def _refill_in_progress(cls, timeout):
+        return (cls.refill_start_date != None) & \
+            (cls.refill_start_date > datetime.utcnow() - timedelta(seconds=timeout))
+
+    @classmethod
+    def is_refilling(cls, record_type, timeout):
+        '''
+        Indicates whether the reservoir of the specified record type is being refilled.
+
+        :param timeout:
+            The time, in seconds, after which a refill that was not released is
+            assumed to have failed (e.g. its worker was killed).
+
+        '''
+
+        return cls.query.filter_by(record_type=int(record_type)) \
+            .filter(cls._refill_in_progress(timeout)).count() > 0
+
+    @classmethod
+    def claim_refill(cls, record_type, timeout):
+        '''
+        Claims the refill of the reservoir of the specified record type, so that
+        a single refill is in progress at a time. The claim is released with
+        :meth:`release_refill`.
+
+        The claim is a conditional update of the row of the record type, so
+        that only one of the workers claiming it at once succeeds.
+
+        :param timeout:
+            The time, in seconds, after which a claim that was not released is
+            assumed to have failed (e.g. its worker was killed).
+        :returns:
+            True if the refill was claimed, or False if another refill is in progress.
+
+        '''
+
+        cls.get(record_type)
+        claimed = cls.query.filter_by(record_type=int(record_type)) \
+            .filter(~cls._refill_in_progress(timeout)) \
+            .update({cls.refill_start_date: datetime.utcnow()}, synchronize_session=False)
+
+        db.session.commit()
+        return claimed == 1
+
+    @classmethod
+    def release_refill(cls, record_type):
+        '''
+        Releases the refill of the reservoir of the specified record type.
+
+        '''
+
+        cls.query.filter_by(record_type=int(record_type)) \
+            .update({cls.refill_start_date: None}, synchronize_session=False)
+
+        db.session.commit()
+
+    def to_dict(self):
+        '''
+        Gets a dictionary object representing the counters.
+
+        '''
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refilled': self.refilled,
+            'last_refill_date': str(self.last_refill_date) if self.last_refill_date is not None else None
+        }
@@ -0,0 +1,122 @@
+'''
+Key/value cache reuse for prompts shared across generations.
+
+'''
+
+import threading
+from collections import OrderedDict
+
+def _tensors_nbytes(value):
+    '''
+    Gets the total size, in bytes, of all the tensors in a (nested) tuple.
+
+    '''
+
+    if isinstance(value, (tuple, list)):
+        return sum(_tensors_nbytes(x) for x in value)
+
+    return value.numel() * value.element_size()
+
+class PromptCache:
+    '''
+    A least-recently-used cache of the model state after encoding a prompt.
+
+    Each entry is keyed by the token ids of the prompt and holds the key/value
+    cache (past) of the model, as well as the logits of the last prompt token,
+    so that a generation from a cached prompt can begin sampling immediately.
+    Entries are evicted, least recently used first, once the total size of the
+    cached tensors exceeds the memory cap.
+
+    '''
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        '''
+        Initializes an instance of :class:`PromptCache`.
+
+        :param max_bytes:
+            The maximum total size, in bytes, of the cached tensors.
+            Defaults to 256 MiB.
+
+        '''
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, prompt_ids):
+        '''
+        Gets the cached state of the prompt with the longest token ids that
+        are a prefix of (or equal to) the specified prompt token ids.
+
+        :param prompt_ids:
+            A tuple of prompt token ids.
+        :returns:
+            A tuple containing the token ids of the cached prompt, its key/value
+            cache and its last token logits; or None, if no cached prompt matches.
+
+        '''
+
+        with self._lock:
+            match = None
+            if prompt_ids in self._entries:
+                match = prompt_ids
+            else:
+                for key in self._entries:
+                    if len(key) >= len(prompt_ids) or (match is not None and len(key) <= len(match)): continue
+                    if prompt_ids[:len(key)] == key:
+                        match = key
+
+            if match is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(match)
+            past, logits, _ = self._entries[match]
+            return match, past, logits
+
+    def put(self, prompt_ids, past, logits):
+        '''
+        Caches the state of the model after encoding a prompt.
+
+        :param prompt_ids:
+            A tuple of prompt token ids.
+        :param past:
+            The key/value cache of the model after encoding the prompt.
+        :param logits:
+            The logits of the last prompt token.
+
+        '''
+
+        nbytes = _tensors_nbytes(past) + _tensors_nbytes(logits)
+        # Entries that could never fit are not worth evicting the whole cache for.
+        if nbytes > self.max_bytes: return
+
+        with self._lock:
+            if prompt_ids in self._entries:
+                self._entries.move_to_end(prompt_ids)
+                return
+
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+            self._entries[prompt_ids] = (past, logits, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        '''
+        Removes all entries from the cache.
+
+        '''
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
@@ -1,12 +1,18 @@
 import json
+import time
 from celery import states
 from celery.result import AsyncResult
 from flask_expects_json import expects_json
 from flask import Blueprint, current_app, g, jsonify, url_for
 
-import ai_redditor_service.tasks as tasks
 from ai_redditor_service.utils import validate_json
-from ai_redditor_service.models import RecordType, RECORD_MODEL_CLASSES
+from ai_redditor_service.shared import send_generate_record
+from ai_redditor_service.models import (
+    RecordType,
+    RECORD_MODEL_CLASSES,
+    ReservoirRecord,
+    ReservoirStats
+)
 from ai_redditor_service.extensions import celery as celery_app
 
 bp = Blueprint('api', __name__, url_prefix='/api')
@@ -86,6 +92,11 @@ generate_schema = {
         'prompt': {
             'type': ['object', 'null'],
             'default': None
+        },
+        'time_budget': {
+            'type': ['number', 'null'],
+            'exclusiveMinimum': 0,
+            'default': None
         }
     }
 }
@@ -137,6 +148,15 @@ def generate_record(record_type):
     Generates a record of the specified type. An optional JSON object
     can be specified to this endpoint providing a prompt to the model.
 
+    :param prompt:
+        The prompt object of the record. Defaults to None, meaning no prompt.
+    :param time_budget:
+        The time, in seconds, within which the record must be generated (including
+        the time spent waiting in the queue). Once it runs out, a record generated
+        from an empty prompt is served from the reservoir or the dataset instead;
+        otherwise, the task fails. Defaults to the "GPT2_DEFAULT_TIME_BUDGET_SECONDS"
+        configuration value.
+
     '''
 
     # Convert record type argument to enum
@@ -146,7 +166,14 @@ def generate_record(record_type):
     if record_type in _PROMPT_SCHEMAS:
         validate_json(prompt, _PROMPT_SCHEMAS[record_type])
 
-    result = tasks.generate_record.delay(record_type, prompt, samples=1) 
+    kwargs = {}
+    time_budget = g.data['time_budget'] or current_app.config.get('GPT2_DEFAULT_TIME_BUDGET_SECONDS', 0)
+    if time_budget > 0:
+        # The deadline is absolute, so that the time spent in the queue counts against the budget.
+        kwargs['deadline'] = time.time() + time_budget
+
+    # The task is sent by name, so that the web process never imports the models.
+    result = send_generate_record(record_type, prompt, samples=1, **kwargs)
     response_message = 'Queued up {} record generation.'.format(record_type.name)
 
     return jsonify(
@@ -183,7 +210,9 @@ def generate_record_task_status(task_id):
             state_meta = backend.get(backend.get_key_for_task(result_handle.id))
             # The state meta is an encoded JSON string, so we have to decode and parse it.
             state_meta = json.loads(state_meta.decode())
-            return error_response(state_meta['result']['error'], 500)
+            # The exception is compared by name, so that the web process never imports the tasks.
+            status_code = 504 if state_meta['result'].get('exc_type') == 'GenerationTimeoutError' else 500
+            return error_response(state_meta['result']['error'], status_code)
         else:
             record_type, uuids = result_handle.result
             if len(uuids) == 0:
@@ -195,4 +224,29 @@ def generate_record_task_status(task_id):
             kwargs['permalink'] = url_for(route, uuid=uuids[0])
 
     status_code = 201 if is_ready else 202
-    return jsonify(success=True, **kwargs), status_code
\ No newline at end of file
+    return jsonify(success=True, **kwargs), status_code
+
+@bp.route('/r/<any(tifu, wp, phc):record_type>/reservoir')
+def get_reservoir_status(record_type):
+    '''
+    Gets the depth and counters of the reservoir of pre-generated
+    records of the specified type.
+
+    '''
+
+    # Convert record type argument to enum
+    record_type = RecordType[record_type.upper()]
+    stats = ReservoirStats.query.get(int(record_type))
+    stats = stats.to_dict() if stats is not None else ReservoirStats(
+        hits=0, misses=0, refilled=0
+    ).to_dict()
+
+    requests = stats['hits'] + stats['misses']
+    return jsonify(
+        enabled=current_app.config.get('GPT2_RESERVOIR_ENABLED', False),
+        depth=ReservoirRecord.depth(record_type),
+        target_depth=current_app.config.get('GPT2_RESERVOIR_DEPTH', 16),
+        hit_rate=stats['hits'] / requests if requests > 0 else None,
+        success=True,
+        **stats
+    ), 200
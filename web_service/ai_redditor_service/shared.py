@@ -0,0 +1,97 @@
+'''
+Definitions shared by the web process and the Celery workers.
+
+This module must not import torch or transformers (directly or through
+:mod:`ai_redditor_service.gpt2` and :mod:`ai_redditor_service.tasks`), so
+that the web process can queue record generation tasks without loading them.
+
+'''
+
+import re
+from ai_redditor_service.extensions import celery
+from ai_redditor_service.formats import (
+    ModelDecodeFormat,
+    PHC_LINK_PATTERN,
+    PHC_LINK_BANNED_SUBSTRING
+)
+from ai_redditor_service.models import (
+    RecordType,
+    TIFURecord,
+    WPRecord,
+    PHCRecord
+)
+
+# The name of the :func:`ai_redditor_service.tasks.generate_record` task.
+GENERATE_RECORD_TASK_NAME = 'ai_redditor_service.tasks.generate_record'
+
+def send_generate_record(record_type, prompt=None, **kwargs):
+    '''
+    Queues a :func:`ai_redditor_service.tasks.generate_record` task by name,
+    without importing the task module.
+
+    :returns:
+        A :class:`celery.result.AsyncResult` of the task.
+
+    '''
+
+    return celery.send_task(GENERATE_RECORD_TASK_NAME, args=(record_type, prompt), kwargs=kwargs)
+
+class RecordGenerateConfig:
+    '''
+    Configuration values for generating a record.
+
+    '''
+
+    def __init__(self, decode_format, group_to_record_func, min_length=250, max_length=1024):
+        self.decode_format = decode_format
+        self._group_to_record_func = group_to_record_func
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def group_to_record(self, prompt_object, generated_groups, *args, **kwargs):  
+        return self._group_to_record_func(prompt_object, generated_groups, *args, **kwargs)
+
+def _sanitize_likes(likes_str):
+    '''
+    Sanitize the likes group of the model output.
+
+    '''
+
+    return int(re.sub('[^0-9-]', '', likes_str) or 0)
+
+def _is_field_missing(field, data):
+    return field not in data or not isinstance(data[field], int) and not bool(data.get(field, None))
+
+# Maps record type to a value configuration
+_RECORD_GENERATE_CONFIGS = {
+    RecordType.TIFU: RecordGenerateConfig(
+        ModelDecodeFormat.QUERY_ANSWER,
+        lambda prompt_object, generated_groups, *args, **kwargs: TIFURecord(
+            generated_groups['prompt'], generated_groups['response'],
+            post_title_prompt_end=len(prompt_object.get('post_title', '')),
+            post_body_prompt_end=len(prompt_object.get('post_body', '')),
+            *args, **kwargs
+        )
+    ),
+    RecordType.WP: RecordGenerateConfig(
+        ModelDecodeFormat.QUERY_ANSWER,
+        lambda prompt_object, generated_groups, *args, **kwargs: WPRecord(
+            generated_groups['prompt'], generated_groups['response'],
+            prompted_prompt_end=len(prompt_object.get('post_title', '')),
+            prompted_response_end=len(prompt_object.get('post_body', '')),
+            *args, **kwargs
+        )
+    ),
+    RecordType.PHC: RecordGenerateConfig(
+        ModelDecodeFormat.PHC,
+        lambda prompt_object, generated_groups, *args, **kwargs: PHCRecord(
+            generated_groups['author'],
+            _sanitize_likes(generated_groups['likes']),
+            generated_groups['comment_body'],
+            prompted_author_username_end=len(prompt_object.get('author', '')),
+            is_likes_prompted=not _is_field_missing('likes', prompt_object),
+            prompted_comment_end=len(prompt_object.get('comment_body', '')),
+            *args, **kwargs
+        ), min_length=10, max_length=200
+    )
+}
@@ -0,0 +1,152 @@
+'''
+Incremental decoding of sampled tokens, used to stream the text of
+sequences while they are being generated.
+
+'''
+
+class IncrementalDecoder:
+    '''
+    Decodes the tokens of a single sequence as they are sampled.
+
+    Only the text of the tokens since the last emitted chunk (and the token
+    before them, for context) is decoded at each step, so the cost per token
+    does not grow with the sequence length. Text ending in an incomplete
+    multi-byte character is held back until the character is complete.
+
+    '''
+
+    def __init__(self, tokenizer):
+        '''
+        Initializes an instance of :class:`IncrementalDecoder`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` used to decode tokens.
+
+        '''
+
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def push(self, token_id):
+        '''
+        Adds a token to the sequence.
+
+        :returns:
+            The text that was completed by the token (possibly empty).
+
+        '''
+
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(self.token_ids[self._prefix_offset:self._read_offset])
+        text = self.tokenizer.decode(self.token_ids[self._prefix_offset:])
+        if len(text) <= len(prefix_text) or text.endswith('\ufffd'): return ''
+
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.token_ids)
+        return text[len(prefix_text):]
+
+class TextStreamer:
+    '''
+    Streams the text of the sequences sampled for a batch of requests.
+
+    Each sequence is identified by a per-request sequence number that keeps
+    increasing across iterations. After every decode step, the callback of each
+    request is called with an event dictionary containing:
+
+    - ``chunks``: a dictionary mapping sequence numbers to the text they just completed;
+    - ``tokens``: the number of tokens sampled for the request in this step;
+    - ``rejected``: the sequence numbers that were aborted or failed validation;
+    - ``accepted``: the sequence numbers that were accepted as records.
+
+    '''
+
+    def __init__(self, tokenizer, callbacks, row_owners, first_sequence_numbers):
+        '''
+        Initializes an instance of :class:`TextStreamer`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` used to decode tokens.
+        :param callbacks:
+            A list containing the stream callback of each request (or None).
+        :param row_owners:
+            A list containing the index of the request that owns each row of the batch.
+        :param first_sequence_numbers:
+            A list containing the sequence number of the first row of each request
+            in this batch.
+
+        '''
+
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.row_owners = row_owners
+
+        self.sequence_numbers = []
+        next_sequence_numbers = list(first_sequence_numbers)
+        for owner in row_owners:
+            self.sequence_numbers.append(next_sequence_numbers[owner])
+            next_sequence_numbers[owner] += 1
+
+        self._decoders = {}
+
+    def _emit(self, events):
+        for owner, event in events.items():
+            event.setdefault('chunks', {})
+            event.setdefault('tokens', 0)
+            event.setdefault('rejected', [])
+            event.setdefault('accepted', [])
+            self.callbacks[owner](event)
+
+    def step(self, rows, next_tokens, aborted_rows):
+        '''
+        Streams the tokens sampled in a decode step.
+
+        :param rows:
+            A list of the indices of the rows that sampled a token.
+        :param next_tokens:
+            A list of the token ids sampled for each row in ``rows``.
+        :param aborted_rows:
+            A list of the indices of the rows that were aborted in this step.
+
+        '''
+
+        events = {}
+        for row, token_id in zip(rows, next_tokens):
+            owner = self.row_owners[row]
+            if self.callbacks[owner] is None: continue
+            if row not in self._decoders:
+                self._decoders[row] = IncrementalDecoder(self.tokenizer)
+
+            event = events.setdefault(owner, {'chunks': {}, 'tokens': 0})
+            event['tokens'] += 1
+            text = self._decoders[row].push(token_id)
+            if len(text) > 0:
+                event['chunks'][self.sequence_numbers[row]] = text
+
+        for row in aborted_rows:
+            owner = self.row_owners[row]
+            if self.callbacks[owner] is None: continue
+            events.setdefault(owner, {}).setdefault('rejected', []).append(self.sequence_numbers[row])
+
+        self._emit(events)
+
+    def finish(self, accepted_rows, rejected_rows):
+        '''
+        Streams the outcome of the rows that were not aborted while decoding.
+
+        :param accepted_rows:
+            A list of the indices of the rows that were accepted as records.
+        :param rejected_rows:
+            A list of the indices of the rows that were rejected.
+
+        '''
+
+        events = {}
+        for key, rows in (('accepted', accepted_rows), ('rejected', rejected_rows)):
+            for row in rows:
+                owner = self.row_owners[row]
+                if self.callbacks[owner] is None: continue
+                events.setdefault(owner, {}).setdefault(key, []).append(self.sequence_numbers[row])
+
+        self._emit(events)
@@ -7,31 +7,83 @@ import re
 import copy
 import time
 import traceback
+import functools
+import threading
+from pathlib import Path
+from types import SimpleNamespace
 
 from celery import states
 from flask_socketio import SocketIO
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
 from celery.utils import cached_property, log
 from ai_redditor_service.extensions import celery, db
-from ai_redditor_service.utils import unescape_unicode, all_empty
-from ai_redditor_service.gpt2 import (
+from ai_redditor_service.utils import unescape_unicode, all_empty, merge_dicts
+from ai_redditor_service.acceptance import AcceptanceTracker
+from ai_redditor_service.dedup import DatabaseHashIndex, content_hash, to_signed64
+from ai_redditor_service.batching import BatchScheduler
+from ai_redditor_service.prompt_cache import PromptCache
+from ai_redditor_service.model_manager import ModelManager, LazyDict
+from ai_redditor_service.inference_client import InferenceClient
+from ai_redditor_service.adapters import AdapterView, load_adapters
+from ai_redditor_service.field_completion import FIELD_COMPLETION_STRATEGIES, FieldDistribution
+from ai_redditor_service.shared import (
     ModelDecodeFormat,
-    load_model,
-    generate as gpt2_model_generate,
     PHC_LINK_PATTERN,
+    _RECORD_GENERATE_CONFIGS,
+    _sanitize_likes,
+    _is_field_missing
+)
+from ai_redditor_service.gpt2 import (
+    GenerationRequest,
+    GenerationGroup,
+    GenerationStats,
+    load_model,
+    load_tokenizer,
+    get_model_nbytes,
+    generate_batch as gpt2_model_generate_batch,
+    generate_groups as gpt2_model_generate_groups,
+    complete_fields as gpt2_model_complete_fields,
     _get_decode_regex_mapping,
     _get_decode_special_tokens_mapping
 )
 
 from ai_redditor_service.models import (
     RecordType, 
-    TIFURecord, 
-    WPRecord, 
-    PHCRecord
+    ReservoirRecord,
+    ReservoirStats,
+    RECORD_MODEL_CLASSES
 )
 
 logger = log.get_task_logger(__name__)
 
+# The keyword arguments of GPT2GenerateTask.get_generate_kwargs that are specific
+# to each group of a batch of several record types (see GenerationGroup).
+_GENERATION_GROUP_KWARGS = (
+    'min_length', 'max_length', 'decode_strict_regex_mapping',
+    'prompt_cache', 'model_name', 'dedup_index'
+)
+
+# The keyword arguments of GPT2GenerateTask.get_generate_kwargs that are the same for
+# every record type, and so are shared by the groups of a batch of several record types.
+_GENERATION_SHARED_KWARGS = (
+    'translate_token', 'end_of_likes_token', 'use_streaming_validation',
+    'use_constrained_decoding', 'acceptance_tracker', 'target_probability',
+    'max_batch_size', 'window_shift'
+)
+
+class GenerationTimeoutError(Exception):
+    '''
+    Raised when no record could be generated (or served from a fallback)
+    within the time budget of a generation request.
+
+    '''
+
+    pass
+
+def _is_expired(deadline):
+    return deadline is not None and time.time() >= deadline
+
 class SqlAlchemyTask(celery.Task):
     '''
     Celery task that ensures that the connection of
@@ -91,40 +143,176 @@ class GPT2GenerateTask(SqlAlchemyTask):
     @cached_property
     def models(self):
         '''
-        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
-        to its respective :class:`transformers.PreTrainedModel` instance
-        and :class:`transformers.PreTrainedTokenizer` instance. 
+        A :class:`ai_redditor_service.model_manager.ModelManager` mapping each
+        :class:`ai_redditor_service.models.RecordType` to its respective
+        :class:`transformers.PreTrainedModel` instance and
+        :class:`transformers.PreTrainedTokenizer` instance.
+
+        Each model is loaded the first time it is used, and the least recently
+        used models are evicted to stay within the memory budget. With a base model
+        shared by the record types (see :attr:`base_model`), each model is the base
+        model with the adapter of its record type, and the tokenizer is that of the adapter.
 
         '''
 
-        no_cuda = current_app.config.get('GPT2_NO_CUDA', False),
+        if self.base_model_path is not None:
+            adapter_paths = {
+                model_type: current_app.config['{}_ADAPTER_PATH'.format(model_type.name)]
+                for model_type in RecordType
+            }
+
+            def _get_adapter_model(model_type):
+                model, adapter_ids = self.base_model
+                return AdapterView(model, adapter_ids[model_type]), load_tokenizer(adapter_paths[model_type])
+
+            # The base model stays resident for all the record types, so there is no budget to enforce.
+            return ModelManager(_get_adapter_model, lambda value: 0)
+
+        no_cuda = current_app.config.get('GPT2_NO_CUDA', False)
         quantize = current_app.config.get('GPT2_QUANTIZE', False)
-        start_time = time.time()
+        mmap_weights = current_app.config.get('GPT2_MMAP_WEIGHTS', True)
+        default_engine = current_app.config.get('GPT2_ENGINE', 'torch')
+        default_precision = current_app.config.get('GPT2_PRECISION', 'float32')
+        paths = {
+            model_type: (
+                current_app.config['{}_MODEL_PATH'.format(model_type.name)],
+                current_app.config.get('{}_TOKENIZER_PATH'.format(model_type.name), None)
+            ) for model_type in RecordType
+        }
 
-        models = {
-            RecordType.TIFU: load_model(
-                current_app.config['TIFU_MODEL_PATH'],
-                current_app.config.get('TIFU_TOKENIZER_PATH', None),
-                no_cuda=no_cuda, quantize=quantize
-            ),
-            RecordType.WP: load_model(
-                current_app.config['WP_MODEL_PATH'],
-                current_app.config.get('WP_TOKENIZER_PATH', None),
-                no_cuda=no_cuda, quantize=quantize
-            ),
-            RecordType.PHC: load_model(
-                current_app.config['PHC_MODEL_PATH'],
-                current_app.config.get('PHC_TOKENIZER_PATH', None),
-                no_cuda=no_cuda, quantize=quantize
+        engines = {
+            model_type: current_app.config.get('{}_MODEL_ENGINE'.format(model_type.name), default_engine)
+            for model_type in RecordType
+        }
+
+        precisions = {
+            model_type: current_app.config.get('{}_MODEL_PRECISION'.format(model_type.name), default_precision)
+            for model_type in RecordType
+        }
+
+        default_restrict_vocab = current_app.config.get('GPT2_RESTRICTED_VOCAB', True)
+        restrict_vocabs = {
+            model_type: current_app.config.get('{}_MODEL_RESTRICTED_VOCAB'.format(model_type.name), default_restrict_vocab)
+            for model_type in RecordType
+        }
+
+        def _load_model(model_type):
+            model_path, tokenizer_path = paths[model_type]
+            return load_model(
+                model_path, tokenizer_path, no_cuda=no_cuda,
+                quantize=quantize, mmap_weights=mmap_weights,
+                engine=engines[model_type], precision=precisions[model_type],
+                restrict_vocab=restrict_vocabs[model_type]
             )
+
+        def _on_evict(model_type):
+            # The cached key/value states are only useful with the model resident.
+            if self.prompt_caches[model_type] is not None:
+                self.prompt_caches[model_type].clear()
+
+        max_megabytes = current_app.config.get('GPT2_MODEL_MEMORY_BUDGET_MB', 0)
+        return ModelManager(
+            _load_model, lambda value: get_model_nbytes(value[0]),
+            max_bytes=int(max_megabytes * 1024 * 1024) if max_megabytes > 0 else None,
+            on_evict=_on_evict
+        )
+
+    @cached_property
+    def base_model_path(self):
+        '''
+        The path to the base model shared by the adapters of the record types,
+        or None if each record type has a model of its own.
+
+        '''
+
+        return current_app.config.get('GPT2_BASE_MODEL_PATH', None)
+
+    @cached_property
+    def base_model(self):
+        '''
+        The base model shared by the record types, with the adapter of each record type
+        (see :mod:`ai_redditor_service.adapters`), and a dictionary mapping each
+        :class:`ai_redditor_service.models.RecordType` to the index of its adapter.
+
+        '''
+
+        if current_app.config.get('GPT2_QUANTIZE', False) or current_app.config.get('GPT2_ENGINE', 'torch') != 'torch':
+            raise ValueError('A base model with adapters is only run unquantized by the torch engine.')
+
+        model, _ = load_model(
+            self.base_model_path, no_cuda=current_app.config.get('GPT2_NO_CUDA', False),
+            mmap_weights=current_app.config.get('GPT2_MMAP_WEIGHTS', True),
+            precision=current_app.config.get('GPT2_PRECISION', 'float32')
+        )
+
+        adapter_ids = load_adapters(model, [
+            current_app.config['{}_ADAPTER_PATH'.format(model_type.name)]
+            for model_type in RecordType
+        ])
+
+        return model, dict(zip(RecordType, adapter_ids))
+
+    @cached_property
+    def draft_models(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to the draft model used to sample from its model with speculative decoding,
+        or None if the record type has no draft model.
+
+        '''
+
+        no_cuda = current_app.config.get('GPT2_NO_CUDA', False)
+        default_precision = current_app.config.get('GPT2_PRECISION', 'float32')
+        paths = {
+            model_type: current_app.config.get('{}_DRAFT_MODEL_PATH'.format(model_type.name), None)
+            for model_type in RecordType
         }
 
-        logger.info('Loaded GPT2 models ({}) ({} seconds)'.format(
-            ', '.join(str(x) for x in models.keys()),
-            round(time.time() - start_time, 2)
-        ))
+        def _load_draft_model(model_type):
+            if paths[model_type] is None: return None
+
+            precision = current_app.config.get('{}_MODEL_PRECISION'.format(model_type.name), default_precision)
+            draft_model, _ = load_model(paths[model_type], no_cuda=no_cuda, precision=precision)
+            model, _ = self.models[model_type]
+            if draft_model.config.vocab_size != model.config.vocab_size:
+                raise ValueError('The draft model of {} (\'{}\') does not share the vocabulary of its model.'.format(
+                    model_type, paths[model_type]
+                ))
+
+            return draft_model
 
-        return models
+        return LazyDict(_load_draft_model)
+
+    @cached_property
+    def inference_client(self):
+        '''
+        The :class:`ai_redditor_service.inference_client.InferenceClient` used to
+        generate records, or None if records are generated by this process.
+
+        '''
+
+        url = current_app.config.get('GPT2_INFERENCE_SERVER_URL', None)
+        if url is None: return None
+
+        return InferenceClient(url, timeout=current_app.config.get('GPT2_INFERENCE_SERVER_TIMEOUT_SECONDS', 300))
+
+    @cached_property
+    def tokenizers(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to the :class:`transformers.PreTrainedTokenizer` of its model. When using an
+        inference server, only the special tokens of the tokenizers are available.
+
+        '''
+
+        def _get_tokenizer(model_type):
+            if self.inference_client is not None:
+                return SimpleNamespace(**self.inference_client.info(model_type))
+
+            _, tokenizer = self.models[model_type]
+            return tokenizer
+
+        return LazyDict(_get_tokenizer)
 
     @cached_property
     def special_tokens_match_pattern(self):
@@ -134,14 +322,11 @@ class GPT2GenerateTask(SqlAlchemyTask):
 
         '''
 
-        match_patterns = {}
-        for model_type, value in self.models.items():
-            _, tokenizer = value
-            match_patterns[model_type] = re.compile(
-                '|'.join(re.escape(token) for token in tokenizer.all_special_tokens)
-            )
-        
-        return match_patterns
+        def _get_pattern(model_type):
+            tokenizer = self.tokenizers[model_type]
+            return re.compile('|'.join(re.escape(token) for token in tokenizer.all_special_tokens))
+
+        return LazyDict(_get_pattern)
 
     @cached_property
     def translate_token(self):
@@ -172,15 +357,320 @@ class GPT2GenerateTask(SqlAlchemyTask):
 
         '''
         
-        regex_mappings = {}
-        for model_type, value in self.models.items():
-            _, tokenizer = value
-            regex_mappings[model_type] =  _get_decode_regex_mapping(
+        def _get_regex_mapping(model_type):
+            _, tokenizer = self.models[model_type]
+            return _get_decode_regex_mapping(
                 True, tokenizer.bos_token, tokenizer.eos_token,
                 self.translate_token, self.end_of_likes_token
             )
 
-        return regex_mappings
+        return LazyDict(_get_regex_mapping)
+
+    @cached_property
+    def prompt_caches(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to the :class:`ai_redditor_service.prompt_cache.PromptCache` of its model,
+        or None if prompt caching is disabled.
+
+        '''
+
+        max_megabytes = current_app.config.get('GPT2_PROMPT_CACHE_MAX_MB', 256)
+        return {
+            model_type: PromptCache(max_bytes=max_megabytes * 1024 * 1024) \
+                if max_megabytes > 0 else None
+            for model_type in RecordType
+        }
+
+    @cached_property
+    def use_streaming_validation(self):
+        '''
+        Indicates whether sequences are validated (and aborted) while they are being decoded.
+
+        '''
+
+        return current_app.config.get('GPT2_STREAMING_VALIDATION', True)
+
+    @cached_property
+    def use_constrained_decoding(self):
+        '''
+        Indicates whether sampling is constrained to the decode format of each model.
+
+        '''
+
+        return current_app.config.get('GPT2_CONSTRAINED_DECODING', True)
+
+    @cached_property
+    def generation_stats(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to a :class:`ai_redditor_service.gpt2.GenerationStats` object with the
+        cumulative counters of its model for the lifetime of the worker. The decode
+        loops of batches that mix record types (with a shared base model) are counted
+        in :attr:`mixed_generation_stats` instead.
+
+        '''
+
+        return {model_type: GenerationStats() for model_type in RecordType}
+
+    @cached_property
+    def mixed_generation_stats(self):
+        '''
+        A :class:`ai_redditor_service.gpt2.GenerationStats` object with the cumulative
+        counters of the decode loops (e.g. the decode steps) of the batches that mix
+        record types. The sequences sampled and accepted for each record type are
+        counted in its :attr:`generation_stats`.
+
+        '''
+
+        return GenerationStats()
+
+    @cached_property
+    def acceptance_tracker(self):
+        '''
+        The :class:`ai_redditor_service.acceptance.AcceptanceTracker` of the acceptance
+        rates of sampled sequences, or None if adaptive oversampling is disabled.
+
+        '''
+
+        if not current_app.config.get('GPT2_ADAPTIVE_OVERSAMPLING', True): return None
+
+        filepath = current_app.config.get('GPT2_ACCEPTANCE_RATES_FILENAME', None)
+        if filepath is not None:
+            filepath = Path(current_app.instance_path) / filepath
+
+        return AcceptanceTracker(
+            filepath=filepath,
+            half_life=current_app.config.get('GPT2_ACCEPTANCE_RATES_HALF_LIFE', 500)
+        )
+
+    def get_generate_kwargs(self, model_type):
+        '''
+        Gets the keyword arguments passed to :func:`ai_redditor_service.gpt2.generate_batch`
+        when generating records with the model of the specified record type.
+
+        '''
+
+        record_config = _RECORD_GENERATE_CONFIGS[model_type]
+        return {
+            'translate_token': self.translate_token,
+            'end_of_likes_token': self.end_of_likes_token,
+            'min_length': record_config.min_length,
+            'max_length': current_app.config.get(
+                '{}_MAX_LENGTH'.format(RecordType(model_type).name), record_config.max_length
+            ),
+            'decode_strict_regex_mapping': self.decode_strict_regex_mapping[model_type],
+            'prompt_cache': self.prompt_caches[model_type],
+            'use_streaming_validation': self.use_streaming_validation,
+            'use_constrained_decoding': self.use_constrained_decoding,
+            'stats': self.generation_stats[model_type],
+            'acceptance_tracker': self.acceptance_tracker,
+            'model_name': current_app.config['{}_{}_PATH'.format(
+                RecordType(model_type).name, 'MODEL' if self.base_model_path is None else 'ADAPTER'
+            )],
+            'target_probability': current_app.config.get('GPT2_ACCEPTANCE_TARGET_PROBABILITY', 0.9),
+            'dedup_index': self.dedup_indices[model_type],
+            'draft_model': self.draft_models[model_type],
+            'num_draft_tokens': current_app.config.get('GPT2_NUM_DRAFT_TOKENS', 4),
+            'max_batch_size': current_app.config.get('GPT2_MAX_DECODE_BATCH_SIZE', 0) or None,
+            'window_shift': current_app.config.get('GPT2_CONTEXT_WINDOW_SHIFT', 256)
+        }
+
+    @cached_property
+    def dedup_indices(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to the :class:`ai_redditor_service.dedup.DatabaseHashIndex` of its records,
+        or None if deduplication is disabled.
+
+        '''
+
+        is_enabled = current_app.config.get('GPT2_DEDUP_ENABLED', True)
+        return {
+            model_type: DatabaseHashIndex(RECORD_MODEL_CLASSES[model_type]) \
+                if is_enabled else None
+            for model_type in RecordType
+        }
+
+    @cached_property
+    def batching_enabled(self):
+        '''
+        Indicates whether concurrent generation requests are batched together.
+
+        '''
+
+        return current_app.config.get('GPT2_BATCHING_ENABLED', False)
+
+    @cached_property
+    def batch_schedulers(self):
+        '''
+        A dictionary mapping each :class:`ai_redditor_service.models.RecordType`
+        to the :class:`ai_redditor_service.batching.BatchScheduler` in front
+        of its model. The requests are submitted along with their record type.
+
+        With a base model shared by the record types, a single scheduler batches the
+        requests of every record type, which are sampled in the same forward passes.
+
+        '''
+
+        window = current_app.config.get('GPT2_BATCH_WINDOW_MS', 50) / 1000
+        max_batch_size = current_app.config.get('GPT2_BATCH_MAX_SIZE', 8)
+
+        def _generate_batch(model_type, items):
+            # The model is looked up for every batch, so that the scheduler
+            # does not keep an evicted model resident.
+            model, tokenizer = self.models[model_type]
+            return gpt2_model_generate_batch(
+                model, tokenizer, _RECORD_GENERATE_CONFIGS[model_type].decode_format,
+                [request for _, request in items], **self.get_generate_kwargs(model_type)
+            )
+
+        def _generate_groups(items):
+            model, adapter_ids = self.base_model
+            model_types = list(dict.fromkeys(model_type for model_type, _ in items))
+
+            groups = []
+            for model_type in model_types:
+                kwargs = self.get_generate_kwargs(model_type)
+                groups.append(GenerationGroup(
+                    self.models[model_type][1], _RECORD_GENERATE_CONFIGS[model_type].decode_format,
+                    [request for item_type, request in items if item_type == model_type],
+                    adapter_id=adapter_ids[model_type], stats=kwargs['stats'],
+                    **{key: kwargs[key] for key in _GENERATION_GROUP_KWARGS}
+                ))
+
+            # Draft models are specific to the model of a single record type, so they are not used.
+            # The decode loops of a batch of a single record type are counted in its stats.
+            shared_kwargs = {key: kwargs[key] for key in _GENERATION_SHARED_KWARGS}
+            shared_kwargs['stats'] = groups[0].stats if len(groups) == 1 else self.mixed_generation_stats
+
+            results = {
+                model_type: iter(group_results) for model_type, group_results in
+                zip(model_types, gpt2_model_generate_groups(model, groups, **shared_kwargs))
+            }
+
+            return [next(results[model_type]) for model_type, _ in items]
+
+        if self.base_model_path is not None:
+            scheduler = BatchScheduler(_generate_groups, window=window, max_batch_size=max_batch_size)
+            return {model_type: scheduler for model_type in RecordType}
+
+        return LazyDict(lambda model_type: BatchScheduler(
+            functools.partial(_generate_batch, model_type),
+            window=window, max_batch_size=max_batch_size
+        ))
+
+    @cached_property
+    def reservoir_enabled(self):
+        '''
+        Indicates whether records requested with an empty prompt
+        are served from the reservoir of pre-generated records.
+
+        '''
+
+        return current_app.config.get('GPT2_RESERVOIR_ENABLED', False)
+
+    @cached_property
+    def dataset_fallback_enabled(self):
+        '''
+        Indicates whether requests with an empty prompt whose time budget runs out
+        are served a random dataset record when the reservoir is empty.
+
+        '''
+
+        return current_app.config.get('GPT2_TIME_BUDGET_DATASET_FALLBACK', True)
+
+    @cached_property
+    def reservoir_depth(self):
+        '''
+        The number of unserved records kept in the reservoir of each record type.
+
+        '''
+
+        return current_app.config.get('GPT2_RESERVOIR_DEPTH', 16)
+
+    @cached_property
+    def reservoir_low_water_mark(self):
+        '''
+        The depth below which a request served from the reservoir schedules its refill.
+
+        '''
+
+        return current_app.config.get('GPT2_RESERVOIR_LOW_WATER_MARK', 8)
+
+    @cached_property
+    def reservoir_refill_timeout(self):
+        '''
+        The time, in seconds, after which a refill of the reservoir that did not
+        finish is assumed to have failed, so that another refill can start.
+
+        '''
+
+        return current_app.config.get('GPT2_RESERVOIR_REFILL_TIMEOUT_SECONDS', 600)
+
+    @cached_property
+    def reservoir_refill_batch_size(self):
+        '''
+        The maximum number of records generated for the reservoir at once.
+
+        '''
+
+        return current_app.config.get('GPT2_RESERVOIR_REFILL_BATCH_SIZE', 8)
+
+    @cached_property
+    def stream_progress(self):
+        '''
+        Indicates whether the text of the records is streamed to the client
+        while they are being generated.
+
+        '''
+
+        return current_app.config.get('RECORD_GENERATION_STREAM_PROGRESS', True)
+
+    @cached_property
+    def progress_interval(self):
+        '''
+        The minimum time, in seconds, between two progress events of a task.
+
+        '''
+
+        return current_app.config.get('RECORD_GENERATION_PROGRESS_INTERVAL_MS', 100) / 1000
+
+    @cached_property
+    def phc_field_completion(self):
+        '''
+        The strategy used to complete the fields missing from PHC prompts
+        (see :mod:`ai_redditor_service.field_completion`).
+
+        '''
+
+        strategy = current_app.config.get('GPT2_PHC_FIELD_COMPLETION', 'decode')
+        if strategy not in FIELD_COMPLETION_STRATEGIES:
+            raise ValueError('Unknown field completion strategy \'{}\'. Must be one of: {}.'.format(
+                strategy, ', '.join(FIELD_COMPLETION_STRATEGIES)
+            ))
+
+        return strategy
+
+    @cached_property
+    def phc_field_distribution(self):
+        '''
+        The :class:`ai_redditor_service.field_completion.FieldDistribution` of the PHC
+        dataset records (computed with the "compute-field-distribution" command), or
+        None if it has not been computed.
+
+        '''
+
+        filepath = Path(current_app.instance_path) / current_app.config.get(
+            'GPT2_PHC_FIELD_DISTRIBUTION_FILENAME', 'phc_field_distribution.json'
+        )
+
+        if not filepath.is_file():
+            logger.warning('The PHC field distribution (\'{}\') does not exist; '
+                           'missing prompt fields are decoded instead.'.format(filepath))
+            return None
+
+        return FieldDistribution.load(filepath)
 
     @cached_property
     def log_debug_info(self):
@@ -191,65 +681,109 @@ class GPT2GenerateTask(SqlAlchemyTask):
 
         return current_app.config['RECORD_GENERATION_LOG_DEBUG_INFO']
 
-class RecordGenerateConfig:
+class GenerationProgress:
     '''
-    Configuration values for generating a record.
+    Forwards the text streamed while generating records to the SocketIO room
+    of a task as ``generate_record_progress`` events.
+
+    Chunks are buffered and emitted at most once per interval (or as soon as a
+    sequence is accepted or rejected), and the time to first token and the number
+    of tokens sampled per second are measured for the task.
 
     '''
 
-    def __init__(self, decode_format, group_to_record_func, min_length=250, max_length=1024):
-        self.decode_format = decode_format
-        self._group_to_record_func = group_to_record_func
-        self.min_length = min_length
-        self.max_length = max_length
+    def __init__(self, socketio, room, special_token_pattern, interval=0.1):
+        '''
+        Initializes an instance of :class:`GenerationProgress`.
+
+        :param socketio:
+            The :class:`flask_socketio.SocketIO` used to emit events.
+        :param room:
+            The SocketIO room to emit the events to (i.e. the id of the task).
+        :param special_token_pattern:
+            A compiled regular expression pattern matching special tokens, which
+            are replaced by line breaks in the streamed text.
+        :param interval:
+            The minimum time, in seconds, between two events. Defaults to 0.1 seconds.
 
-    def group_to_record(self, prompt_object, generated_groups, *args, **kwargs):  
-        return self._group_to_record_func(prompt_object, generated_groups, *args, **kwargs)
+        '''
 
-def _sanitize_likes(likes_str):
-    '''
-    Sanitize the likes group of the model output.
+        self.socketio = socketio
+        self.room = room
+        self.special_token_pattern = special_token_pattern
+        self.interval = interval
 
-    '''
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.tokens = 0
 
-    return int(re.sub('[^0-9-]', '', likes_str) or 0)
+        self._chunks = {}
+        self._rejected = []
+        self._accepted = []
+        self._last_emit_time = 0
+        self._lock = threading.Lock()
 
-def _is_field_missing(field, data):
-    return field not in data or not isinstance(data[field], int) and not bool(data.get(field, None))
+    @property
+    def stats(self):
+        '''
+        A dictionary containing the time to first token (in seconds) and
+        the number of tokens sampled per second, or None if no token was sampled.
 
-# Maps record type to a value configuration
-_RECORD_GENERATE_CONFIGS = {
-    RecordType.TIFU: RecordGenerateConfig(
-        ModelDecodeFormat.QUERY_ANSWER,
-        lambda prompt_object, generated_groups, *args, **kwargs: TIFURecord(
-            generated_groups['prompt'], generated_groups['response'],
-            post_title_prompt_end=len(prompt_object.get('post_title', '')),
-            post_body_prompt_end=len(prompt_object.get('post_body', '')),
-            *args, **kwargs
-        )
-    ),
-    RecordType.WP: RecordGenerateConfig(
-        ModelDecodeFormat.QUERY_ANSWER,
-        lambda prompt_object, generated_groups, *args, **kwargs: WPRecord(
-            generated_groups['prompt'], generated_groups['response'],
-            prompted_prompt_end=len(prompt_object.get('post_title', '')),
-            prompted_response_end=len(prompt_object.get('post_body', '')),
-            *args, **kwargs
+        '''
+
+        if self.first_token_time is None:
+            return {'time_to_first_token': None, 'tokens_per_second': None}
+
+        elapsed = time.time() - self.first_token_time
+        return {
+            'time_to_first_token': round(self.first_token_time - self.start_time, 3),
+            'tokens_per_second': round(self.tokens / elapsed, 1) if elapsed > 0 else None
+        }
+
+    def __call__(self, event):
+        with self._lock:
+            if self.first_token_time is None and event['tokens'] > 0:
+                self.first_token_time = time.time()
+
+            self.tokens += event['tokens']
+            for sequence, text in event['chunks'].items():
+                self._chunks[sequence] = self._chunks.get(sequence, '') + \
+                    self.special_token_pattern.sub('\n', text)
+
+            self._rejected += event['rejected']
+            self._accepted += event['accepted']
+            for sequence in event['rejected']:
+                self._chunks.pop(sequence, None)
+
+            is_due = time.time() - self._last_emit_time >= self.interval
+            if is_due or len(event['rejected']) > 0 or len(event['accepted']) > 0:
+                self._flush()
+
+    def flush(self):
+        '''
+        Emits the buffered chunks.
+
+        '''
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._chunks) == 0 and len(self._rejected) == 0 and len(self._accepted) == 0: return
+
+        self.socketio.emit(
+            'generate_record_progress', {
+                'chunks': self._chunks,
+                'rejected': self._rejected,
+                'accepted': self._accepted,
+                'stats': self.stats
+            },
+            namespace='/app',
+            room=self.room
         )
-    ),
-    RecordType.PHC: RecordGenerateConfig(
-        ModelDecodeFormat.PHC,
-        lambda prompt_object, generated_groups, *args, **kwargs: PHCRecord(
-            generated_groups['author'],
-            _sanitize_likes(generated_groups['likes']),
-            generated_groups['comment_body'],
-            prompted_author_username_end=len(prompt_object.get('author', '')),
-            is_likes_prompted=not _is_field_missing('likes', prompt_object),
-            prompted_comment_end=len(prompt_object.get('comment_body', '')),
-            *args, **kwargs
-        ), min_length=10, max_length=200
-    )
-}
+
+        self._chunks, self._rejected, self._accepted = {}, [], []
+        self._last_emit_time = time.time()
 
 # Prefix for each record type
 _RECORD_PROMPT_PREFIXES = {
@@ -257,9 +791,83 @@ _RECORD_PROMPT_PREFIXES = {
     RecordType.WP: '[WP] '
 }
 
-def _qa_prompt_to_string(record_type, prompt_object):
+def _generate(record_type, prompt, samples=1, use_link_filter=True, no_duplicates=False,
+              is_custom=None, stream_callback=None, deadline=None, **kwargs):
+    '''
+    Generates records from the model of the specified record type.
+
+    If batching is enabled, the request is coalesced with other concurrent
+    requests for the same model; requests with sampling arguments other than
+    the per-request ones (see :class:`ai_redditor_service.gpt2.GenerationRequest`)
+    bypass batching since they cannot share a batch.
+
+    '''
+
+    if generate_record.inference_client is not None:
+        return generate_record.inference_client.generate(
+            record_type, prompt, samples=samples,
+            use_link_filter=use_link_filter,
+            no_duplicates=no_duplicates,
+            is_custom=is_custom,
+            stream_callback=stream_callback,
+            deadline=deadline,
+            **kwargs
+        )
+
+    request = GenerationRequest(
+        prompt=prompt, samples=samples,
+        use_link_filter=use_link_filter,
+        no_duplicates=no_duplicates,
+        is_custom=is_custom,
+        stream_callback=stream_callback,
+        deadline=deadline
+    )
+
+    if generate_record.batching_enabled and len(kwargs) == 0:
+        return generate_record.batch_schedulers[record_type].submit((record_type, request))
+
+    record_config = _RECORD_GENERATE_CONFIGS[record_type]
+    model, tokenizer = generate_record.models[record_type]
+    return gpt2_model_generate_batch(
+        model, tokenizer, record_config.decode_format, [request],
+        **merge_dicts(generate_record.get_generate_kwargs(record_type), kwargs)
+    )[0]
+
+def _complete_fields(record_type, prompt, stop_token, deadline=None):
+    '''
+    Samples the fields that follow a prompt, up to a special token, with the
+    model of the specified record type.
+
+    :returns:
+        A list of completions (see :func:`ai_redditor_service.gpt2.complete_fields`).
+
+    '''
+
+    if generate_record.inference_client is not None:
+        return generate_record.inference_client.complete_fields(
+            record_type, prompt, stop_token, deadline=deadline
+        )
+
+    # Every sequence sampled with constrained decoding reaches the stop token,
+    # so there is no need to sample more than one.
+    num_sequences = 1 if generate_record.use_constrained_decoding else 4
+    max_new_tokens = current_app.config.get('GPT2_FIELD_COMPLETION_MAX_TOKENS', 32)
+    record_config = _RECORD_GENERATE_CONFIGS[record_type]
+    model, tokenizer = generate_record.models[record_type]
+    return gpt2_model_complete_fields(
+        model, tokenizer, record_config.decode_format, prompt, stop_token,
+        num_sequences=num_sequences, max_new_tokens=max_new_tokens,
+        translate_token=generate_record.translate_token,
+        end_of_likes_token=generate_record.end_of_likes_token,
+        prompt_cache=generate_record.prompt_caches[record_type],
+        use_constrained_decoding=generate_record.use_constrained_decoding,
+        stats=generate_record.generation_stats[record_type],
+        deadline=deadline
+    )
+
+def _qa_prompt_to_string(record_type, prompt_object, deadline=None):
     prompt_prefix = _RECORD_PROMPT_PREFIXES[record_type]
-    _, tokenizer = generate_record.models[record_type]
+    tokenizer = generate_record.tokenizers[record_type]
 
     # Check if the prompt object is empty or None; if so,
     # we simply provide the <|bos|> and prompt prefix as the
@@ -284,8 +892,92 @@ def _qa_prompt_to_string(record_type, prompt_object):
 
     return prompt    
 
-def _phc_prompt_to_string(record_type, prompt_object):
-    model, tokenizer = generate_record.models[record_type]
+def _get_phc_fields_prompt(prompt_object, missing_fields):
+    prompt = generate_record.tokenizers[RecordType.PHC].bos_token
+    if 'likes' not in missing_fields:
+        # Include the prompted likes, if given, to get more accurate field values.
+        prompt += str(prompt_object['likes']) + generate_record.end_of_likes_token
+
+    return prompt
+
+def _raise_field_completion_error(deadline):
+    if _is_expired(deadline):
+        raise GenerationTimeoutError('Could not generate the missing prompt fields within the time budget.')
+
+    raise ValueError('Could not generate the missing prompt fields.')
+
+def _generate_phc_fields(prompt_object, missing_fields, deadline=None):
+    '''
+    Completes the missing fields of a PHC prompt object by generating another record.
+
+    '''
+
+    outputs = _generate(
+        RecordType.PHC, _get_phc_fields_prompt(prompt_object, missing_fields), samples=1,
+        is_custom='likes' not in missing_fields, deadline=deadline
+    )
+
+    if len(outputs) == 0:
+        _raise_field_completion_error(deadline)
+
+    values = {field: outputs[0].groups[field] for field in missing_fields}
+    if 'likes' in values:
+        values['likes'] = _sanitize_likes(values['likes'])
+
+    return values
+
+def _decode_phc_fields(prompt_object, missing_fields, deadline=None):
+    '''
+    Completes the missing fields of a PHC prompt object by only decoding them.
+
+    '''
+
+    # The author field is followed by the translate token; the likes field by the end of likes token.
+    stop_token = generate_record.translate_token if 'author' in missing_fields \
+        else generate_record.end_of_likes_token
+
+    completions = _complete_fields(
+        RecordType.PHC, _get_phc_fields_prompt(prompt_object, missing_fields),
+        stop_token, deadline=deadline
+    )
+
+    for completion in completions:
+        values = {}
+        if 'likes' in missing_fields:
+            likes, _, completion = completion.partition(generate_record.end_of_likes_token)
+            values['likes'] = _sanitize_likes(likes)
+
+        if 'author' in missing_fields:
+            values['author'] = completion.strip()
+
+        # Without constrained decoding, a completion can have empty fields.
+        if all(not _is_field_missing(field, values) for field in missing_fields):
+            return values
+
+    _raise_field_completion_error(deadline)
+
+def _sample_phc_fields(prompt_object, missing_fields, deadline=None):
+    '''
+    Completes the missing fields of a PHC prompt object by sampling them from
+    their distribution in the dataset records, falling back to decoding them
+    if the distribution has not been computed.
+
+    '''
+
+    distribution = generate_record.phc_field_distribution
+    if distribution is None:
+        return _decode_phc_fields(prompt_object, missing_fields, deadline=deadline)
+
+    return {field: distribution.sample(field) for field in missing_fields}
+
+_PHC_FIELD_COMPLETION_FUNCS = {
+    'generate': _generate_phc_fields,
+    'decode': _decode_phc_fields,
+    'empirical': _sample_phc_fields
+}
+
+def _phc_prompt_to_string(record_type, prompt_object, deadline=None):
+    tokenizer = generate_record.tokenizers[record_type]
 
     # Check if the prompt object is empty or None, or if it contains
     # keys with all empty values. If so, we simply provide the <|bos|>
@@ -311,42 +1003,18 @@ def _phc_prompt_to_string(record_type, prompt_object):
         logger.warning(f'{required_fields} are required; {missing_fields} are missing.')
 
     if len(missing_fields) > 0:
-        # Generate another record to populate the missing fields
-        record_config = _RECORD_GENERATE_CONFIGS[RecordType.PHC]
-        decode_strict_regex_mapping = generate_record.decode_strict_regex_mapping[RecordType.PHC]
-        
-        prompt = tokenizer.bos_token
-        if 'likes' not in missing_fields:
-            # Include the prompted likes, if given, to get more accurate field values.
-            prompt += str(prompt_object['likes']) + generate_record.end_of_likes_token
-
+        strategy = generate_record.phc_field_completion
         start_time = time.time()
-        outputs = gpt2_model_generate(
-            model, tokenizer, record_config.decode_format,
-            translate_token=generate_record.translate_token,
-            end_of_likes_token=generate_record.end_of_likes_token,
-            min_length=record_config.min_length,
-            max_length=record_config.max_length,
-            decode_strict_regex_mapping=decode_strict_regex_mapping,
-            prompt=prompt, samples=1
-        )
+        values = _PHC_FIELD_COMPLETION_FUNCS[strategy](prompt_object, missing_fields, deadline=deadline)
 
         if generate_record.log_debug_info:
-            end_time = time.time()
-            logger.warning('Generating secondary record with prompt \'{}\'; took {:.2f} seconds'.format(
-                prompt, end_time - start_time
+            logger.warning('Completed the {} prompt fields ({}); took {:.2f} seconds'.format(
+                missing_fields, strategy, time.time() - start_time
             ))
 
         # Copy prompt object so that we only modify it within this function
         prompt_object = copy.copy(prompt_object)
-
-        # Populate the missing fields
-        for field in missing_fields:
-            value = outputs[0].groups[field]
-            if field == 'likes':
-                value = _sanitize_likes(value)
-            
-            prompt_object[field] = value
+        prompt_object.update(values)
 
     prompt = tokenizer.bos_token + str(prompt_object['likes'])
     if bool(prompt_object.get('author', None)):
@@ -363,17 +1031,20 @@ _PROMPT_OBJECT_TO_STRING = {
     RecordType.PHC: _phc_prompt_to_string
 }
 
-@celery.task(base=GPT2GenerateTask)
-def generate_record(record_type, prompt_object=None, **kwargs):
-    # Ensure SocketIO message queue url is loaded.
-    # Since the on_failure callback does not have access to the
-    # Flask app context and we need that to get the config, we do it
-    # here, where the app context is available.
-    socketio_message_queue = generate_record.socketio_message_queue
-    
-    record_config = _RECORD_GENERATE_CONFIGS[record_type]
-    model, tokenizer = generate_record.models[record_type]
+def _generate_records(record_type, prompt_object=None, stream_callback=None, deadline=None, **kwargs):
+    '''
+    Generates records from a prompt object and adds them to the database.
+
+    :param deadline:
+        The time (as returned by :func:`time.time`) by which generation stops.
+        Defaults to None, meaning that there is no deadline.
+
+    :returns:
+        A list of the UUIDs of the generated records.
+
+    '''
 
+    record_config = _RECORD_GENERATE_CONFIGS[record_type]
     if prompt_object is None:
         prompt_object = dict()
     
@@ -383,8 +1054,9 @@ def generate_record(record_type, prompt_object=None, **kwargs):
             for key, value in prompt_object.items()
     }
 
+    is_prompt_empty = not bool(prompt_object) or all_empty(prompt_object.values())
     # Convert the prompt object to a string
-    prompt = _PROMPT_OBJECT_TO_STRING[record_type](record_type, prompt_object)
+    prompt = _PROMPT_OBJECT_TO_STRING[record_type](record_type, prompt_object, deadline=deadline)
 
     use_link_filter = True
     is_custom = prompt is not None
@@ -394,16 +1066,10 @@ def generate_record(record_type, prompt_object=None, **kwargs):
         use_link_filter = len(PHC_LINK_PATTERN.findall(prompt)) == 0
 
     start_time = time.time()
-    decode_strict_regex_mapping = generate_record.decode_strict_regex_mapping[record_type]
-    outputs = gpt2_model_generate(
-        model, tokenizer, record_config.decode_format,
-        translate_token=generate_record.translate_token,
-        end_of_likes_token=generate_record.end_of_likes_token,
-        min_length=record_config.min_length,
-        max_length=record_config.max_length,
-        use_link_filter=use_link_filter,
-        decode_strict_regex_mapping=decode_strict_regex_mapping,
-        prompt=prompt, **kwargs
+    outputs = _generate(
+        record_type, prompt, use_link_filter=use_link_filter,
+        is_custom=not is_prompt_empty, stream_callback=stream_callback,
+        deadline=deadline, **kwargs
     )
 
     if generate_record.log_debug_info:
@@ -412,6 +1078,16 @@ def generate_record(record_type, prompt_object=None, **kwargs):
             prompt, end_time - start_time
         ))
 
+        if generate_record.inference_client is None:
+            logger.warning('{} generation stats: {}'.format(
+                RecordType(record_type).name, generate_record.generation_stats[record_type]
+            ))
+
+            if generate_record.base_model_path is not None:
+                logger.warning('Mixed batch generation stats: {}'.format(generate_record.mixed_generation_stats))
+
+            logger.warning('Model manager stats: {}'.format(generate_record.models.stats()))
+
     special_token_pattern = generate_record.special_tokens_match_pattern[record_type]
 
     record_uuids = []
@@ -421,15 +1097,122 @@ def generate_record(record_type, prompt_object=None, **kwargs):
             for key, value in output.groups.items()
         }
 
-        record = record_config.group_to_record(prompt_object, groups, is_custom=is_custom)
+        record = record_config.group_to_record(
+            prompt_object, groups, is_custom=is_custom,
+            content_hash=to_signed64(content_hash(output.groups))
+        )
         
+        try:
+            with db.session.begin_nested():
+                db.session.add(record)
+        except IntegrityError:
+            # Another worker stored an identical record after it was checked against the
+            # dedup index; serve that record rather than storing a duplicate.
+            record = type(record).query.filter_by(content_hash=record.content_hash).one()
+
         record_uuids.append(record.uuid)
-        db.session.add(record)
 
     db.session.commit()
+    return record_uuids
+
+def _get_fallback_records(record_type, samples):
+    '''
+    Gets records to serve in place of records generated from an empty prompt,
+    once the time budget of a request has run out: records from the reservoir,
+    then (if enabled) random dataset records.
+
+    :returns:
+        A list of the UUIDs of at most ``samples`` records.
+
+    '''
+
+    record_uuids = []
+    if generate_record.reservoir_enabled:
+        record_uuids = ReservoirRecord.pop_n(record_type, samples)
+        ReservoirStats.increment(record_type, hits=len(record_uuids))
+
+    if len(record_uuids) < samples and generate_record.dataset_fallback_enabled:
+        records = RECORD_MODEL_CLASSES[record_type].select_random_n(
+            samples - len(record_uuids), is_custom=False, is_generated=False
+        )
+
+        record_uuids += [record.uuid for record in records or []]
+
+    return record_uuids
+
+@celery.task(base=GPT2GenerateTask)
+def generate_record(record_type, prompt_object=None, **kwargs):
+    # Ensure SocketIO message queue url is loaded.
+    # Since the on_failure callback does not have access to the
+    # Flask app context and we need that to get the config, we do it
+    # here, where the app context is available.
+    socketio_message_queue = generate_record.socketio_message_queue
+
+    record_uuids = []
+    samples = kwargs.pop('samples', 1)
+    # The time (as returned by time.time()) by which the request must be served.
+    deadline = kwargs.pop('deadline', None)
+    if prompt_object is not None:
+        # Strip all prompt string values of trailing whitespace, so that a
+        # whitespace-only prompt is served as an empty prompt.
+        prompt_object = {
+            key: (value.strip() if isinstance(value, str) else value) \
+                for key, value in prompt_object.items()
+        }
+
+    is_prompt_empty = not bool(prompt_object) or all_empty(prompt_object.values())
+    if generate_record.reservoir_enabled and len(kwargs) == 0 and is_prompt_empty:
+        # Records generated from an empty prompt are interchangeable,
+        # so they can be served from the reservoir.
+        record_uuids = ReservoirRecord.pop_n(record_type, samples)
+        ReservoirStats.increment(
+            record_type, hits=len(record_uuids),
+            misses=samples - len(record_uuids)
+        )
+
+        if ReservoirRecord.depth(record_type) < generate_record.reservoir_low_water_mark and \
+           not ReservoirStats.is_refilling(record_type, generate_record.reservoir_refill_timeout):
+            refill_reservoir.delay(record_type)
+
+    socketio = SocketIO(message_queue=socketio_message_queue)
+    progress = None
+    # Fail fast if the request waited in the queue for its whole time budget.
+    if len(record_uuids) < samples and not _is_expired(deadline):
+        if generate_record.stream_progress:
+            progress = GenerationProgress(
+                socketio, generate_record.request.id,
+                generate_record.special_tokens_match_pattern[record_type],
+                interval=generate_record.progress_interval
+            )
+
+        record_uuids += _generate_records(
+            record_type, prompt_object, stream_callback=progress,
+            samples=samples - len(record_uuids), deadline=deadline,
+            **kwargs
+        )
+
+    if len(record_uuids) < samples and _is_expired(deadline):
+        # Records generated from an empty prompt are interchangeable, so the
+        # missing ones can be served from the fallbacks.
+        if is_prompt_empty:
+            record_uuids += _get_fallback_records(record_type, samples - len(record_uuids))
+
+        logger.warning('The time budget of a {} record generation ran out; serving {} of {} records'.format(
+            RecordType(record_type).name, len(record_uuids), samples
+        ))
+
+        if len(record_uuids) == 0:
+            raise GenerationTimeoutError('Could not generate a {} record within the time budget.'.format(
+                RecordType(record_type).name
+            ))
+
+    if progress is not None:
+        progress.flush()
+        logger.info('Streamed {} record generation: {}'.format(
+            RecordType(record_type).name, progress.stats
+        ))
     
     # Emit socket event
-    socketio = SocketIO(message_queue=socketio_message_queue)
     if len(record_uuids) > 0:
         event_data = {
             'records': [
@@ -444,6 +1227,9 @@ def generate_record(record_type, prompt_object=None, **kwargs):
             'error': 'Could not generate a record from the given prompt',
             'success': False
         }
+
+    if progress is not None:
+        event_data['stats'] = progress.stats
     
     socketio.emit(
         'generate_record_complete', event_data,
@@ -452,3 +1238,65 @@ def generate_record(record_type, prompt_object=None, **kwargs):
     )
 
     return record_type, record_uuids
+
+@celery.task(base=GPT2GenerateTask)
+def refill_reservoir(record_type):
+    '''
+    Generates records with an empty prompt until the reservoir of the
+    specified record type is full, or the refill batch size is reached.
+    Refills that are queued while another one is in progress do nothing.
+
+    :returns:
+        The number of records added to the reservoir.
+
+    '''
+
+    # Several refills may be queued for the same reservoir; only one runs at a time.
+    if not ReservoirStats.claim_refill(record_type, generate_record.reservoir_refill_timeout):
+        return 0
+
+    try:
+        samples = min(
+            generate_record.reservoir_depth - ReservoirRecord.depth(record_type),
+            generate_record.reservoir_refill_batch_size
+        )
+
+        if samples <= 0: return 0
+
+        start_time = time.time()
+        record_uuids = _generate_records(record_type, samples=samples)
+
+        # The reservoir may have been refilled otherwise (e.g. a refill whose claim timed out)
+        # while generating. The records that do not fit stay in the database as generated records.
+        depth = ReservoirRecord.depth(record_type)
+        record_uuids = record_uuids[:max(generate_record.reservoir_depth - depth, 0)]
+        for record_uuid in record_uuids:
+            db.session.add(ReservoirRecord(record_type=int(record_type), record_uuid=record_uuid))
+
+        db.session.commit()
+        ReservoirStats.increment(record_type, refilled=len(record_uuids))
+    finally:
+        # Discard a transaction left open by a failed refill before releasing the claim.
+        db.session.rollback()
+        ReservoirStats.release_refill(record_type)
+
+    logger.info('Refilled {} reservoir with {} records ({} seconds); depth is {}'.format(
+        RecordType(record_type).name, len(record_uuids),
+        round(time.time() - start_time, 2), depth + len(record_uuids)
+    ))
+
+    return len(record_uuids)
+
+@celery.task(base=SqlAlchemyTask)
+def refill_reservoirs():
+    '''
+    Queues a refill of the reservoir of every record type that is not full.
+    This task is run periodically by Celery beat.
+
+    '''
+
+    depth = current_app.config.get('GPT2_RESERVOIR_DEPTH', 16)
+    timeout = current_app.config.get('GPT2_RESERVOIR_REFILL_TIMEOUT_SECONDS', 600)
+    for record_type in RecordType:
+        if ReservoirRecord.depth(record_type) < depth and not ReservoirStats.is_refilling(record_type, timeout):
+            refill_reservoir.delay(record_type)
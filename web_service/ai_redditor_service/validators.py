@@ -0,0 +1,150 @@
+'''
+Validators that inspect sequences while they are being decoded, so that
+sequences which can no longer produce a valid record are dropped from the
+batch instead of being decoded to the maximum length.
+
+'''
+
+import torch
+
+class SequenceValidator:
+    '''
+    The base class for all sequence validators.
+
+    Rows are identified by their index in the batch given to :meth:`start`,
+    which stays the same even as other rows are dropped from the batch.
+
+    '''
+
+    def start(self, prompt_ids):
+        '''
+        Initializes the state of each row.
+
+        :param prompt_ids:
+            A list of 1-dimensional prompt token id tensors, one for each row.
+
+        '''
+
+        pass
+
+    def step(self, rows, next_tokens):
+        '''
+        Validates the token that was just sampled for each of the specified rows.
+
+        :param rows:
+            A list of row indices.
+        :param next_tokens:
+            A list of the token ids sampled for each row in ``rows``.
+        :returns:
+            A boolean tensor indicating, for each row in ``rows``,
+            whether the sequence is still valid.
+
+        '''
+
+        raise NotImplementedError()
+
+class SpecialTokenOrderValidator(SequenceValidator):
+    '''
+    Invalidates sequences whose special tokens deviate from the order of the decode format.
+
+    Every special token of the decode format must appear exactly once and directly
+    after the one preceding it in the format (e.g. ``<|bos|>``, ``<|eol|>``,
+    ``<|eq_tok|>``, ``<|eos|>`` for :var:`ai_redditor_service.gpt2.ModelDecodeFormat.PHC`).
+    A sequence that skips or repeats one of them is missing a match group.
+
+    '''
+
+    def __init__(self, special_token_ids):
+        '''
+        Initializes an instance of :class:`SpecialTokenOrderValidator`.
+
+        :param special_token_ids:
+            The ids of the special tokens, in order of appearance in the decode format.
+
+        '''
+
+        self.positions = {token_id: i for i, token_id in enumerate(special_token_ids)}
+        self._state = []
+
+    def start(self, prompt_ids):
+        self._state = []
+        for ids in prompt_ids:
+            # The position (in the decode format) of the last special token seen
+            position = -1
+            for token_id in ids.tolist():
+                position = self.positions.get(token_id, position)
+
+            self._state.append(position)
+
+    def step(self, rows, next_tokens):
+        is_valid = []
+        for row, token_id in zip(rows, next_tokens):
+            position = self.positions.get(token_id, None)
+            if position is not None:
+                if position != self._state[row] + 1:
+                    is_valid.append(False)
+                    continue
+
+                self._state[row] = position
+
+            is_valid.append(True)
+
+        return torch.tensor(is_valid, dtype=torch.bool)
+
+class LinkFilterValidator(SequenceValidator):
+    '''
+    Invalidates sequences as soon as their decoded text matches the link pattern.
+
+    Only the tail of the decoded text of each row is kept and searched, so the
+    cost per step does not grow with the sequence length.
+
+    '''
+
+    def __init__(self, tokenizer, pattern, rows=None, window=64):
+        '''
+        Initializes an instance of :class:`LinkFilterValidator`.
+
+        :param tokenizer:
+            The :class:`transformers.PreTrainedTokenizer` used to decode tokens.
+        :param pattern:
+            A compiled regular expression pattern matching links.
+        :param rows:
+            A collection of the row indices to filter. Defaults to None, meaning that
+            the filter is applied on all rows.
+        :param window:
+            The number of trailing characters of each row searched for a link.
+            This must be longer than the shortest match of the pattern. Defaults to 64.
+
+        '''
+
+        self.tokenizer = tokenizer
+        self.pattern = pattern
+        self.rows = set(rows) if rows is not None else None
+        self.window = window
+
+        self._token_text = {}
+        self._tails = []
+
+    def _decode_token(self, token_id):
+        if token_id not in self._token_text:
+            self._token_text[token_id] = self.tokenizer.decode([token_id])
+
+        return self._token_text[token_id]
+
+    def start(self, prompt_ids):
+        self._tails = [
+            self.tokenizer.decode(ids.tolist())[-self.window:] for ids in prompt_ids
+        ]
+
+    def step(self, rows, next_tokens):
+        is_valid = []
+        for row, token_id in zip(rows, next_tokens):
+            if self.rows is not None and row not in self.rows:
+                is_valid.append(True)
+                continue
+
+            tail = self._tails[row] + self._decode_token(token_id)
+            self._tails[row] = tail[-self.window:]
+            is_valid.append(self.pattern.search(tail) is None)
+
+        return torch.tensor(is_valid, dtype=torch.bool)
@@ -0,0 +1,191 @@
+'''
+Restricted output vocabularies, whose language modelling head only projects the hidden
+states onto the tokens that a model actually generates (e.g. the tokens of its training
+corpus), rather than onto the whole GPT2 vocabulary.
+
+A restricted vocabulary is saved as a file of the sorted ids of its tokens in the model
+directory (built with ``ai_redditor/gpt2/restrict_vocab.py``). It always keeps the special
+tokens and the byte-level tokens of the tokenizer, so that any text can still be spelled
+out. The sliced head scatters its logits back to their token ids, with the logits of the
+other tokens set to -inf, so that the rest of the decode loop is unchanged.
+
+'''
+
+import json
+import torch
+from pathlib import Path
+from collections import Counter
+
+# The name of the restricted vocabulary file in a model directory.
+VOCAB_FILENAME = 'restricted_vocab.json'
+
+def get_byte_token_ids(tokenizer):
+    '''
+    Gets the ids of the byte-level tokens of a byte-level BPE tokenizer (e.g. the
+    GPT2 tokenizer), which every other token can be decomposed into.
+
+    '''
+
+    byte_encoder = getattr(tokenizer, 'byte_encoder', None)
+    if byte_encoder is None:
+        return []
+
+    return tokenizer.convert_tokens_to_ids(list(byte_encoder.values()))
+
+def count_tokens(tokenizer, texts):
+    '''
+    Counts the occurrences of each token id in texts (including their special tokens).
+
+    :returns:
+        A :class:`collections.Counter` mapping each token id to its number of occurrences.
+
+    '''
+
+    counts = Counter()
+    for text in texts:
+        counts.update(tokenizer.encode(text, add_special_tokens=False))
+
+    return counts
+
+def build_vocabulary(tokenizer, token_counts, min_count=1, max_size=None):
+    '''
+    Builds a restricted vocabulary from the token counts of a corpus.
+
+    :param tokenizer:
+        The :class:`transformers.PreTrainedTokenizer` of the model.
+    :param token_counts:
+        A dictionary mapping each token id to its number of occurrences in the
+        corpus (see :func:`count_tokens`).
+    :param min_count:
+        The minimum number of occurrences of a corpus token to keep it. Defaults to 1.
+    :param max_size:
+        The maximum size of the vocabulary, including the special and byte-level tokens,
+        which are always kept. The most frequent corpus tokens fill the rest of it.
+        Defaults to None, meaning that every token with at least ``min_count``
+        occurrences is kept.
+    :returns:
+        A sorted list of the token ids of the vocabulary.
+
+    '''
+
+    token_ids = set(tokenizer.all_special_ids) | set(get_byte_token_ids(tokenizer))
+    if max_size is not None and max_size < len(token_ids):
+        raise ValueError('The vocabulary must have room for the {} special and byte-level tokens.'.format(
+            len(token_ids)
+        ))
+
+    for token_id, count in sorted(token_counts.items(), key=lambda x: (-x[1], x[0])):
+        if count < min_count or (max_size is not None and len(token_ids) >= max_size):
+            break
+
+        token_ids.add(token_id)
+
+    return sorted(token_ids)
+
+def get_coverage(token_counts, token_ids):
+    '''
+    Gets the fraction of the occurrences of tokens (given as a dictionary mapping each
+    token id to its number of occurrences) that are in a vocabulary.
+
+    '''
+
+    token_ids = set(token_ids)
+    total = sum(token_counts.values())
+    covered = sum(count for token_id, count in token_counts.items() if token_id in token_ids)
+    return covered / max(total, 1)
+
+def save_vocabulary(token_ids, vocab_size, output_path):
+    '''
+    Saves a restricted vocabulary to the vocabulary file of a model directory.
+
+    :param token_ids:
+        A sorted list of the token ids of the vocabulary.
+    :param vocab_size:
+        The size of the full vocabulary of the model.
+    :param output_path:
+        The model directory to save the vocabulary file in.
+    :returns:
+        The path of the vocabulary file.
+
+    '''
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    filepath = output_path / VOCAB_FILENAME
+    with open(filepath, 'w+') as file:
+        json.dump({'vocab_size': vocab_size, 'token_ids': list(token_ids)}, file)
+
+    return filepath
+
+def load_vocabulary(filepath):
+    '''
+    Loads a restricted vocabulary file.
+
+    :returns:
+        The size of the full vocabulary of the model and a sorted list
+        of the token ids of the restricted vocabulary.
+
+    '''
+
+    with open(filepath, 'r') as file:
+        data = json.load(file)
+
+    return data['vocab_size'], data['token_ids']
+
+class RestrictedLMHead(torch.nn.Module):
+    '''
+    A language modelling head that only computes the logits of the tokens of a
+    restricted vocabulary, and scatters them into logits over the full vocabulary
+    (in which the logits of the other tokens are -inf).
+
+    The projection is a :class:`torch.nn.Linear` layer, so that the head is
+    quantized along with the rest of the model (see :func:`torch.quantization.quantize_dynamic`).
+
+    '''
+
+    def __init__(self, lm_head, token_ids):
+        '''
+        Initializes an instance of :class:`RestrictedLMHead`.
+
+        :param lm_head:
+            The :class:`torch.nn.Linear` language modelling head of the model,
+            whose rows are selected. Its rows are copied; the original head, which
+            is tied to the input embeddings of the model, is left unchanged.
+        :param token_ids:
+            A sorted list of the token ids of the restricted vocabulary.
+
+        '''
+
+        super().__init__()
+        self.vocab_size = lm_head.weight.size(0)
+        self.register_buffer('token_ids', torch.tensor(token_ids, dtype=torch.long, device=lm_head.weight.device))
+
+        self.linear = torch.nn.Linear(lm_head.weight.size(1), len(token_ids), bias=lm_head.bias is not None)
+        self.linear.to(lm_head.weight.device, dtype=lm_head.weight.dtype)
+        with torch.no_grad():
+            self.linear.weight.copy_(lm_head.weight[self.token_ids])
+            if lm_head.bias is not None:
+                self.linear.bias.copy_(lm_head.bias[self.token_ids])
+
+    def forward(self, hidden_states):
+        logits = self.linear(hidden_states)
+        output = logits.new_full(logits.shape[:-1] + (self.vocab_size,), -float('inf'))
+        return output.index_copy_(-1, self.token_ids, logits)
+
+def restrict_vocabulary(model, token_ids):
+    '''
+    Replaces the language modelling head of a model by a head restricted to
+    a vocabulary (see :class:`RestrictedLMHead`). The model is modified in place.
+
+    :returns:
+        The model.
+
+    '''
+
+    vocab_size = model.lm_head.weight.size(0)
+    if len(token_ids) == 0 or min(token_ids) < 0 or max(token_ids) >= vocab_size:
+        raise ValueError('The token ids of the vocabulary must be between 0 and {}.'.format(vocab_size - 1))
+
+    model.lm_head = RestrictedLMHead(model.lm_head, token_ids)
+    return model
@@ -0,0 +1,149 @@
+'''
+Model warmup at Celery worker startup, so that the first tasks a worker
+receives do not wait for the models to load.
+
+With the prefork pool, the models are loaded in the parent process before
+it forks its child processes, which then share the model weights copy-on-write.
+Every child then runs dummy forward passes through the models before accepting
+tasks. The worker reports that it is ready once all of its children are warm.
+
+'''
+
+import time
+import multiprocessing
+import threading
+from pathlib import Path
+
+import torch
+from celery import signals
+from celery.utils import log
+from ai_redditor_service.gpt2 import warmup_model
+from ai_redditor_service.models import RecordType
+
+logger = log.get_logger(__name__)
+
+class WorkerWarmup:
+    '''
+    Connects the warmup to the signals of a Celery worker.
+
+    '''
+
+    def __init__(self, app, celery):
+        '''
+        Initializes an instance of :class:`WorkerWarmup`.
+
+        :param app:
+            The Flask app.
+        :param celery:
+            The :class:`celery.Celery` instance of the worker.
+
+        '''
+
+        self.app = app
+        self.batch_size = app.config.get('GPT2_WARMUP_BATCH_SIZE', 4)
+        self.preload = app.config.get('GPT2_WARMUP_PRELOAD', True)
+        ready_filepath = app.config.get('GPT2_WARMUP_READY_FILEPATH', None)
+        self.ready_filepath = Path(ready_filepath) if ready_filepath is not None else None
+
+        self.is_prefork = False
+        self.concurrency = 1
+        # The number of child processes that are warm, shared with the children.
+        self._warm_processes = None
+
+        # Child processes are killed if they do not start within this timeout,
+        # which has to account for the warmup.
+        celery.conf.worker_proc_alive_timeout = app.config.get('GPT2_WARMUP_TIMEOUT_SECONDS', 300)
+
+        # Sent once logging is set up, before the worker starts its pool.
+        signals.celeryd_after_setup.connect(self._on_worker_setup, weak=False)
+        signals.worker_process_init.connect(self._on_worker_process_init, weak=False)
+        signals.worker_ready.connect(self._on_worker_ready, weak=False)
+        signals.worker_shutdown.connect(self._on_worker_shutdown, weak=False)
+
+    @property
+    def _task(self):
+        from ai_redditor_service.tasks import generate_record
+        return generate_record
+
+    def _load_models(self):
+        start_time = time.time()
+        with self.app.app_context():
+            # Models that do not fit the memory budget are evicted as the others load.
+            for record_type in RecordType:
+                self._task.models[record_type]
+                self._task.draft_models[record_type]
+
+        logger.info('Loaded GPT2 models ({}) ({} seconds)'.format(
+            ', '.join(str(x) for x in self._task.models.keys()),
+            round(time.time() - start_time, 2)
+        ))
+
+    def _warmup_models(self):
+        start_time = time.time()
+        with self.app.app_context():
+            record_types = self._task.models.keys()
+            if len(record_types) == 0:
+                self._load_models()
+                record_types = self._task.models.keys()
+
+            for record_type in record_types:
+                model, tokenizer = self._task.models[record_type]
+                warmup_model(model, tokenizer, batch_size=self.batch_size)
+                if self._task.draft_models[record_type] is not None:
+                    warmup_model(self._task.draft_models[record_type], tokenizer, batch_size=self.batch_size)
+
+        logger.info('Warmed up GPT2 models ({}) ({} seconds)'.format(
+            ', '.join(str(x) for x in record_types),
+            round(time.time() - start_time, 2)
+        ))
+
+    def _report_ready(self):
+        logger.info('Worker is ready')
+        if self.ready_filepath is not None:
+            self.ready_filepath.parent.mkdir(parents=True, exist_ok=True)
+            self.ready_filepath.touch()
+
+    def _wait_for_processes(self):
+        while self._warm_processes.value < self.concurrency:
+            time.sleep(0.1)
+
+        self._report_ready()
+
+    def _on_worker_setup(self, instance=None, **kwargs):
+        if self.ready_filepath is not None and self.ready_filepath.exists():
+            self.ready_filepath.unlink()
+
+        self.is_prefork = 'prefork' in str(instance.pool_cls).lower()
+        if not self.is_prefork:
+            # Other pools run tasks in this process (solo) or its threads.
+            self._warmup_models()
+            return
+
+        self.concurrency = instance.concurrency
+        self._warm_processes = multiprocessing.Value('i', 0)
+        # CUDA cannot be used in a forked process once it was initialized in its
+        # parent, so the models are then loaded by each child instead.
+        uses_cuda = torch.cuda.is_available() and not self.app.config.get('GPT2_NO_CUDA', False)
+        if self.preload and not uses_cuda:
+            self._load_models()
+
+    def _on_worker_process_init(self, **kwargs):
+        # The solo pool also sends this signal, from the worker process itself.
+        if not self.is_prefork: return
+
+        # The forward passes run in the children only, since the parent
+        # should not use the intra-op thread pool before forking.
+        self._warmup_models()
+        with self._warm_processes.get_lock():
+            self._warm_processes.value += 1
+
+    def _on_worker_ready(self, **kwargs):
+        if not self.is_prefork:
+            self._report_ready()
+            return
+
+        threading.Thread(target=self._wait_for_processes, daemon=True).start()
+
+    def _on_worker_shutdown(self, **kwargs):
+        if self.ready_filepath is not None and self.ready_filepath.exists():
+            self.ready_filepath.unlink()
@@ -0,0 +1,193 @@
+'''
+A flat weight file format whose tensors are memory mapped when loading, so that
+every process on a node that loads the same model shares its weights.
+
+The format is the safetensors layout: an 8-byte little-endian header size, a JSON
+header mapping each tensor name to its dtype, shape and byte offsets, and then the
+raw (little-endian, contiguous) data of every tensor.
+
+'''
+
+import json
+import mmap
+import struct
+import numpy as np
+import torch
+from pathlib import Path
+
+# The name of the weight file in a model directory.
+WEIGHTS_FILENAME = 'model.safetensors'
+
+_DTYPES = {
+    torch.float64: ('F64', np.float64),
+    torch.float32: ('F32', np.float32),
+    torch.float16: ('F16', np.float16),
+    torch.int64: ('I64', np.int64),
+    torch.int32: ('I32', np.int32),
+    torch.int16: ('I16', np.int16),
+    torch.int8: ('I8', np.int8),
+    torch.uint8: ('U8', np.uint8),
+    torch.bool: ('BOOL', np.bool_)
+}
+
+_NUMPY_DTYPES = {name: numpy_dtype for name, numpy_dtype in _DTYPES.values()}
+
+def save_weights(state_dict, filepath):
+    '''
+    Saves tensors to a weight file.
+
+    Tensors that share their storage with a previous tensor (e.g. tied input and
+    output embeddings) are only saved once, under the name they first appear with.
+
+    :param state_dict:
+        A dictionary mapping names to :class:`torch.Tensor` instances.
+    :param filepath:
+        The path of the weight file.
+    :returns:
+        A list of the names of the tensors that were skipped as shared.
+
+    '''
+
+    header = {'__metadata__': {'format': 'pt'}}
+    tensors, skipped, data_ptrs = [], [], set()
+    offset = 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in _DTYPES:
+            raise ValueError('Tensor \'{}\' has an unsupported dtype ({}).'.format(name, tensor.dtype))
+
+        if tensor.numel() > 0 and tensor.data_ptr() in data_ptrs:
+            skipped.append(name)
+            continue
+
+        data_ptrs.add(tensor.data_ptr())
+        data = tensor.detach().cpu().contiguous().numpy().astype(
+            np.dtype(_DTYPES[tensor.dtype][1]).newbyteorder('<'), copy=False
+        ).tobytes()
+
+        header[name] = {
+            'dtype': _DTYPES[tensor.dtype][0],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + len(data)]
+        }
+
+        tensors.append(data)
+        offset += len(data)
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # Pad the header so that the tensor data is 8-byte aligned.
+    header += b' ' * (-len(header) % 8)
+    with open(filepath, 'wb') as file:
+        file.write(struct.pack('<Q', len(header)))
+        file.write(header)
+        for data in tensors:
+            file.write(data)
+
+    return skipped
+
+def load_weights(filepath):
+    '''
+    Loads the tensors of a weight file by memory mapping it.
+
+    The file is mapped copy-on-write: its pages are shared (through the page cache)
+    with every other process mapping it, for as long as they are not written to.
+    Writing to a tensor only copies the pages written to, and never modifies the file.
+
+    :param filepath:
+        The path of the weight file.
+    :returns:
+        A dictionary mapping names to :class:`torch.Tensor` instances.
+
+    '''
+
+    with open(filepath, 'rb') as file:
+        header_size, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(header_size).decode('utf-8'))
+        # The mapping remains valid after the file is closed.
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_offset = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__': continue
+
+        dtype = np.dtype(_NUMPY_DTYPES[info['dtype']]).newbyteorder('<')
+        begin, end = info['data_offsets']
+        array = np.frombuffer(
+            buffer, dtype=dtype, count=(end - begin) // dtype.itemsize,
+            offset=data_offset + begin
+        )
+
+        tensors[name] = torch.from_numpy(array).view(info['shape'])
+
+    return tensors
+
+def load_weights_into(model, filepath):
+    '''
+    Replaces the parameters and buffers of a model with the (memory mapped)
+    tensors of a weight file.
+
+    :param model:
+        The :class:`torch.nn.Module` to load the weights into.
+    :param filepath:
+        The path of the weight file.
+    :returns:
+        A list of the names of the parameters of the model that were not in the
+        weight file. Buffers that are not in the weight file keep their value.
+
+    '''
+
+    tensors = load_weights(filepath)
+    missing = []
+    # Parameters shared by several modules (e.g. tied embeddings) are only listed once.
+    named_buffers = list(model.named_buffers())
+    for name, value in list(model.named_parameters()) + named_buffers:
+        if name not in tensors:
+            if not any(value is buffer for _, buffer in named_buffers):
+                missing.append(name)
+
+            continue
+
+        tensor = tensors.pop(name)
+        if tensor.shape != value.shape:
+            raise ValueError('Tensor \'{}\' has shape {} in \'{}\' but {} in the model.'.format(
+                name, tuple(tensor.shape), filepath, tuple(value.shape)
+            ))
+
+        # Swapping the data releases the tensor allocated when the model was created.
+        value.data = tensor
+
+    if len(tensors) > 0:
+        raise ValueError('\'{}\' has tensors that are not in the model: {}'.format(
+            filepath, ', '.join(tensors.keys())
+        ))
+
+    return missing
+
+def convert_model(model_path, output_path=None):
+    '''
+    Converts a pretrained model checkpoint to a weight file.
+
+    :param model_path:
+        The path to the pretrained model checkpoint.
+    :param output_path:
+        The directory to save the weight file in. Defaults to None, meaning the
+        model checkpoint directory. If this is another directory, the model
+        configuration is saved along with the weight file.
+    :returns:
+        The path of the weight file.
+
+    '''
+
+    from transformers import AutoModelWithLMHead
+
+    model_path = Path(model_path)
+    output_path = Path(output_path) if output_path is not None else model_path
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    model = AutoModelWithLMHead.from_pretrained(str(model_path))
+    if output_path != model_path:
+        model.config.save_pretrained(str(output_path))
+
+    filepath = output_path / WEIGHTS_FILENAME
+    save_weights(model.state_dict(), filepath)
+    return filepath
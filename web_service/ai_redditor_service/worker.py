@@ -6,5 +6,12 @@ Celery worker module.
 from ai_redditor_service import create_app
 from ai_redditor_service.extensions import _init_celery
 
+app = create_app()
 # Initialize celery instance with flask app
-celery = _init_celery(create_app())
\ No newline at end of file
+celery = _init_celery(app)
+
+# Workers only load the models when there is no inference server.
+if app.config.get('GPT2_WARMUP_ENABLED', True) and \
+    app.config.get('GPT2_INFERENCE_SERVER_URL', None) is None:
+    from ai_redditor_service.warmup import WorkerWarmup
+    WorkerWarmup(app, celery)
\ No newline at end of file
@@ -0,0 +1,64 @@
+'''
+Measures the occupancy of the decode batch (the fraction of its slots computing an
+unfinished sequence) at each decode step, and the decode throughput, when sampling
+sequences of a record type with different maximum batch sizes ("GPT2_MAX_DECODE_BATCH_SIZE").
+
+Finished sequences leave the decode batch after every step; with a maximum batch size
+smaller than the number of sequences, the waiting sequences take their slots.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_compaction.py ...
+
+'''
+
+import time
+import argparse
+
+import torch
+
+from ai_redditor_service.models import RecordType
+from ai_redditor_service.shared import _RECORD_GENERATE_CONFIGS
+from ai_redditor_service.gpt2 import load_model, GenerationStats, _sample
+
+parser = argparse.ArgumentParser(description='Benchmarks the occupancy of the decode batch.')
+parser.add_argument('model_path', type=str, help='The path to the pretrained model checkpoint.')
+parser.add_argument('record_type', type=str, choices=[x.name for x in RecordType],
+                    help='The record type whose lengths the sequences are sampled with.')
+parser.add_argument('--sequences', type=int, default=32, help='The number of sequences to sample. Defaults to 32.')
+parser.add_argument('--max-batch-sizes', type=int, nargs='+', default=[0, 16, 8],
+                    help='The maximum batch sizes to compare (0 meaning all sequences at once). Defaults to 0, 16 and 8.')
+parser.add_argument('--max-length', type=int, default=None,
+                    help='The maximum length of a sequence. Defaults to the maximum length of the record type.')
+parser.add_argument('--buckets', type=int, default=10, help='The number of step ranges the occupancy is reported for. Defaults to 10.')
+parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+parser.add_argument('--no-cuda', action='store_true', help='Disable CUDA devices even when they are available.')
+args = parser.parse_args()
+
+record_config = _RECORD_GENERATE_CONFIGS[RecordType[args.record_type]]
+model, tokenizer = load_model(args.model_path, no_cuda=args.no_cuda)
+prompt_ids = [tokenizer.encode(tokenizer.bos_token, return_tensors='pt')[0].to(model.device)] * args.sequences
+
+for max_batch_size in args.max_batch_sizes:
+    capacity = min(max_batch_size or args.sequences, args.sequences)
+    stats = GenerationStats()
+    # The number of sequences that sampled a token at each step.
+    step_rows = []
+
+    torch.manual_seed(args.seed)
+    start_time = time.time()
+    _sample(
+        model, prompt_ids, tokenizer.eos_token_id, tokenizer.pad_token_id,
+        min_length=record_config.min_length, max_length=args.max_length or record_config.max_length,
+        stats=stats, step_callback=lambda rows, tokens, aborted: step_rows.append(len(rows)),
+        max_batch_size=max_batch_size or None
+    )
+
+    elapsed = time.time() - start_time
+    print('- maximum batch size {}: {} steps, {:.1f} tokens/s, {:.1%} occupancy'.format(
+        capacity, len(step_rows), sum(step_rows) / elapsed, stats.occupancy
+    ))
+
+    bucket_size = max(len(step_rows) // args.buckets, 1)
+    for i in range(0, len(step_rows), bucket_size):
+        rows = step_rows[i:i + bucket_size]
+        print('  steps {}-{}: {:.1%}'.format(i, i + len(rows) - 1, sum(rows) / (len(rows) * capacity)))
@@ -0,0 +1,74 @@
+'''
+Compares the decode throughput of the inference engines (see
+:mod:`ai_redditor_service.engines`) on a model, and the largest difference
+between the logits of each exported model and the eager PyTorch model.
+
+The models have to be exported first with the "export-engine" command.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_engines.py ...
+
+'''
+
+import time
+import argparse
+
+import torch
+
+from ai_redditor_service.gpt2 import load_model, _model_forward
+
+parser = argparse.ArgumentParser(description='Benchmarks the inference engines.')
+parser.add_argument('model_path', type=str, help='The path to the pretrained model checkpoint (with its exported models).')
+parser.add_argument('--engines', type=str, nargs='+', default=['torch', 'torchscript', 'onnx'],
+                    choices=['torch', 'torchscript', 'onnx'], help='The engines to benchmark. Defaults to all.')
+parser.add_argument('--batch-size', type=int, default=8, help='The number of sequences per batch. Defaults to 8.')
+parser.add_argument('--prompt-length', type=int, default=32, help='The number of prompt tokens. Defaults to 32.')
+parser.add_argument('--steps', type=int, default=64, help='The number of decode steps. Defaults to 64.')
+parser.add_argument('--runs', type=int, default=3, help='The number of runs per engine. Defaults to 3.')
+parser.add_argument('--seed', type=int, default=0, help='The seed of the prompt tokens. Defaults to 0.')
+args = parser.parse_args()
+
+@torch.no_grad()
+def _decode(model, input_ids):
+    '''
+    Encodes the prompt and greedily decodes from it.
+
+    :returns:
+        The logits of the prompt, and the time taken by the prompt and by the decode steps.
+
+    '''
+
+    start_time = time.time()
+    logits, past = _model_forward(model, input_ids)
+    prompt_time = time.time() - start_time
+
+    prompt_logits = logits
+    start_time = time.time()
+    for _ in range(args.steps):
+        next_tokens = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+        logits, past = _model_forward(model, next_tokens, past=past)
+
+    return prompt_logits, prompt_time, time.time() - start_time
+
+reference_logits = None
+for engine in args.engines:
+    model, tokenizer = load_model(args.model_path, no_cuda=True, engine=engine)
+    # The same prompt tokens for every engine.
+    torch.manual_seed(args.seed)
+    input_ids = torch.randint(len(tokenizer), (args.batch_size, args.prompt_length))
+
+    # The first run warms up the engine.
+    results = [_decode(model, input_ids) for _ in range(args.runs + 1)][1:]
+    logits = results[0][0]
+    prompt_time = min(result[1] for result in results)
+    decode_time = min(result[2] for result in results)
+
+    if reference_logits is None:
+        reference_logits = logits
+        difference = 0
+    else:
+        difference = (logits - reference_logits).abs().max().item()
+
+    print('- {}: prompt {:.1f} ms, decode {:.1f} tokens/s, max logit difference {:.2e}'.format(
+        engine, prompt_time * 1000, args.batch_size * args.steps / decode_time, difference
+    ))
@@ -0,0 +1,135 @@
+'''
+Compares the accuracy and decode throughput of a model loaded with each precision:
+float32, bfloat16, dynamically quantized int8 ("GPT2_QUANTIZE") and, optionally, a
+statically quantized int8 model (created with "ai_redditor/gpt2/quantize.py").
+
+Accuracy is measured on the samples of a preprocessed dataset file (e.g. a "*_test"
+file): the perplexity of each model, and how often its most likely next token agrees
+with the one of the float32 model.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_precision.py ...
+
+'''
+
+import math
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+
+import torch
+
+from ai_redditor_service.gpt2 import load_model, get_model_nbytes, _model_forward
+
+parser = argparse.ArgumentParser(description='Benchmarks the accuracy and throughput of each model precision.')
+parser.add_argument('model_path', type=str, help='The path to the pretrained model checkpoint.')
+parser.add_argument('dataset', type=Path, help='The preprocessed dataset file (one sample per line) to measure accuracy on.')
+parser.add_argument('--static-int8-path', type=str, default=None,
+                    help='The output directory of "ai_redditor/gpt2/quantize.py" for the model, to also compare.')
+parser.add_argument('--samples', type=int, default=256, help='The number of dataset samples. Defaults to 256.')
+parser.add_argument('--max-tokens', type=int, default=256, help='The maximum number of tokens per sample. Defaults to 256.')
+parser.add_argument('--batch-size', type=int, default=8, help='The number of sequences per batch. Defaults to 8.')
+parser.add_argument('--steps', type=int, default=64, help='The number of decode steps when measuring throughput. Defaults to 64.')
+parser.add_argument('--runs', type=int, default=3, help='The number of throughput runs per model. Defaults to 3.')
+parser.add_argument('--seed', type=int, default=0, help='The seed used to select the samples. Defaults to 0.')
+parser.add_argument('--output', type=Path, default=None, help='A JSON file to write the report to.')
+args = parser.parse_args()
+
+_VARIANTS = [
+    ('float32', dict(precision='float32')),
+    ('bfloat16', dict(precision='bfloat16')),
+    ('int8-dynamic', dict(quantize=True))
+]
+
+if args.static_int8_path is not None:
+    _VARIANTS.append(('int8-static', dict(engine='torchscript')))
+
+@torch.no_grad()
+def _evaluate(model, batches):
+    '''
+    Computes the log-likelihood of the dataset samples, and the most
+    likely next token at each of their positions.
+
+    '''
+
+    log_likelihood, num_tokens, predictions = 0, 0, []
+    for input_ids, attention_mask in batches:
+        logits = model(input_ids, attention_mask=attention_mask)[0][:, :-1].float()
+        mask = attention_mask[:, 1:].bool()
+        log_probs = torch.log_softmax(logits, dim=-1).gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+        log_likelihood += log_probs[mask].sum().item()
+        num_tokens += mask.sum().item()
+        predictions.append(logits.argmax(dim=-1)[mask])
+
+    return math.exp(-log_likelihood / max(num_tokens, 1)), torch.cat(predictions)
+
+@torch.no_grad()
+def _get_throughput(model, vocab_size):
+    torch.manual_seed(args.seed)
+    input_ids = torch.randint(vocab_size, (args.batch_size, 32))
+    timings = []
+    # The first run warms up the model.
+    for _ in range(args.runs + 1):
+        logits, past = _model_forward(model, input_ids)
+        start_time = time.time()
+        for _ in range(args.steps):
+            next_tokens = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+            logits, past = _model_forward(model, next_tokens, past=past)
+
+        timings.append(time.time() - start_time)
+
+    return args.batch_size * args.steps / min(timings[1:])
+
+with open(args.dataset, 'r', encoding='utf-8') as file:
+    samples = [line.rstrip('\n') for line in file if line.strip()]
+
+if args.samples < len(samples):
+    samples = random.Random(args.seed).sample(samples, args.samples)
+
+report = {}
+reference_predictions = None
+for name, kwargs in _VARIANTS:
+    model_path = args.static_int8_path if name == 'int8-static' else args.model_path
+    try:
+        model, tokenizer = load_model(model_path, no_cuda=True, **kwargs)
+    except Exception as exception:
+        print('- {}: could not load the model ({})'.format(name, exception))
+        continue
+
+    if reference_predictions is None:
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        token_ids = sorted((
+            x for x in (tokenizer.encode(text, add_special_tokens=False)[:args.max_tokens] for text in samples)
+            if len(x) > 1
+        ), key=len)
+
+        batches = []
+        for i in range(0, len(token_ids), args.batch_size):
+            batch = token_ids[i:i + args.batch_size]
+            max_length = max(len(x) for x in batch)
+            batches.append((
+                torch.tensor([x + [pad_token_id] * (max_length - len(x)) for x in batch], dtype=torch.long),
+                torch.tensor([[1] * len(x) + [0] * (max_length - len(x)) for x in batch], dtype=torch.long)
+            ))
+
+    perplexity, predictions = _evaluate(model, batches)
+    if reference_predictions is None:
+        reference_predictions = predictions
+
+    report[name] = {
+        'perplexity': perplexity,
+        'top1_agreement': (predictions == reference_predictions).float().mean().item(),
+        'tokens_per_second': _get_throughput(model, len(tokenizer)),
+        'megabytes': get_model_nbytes(model) / 1024 ** 2
+    }
+
+    print('- {}: perplexity {:.3f}, top-1 agreement {:.2%}, {:.1f} tokens/s, {:.1f} MB'.format(
+        name, report[name]['perplexity'], report[name]['top1_agreement'],
+        report[name]['tokens_per_second'], report[name]['megabytes']
+    ))
+
+if args.output is not None:
+    with open(args.output, 'w+') as file:
+        json.dump(report, file, indent=4)
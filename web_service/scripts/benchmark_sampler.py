@@ -0,0 +1,84 @@
+'''
+Measures the cost per decode step of sampling the next tokens of a batch with the
+top-k/top-p sampler of the decode loop (which only exponentiates and samples from the
+top-k scores of each row), compared to filtering the scores over the whole vocabulary
+and sampling from their softmax.
+
+The scores are random logits over a vocabulary of the size of the GPT2 vocabulary (with
+the special tokens of the models). Both samplers are also run on a single row repeated
+many times, and the total variation distance between their token frequencies is reported
+to check that they sample from the same distribution.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_sampler.py
+
+'''
+
+import time
+import argparse
+
+import torch
+
+from ai_redditor_service.gpt2 import _TopKSampler, _filter_top_k_top_p
+
+parser = argparse.ArgumentParser(description='Benchmarks the cost per decode step of sampling the next tokens.')
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                    help='The batch sizes to compare. Defaults to 1, 2, 4, 8, 16 and 32.')
+parser.add_argument('--vocab-size', type=int, default=50262, help='The size of the vocabulary. Defaults to 50262.')
+parser.add_argument('--top-k', type=int, default=300, help='The top-k filtering of sampling. Defaults to 300.')
+parser.add_argument('--top-p', type=float, default=1, help='The top-p filtering of sampling. Defaults to 1.')
+parser.add_argument('--steps', type=int, default=200, help='The number of decode steps timed per batch size. Defaults to 200.')
+parser.add_argument('--samples', type=int, default=20000,
+                    help='The number of tokens sampled by each sampler to compare their distributions. Defaults to 20000.')
+parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+parser.add_argument('--no-cuda', action='store_true', help='Disable CUDA devices even when they are available.')
+args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+
+def _sample_reference(scores):
+    scores = _filter_top_k_top_p(scores.float(), top_k=args.top_k, top_p=args.top_p)
+    return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+
+def _time_per_step(sample, scores):
+    # Warm up the allocator (and the buffers of the sampler).
+    sample(scores)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        sample(scores)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start_time) / args.steps
+
+torch.manual_seed(args.seed)
+sampler = _TopKSampler(args.top_k, args.top_p)
+print('Sampling with top_k={}, top_p={} over {} tokens ({}):'.format(args.top_k, args.top_p, args.vocab_size, device))
+for batch_size in args.batch_sizes:
+    # Logits with roughly the spread of the logits of a finetuned GPT2 model.
+    scores = torch.randn(batch_size, args.vocab_size, device=device) * 4
+    reference_time = _time_per_step(_sample_reference, scores)
+    sampler_time = _time_per_step(sampler.sample, scores)
+    print('- batch size {}: {:.1f} us/step (reference {:.1f} us/step, {:.2f}x)'.format(
+        batch_size, sampler_time * 1e6, reference_time * 1e6, reference_time / sampler_time
+    ))
+
+scores = (torch.randn(1, args.vocab_size, device=device) * 4).expand(args.samples, -1)
+frequencies = [
+    torch.bincount(sample(scores), minlength=args.vocab_size).float() / args.samples
+    for sample in (_sample_reference, _TopKSampler(args.top_k, args.top_p).sample)
+]
+
+print('Total variation distance between the token frequencies of {} samples: {:.4f}'.format(
+    args.samples, (frequencies[0] - frequencies[1]).abs().sum().item() / 2
+))
+
+torch.manual_seed(args.seed)
+first = _TopKSampler(args.top_k, args.top_p).sample(scores)
+torch.manual_seed(args.seed)
+second = _TopKSampler(args.top_k, args.top_p).sample(scores)
+print('Same tokens under the same seed: {}'.format(torch.equal(first, second)))
@@ -0,0 +1,71 @@
+'''
+Measures speculative decoding on each corpus: the rate at which the proposals of the
+draft model are accepted, the number of accepted tokens per verification step of the
+model, and the speedup over sampling one token per forward pass.
+
+Each corpus is given as its record type (TIFU, WP or PHC), the path to its model and
+the path to its draft model (created with the "build-draft-model" command).
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_speculative.py ...
+
+'''
+
+import time
+import argparse
+
+import torch
+
+from ai_redditor_service.models import RecordType
+from ai_redditor_service.shared import _RECORD_GENERATE_CONFIGS
+from ai_redditor_service.gpt2 import load_model, generate_batch, GenerationRequest, GenerationStats
+
+parser = argparse.ArgumentParser(description='Benchmarks speculative decoding with a draft model on each corpus.')
+parser.add_argument('--corpus', type=str, nargs=3, action='append', required=True,
+                    metavar=('RECORD_TYPE', 'MODEL_PATH', 'DRAFT_MODEL_PATH'),
+                    help='The record type of a corpus, the path to its model and the path to its draft model.')
+parser.add_argument('--num-draft-tokens', type=int, nargs='+', default=[2, 4, 6],
+                    help='The numbers of tokens proposed per step to compare. Defaults to 2, 4 and 6.')
+parser.add_argument('--samples', type=int, default=8, help='The number of sequences sampled per run. Defaults to 8.')
+parser.add_argument('--top-k', type=int, default=300, help='The top-k filtering of sampling. Defaults to 300.')
+parser.add_argument('--top-p', type=float, default=1, help='The top-p filtering of sampling. Defaults to 1.')
+parser.add_argument('--max-length', type=int, default=None,
+                    help='The maximum length of a sequence. Defaults to the maximum length of the record type.')
+parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+parser.add_argument('--no-constrained-decoding', action='store_true', help='Sample without the grammar of the decode format.')
+parser.add_argument('--no-cuda', action='store_true', help='Disable CUDA devices even when they are available.')
+args = parser.parse_args()
+
+def _run(model, tokenizer, record_config, draft_model=None, num_draft_tokens=4):
+    stats = GenerationStats()
+    torch.manual_seed(args.seed)
+    start_time = time.time()
+    # A single iteration that samples every sequence, whether or not it is a valid record.
+    generate_batch(
+        model, tokenizer, record_config.decode_format, [GenerationRequest(samples=args.samples)],
+        top_k=args.top_k, top_p=args.top_p, num_return_sequences=args.samples, max_iterations=0,
+        min_length=record_config.min_length, max_length=args.max_length or record_config.max_length,
+        use_constrained_decoding=not args.no_constrained_decoding, stats=stats,
+        draft_model=draft_model, num_draft_tokens=num_draft_tokens
+    )
+
+    return time.time() - start_time, stats
+
+for record_type_name, model_path, draft_model_path in args.corpus:
+    record_config = _RECORD_GENERATE_CONFIGS[RecordType[record_type_name.upper()]]
+    model, tokenizer = load_model(model_path, no_cuda=args.no_cuda)
+    draft_model, _ = load_model(draft_model_path, no_cuda=args.no_cuda)
+
+    print('{} ({} layers, draft model with {} layers):'.format(
+        record_type_name.upper(), model.config.n_layer, draft_model.config.n_layer
+    ))
+
+    baseline_time, baseline_stats = _run(model, tokenizer, record_config)
+    print('- without draft model: {:.2f} s, {} decode steps'.format(baseline_time, baseline_stats.decode_steps))
+    for num_draft_tokens in args.num_draft_tokens:
+        elapsed, stats = _run(model, tokenizer, record_config, draft_model, num_draft_tokens)
+        print('- {} draft tokens: {:.1%} accepted, {:.2f} accepted tokens per step, {:.2f} s ({:.2f}x)'.format(
+            num_draft_tokens, stats.draft_tokens_accepted / max(stats.draft_tokens, 1),
+            stats.draft_tokens_accepted / max(stats.decode_steps, 1),
+            elapsed, baseline_time / elapsed
+        ))
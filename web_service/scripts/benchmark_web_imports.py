@@ -0,0 +1,93 @@
+'''
+Measures the import time and memory usage of creating the Flask app (i.e.
+starting a web process), and fails if it imports the machine learning stack.
+
+Each measurement runs in a fresh interpreter, so that no module is already imported.
+
+'''
+
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+# The modules that the web process must not import.
+BANNED_MODULES = ['torch', 'transformers', 'tokenizers', 'ai_redditor_service.gpt2', 'ai_redditor_service.tasks']
+
+_MEASURE_SOURCE = '''
+import sys
+import json
+import time
+import resource
+
+sys.path.insert(0, {package_path!r})
+start_time = time.time()
+{statement}
+elapsed = time.time() - start_time
+
+print(json.dumps({{
+    'seconds': elapsed,
+    'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'modules': sorted(sys.modules.keys())
+}}))
+'''
+
+_TEST_CONFIG = {
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'CELERY_BROKER_URL': 'memory://',
+    'CELERY_RESULT_BACKEND': 'cache+memory://',
+    'SOCKETIO_MESSAGE_QUEUE': None
+}
+
+_STATEMENTS = {
+    'web': (
+        'from ai_redditor_service import create_app\n'
+        'app = create_app(test_config={!r})'.format(_TEST_CONFIG)
+    ),
+    'worker': (
+        'from ai_redditor_service import create_app\n'
+        'app = create_app(test_config={!r})\n'
+        'import ai_redditor_service.tasks'.format(_TEST_CONFIG)
+    )
+}
+
+parser = argparse.ArgumentParser(description='Benchmarks the imports of the web process.')
+parser.add_argument('--runs', type=int, default=3, help='The number of runs per measurement. Defaults to 3.')
+parser.add_argument('--compare-worker', action='store_true',
+                    help='Also measure the app with the tasks module imported (as in a worker).')
+args = parser.parse_args()
+
+def _measure(statement):
+    source = _MEASURE_SOURCE.format(
+        package_path=str(Path(__file__).resolve().parent.parent),
+        statement=statement
+    )
+
+    output = subprocess.run(
+        [sys.executable, '-c', source], check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ).stdout
+
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def _report(name, statement):
+    results = [_measure(statement) for _ in range(args.runs)]
+    print('- {}: {:.2f} s (min), {:.1f} MB max RSS'.format(
+        name, min(result['seconds'] for result in results),
+        min(result['max_rss'] for result in results) / 1024 ** 2
+    ))
+
+    return results[0]['modules']
+
+modules = _report('web', _STATEMENTS['web'])
+if args.compare_worker:
+    _report('worker', _STATEMENTS['worker'])
+
+imported = [name for name in BANNED_MODULES if name in modules]
+
+if len(imported) > 0:
+    print('The web process imports {}'.format(', '.join(imported)))
+    sys.exit(1)
+
+print('The web process does not import {}'.format(', '.join(BANNED_MODULES)))
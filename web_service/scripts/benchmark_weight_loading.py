@@ -0,0 +1,92 @@
+'''
+Compares the load time and memory usage of worker processes that load a model
+with "from_pretrained" (a private copy of the weights per worker) and from its
+memory mapped weight file (weights shared by all workers).
+
+The weight file has to be created first with the "convert-weights" command.
+Memory usage is read from /proc, so this script only runs on Linux.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/benchmark_weight_loading.py ...
+
+'''
+
+import sys
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description='Benchmarks loading a model with and without memory mapped weights.')
+parser.add_argument('model_path', type=str, help='The path to the pretrained model checkpoint (with a weight file).')
+parser.add_argument('--workers', type=int, default=4, help='The number of worker processes. Defaults to 4.')
+parser.add_argument('--method', type=str, default=None, choices=['from_pretrained', 'mmap'],
+                    help='Only benchmark this loading method. Defaults to both.')
+args = parser.parse_args()
+
+def _read_memory_usage():
+    '''
+    Gets the resident set size (RSS), proportional set size (PSS) and unique set
+    size (USS) of the current process, in bytes.
+
+    '''
+
+    usage = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0}
+    with open('/proc/self/smaps_rollup') as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            if key in usage:
+                usage[key] = int(value.split()[0]) * 1024
+
+    return usage['Rss'], usage['Pss'], usage['Private_Clean'] + usage['Private_Dirty']
+
+def _worker(method, barrier, results):
+    import torch
+    from ai_redditor_service.gpt2 import load_model
+
+    start_time = time.time()
+    model, _ = load_model(args.model_path, mmap_weights=method == 'mmap', no_cuda=True)
+    load_time = time.time() - start_time
+
+    # Run a forward pass so that every weight is paged in.
+    with torch.no_grad():
+        model(torch.zeros((1, 8), dtype=torch.long))
+
+    # Measure once every worker has loaded the model, so that shared pages are
+    # accounted for across all of them.
+    barrier.wait()
+    results.put((load_time,) + _read_memory_usage())
+    barrier.wait()
+
+def _benchmark(method):
+    # Spawn the workers so that none of them inherits pages from this process.
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.workers)
+    results = context.Queue()
+    workers = [context.Process(target=_worker, args=(method, barrier, results)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    measurements = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    load_times, rss, pss, uss = zip(*measurements)
+    print('- {} ({} workers):'.format(method, args.workers))
+    print('  load time: {:.2f} s (min), {:.2f} s (mean)'.format(min(load_times), sum(load_times) / len(load_times)))
+    print('  per worker: {:.1f} MB RSS, {:.1f} MB PSS, {:.1f} MB USS'.format(
+        sum(rss) / len(rss) / 1024 ** 2, sum(pss) / len(pss) / 1024 ** 2, sum(uss) / len(uss) / 1024 ** 2
+    ))
+
+    print('  total: {:.1f} MB PSS'.format(sum(pss) / 1024 ** 2))
+
+if __name__ == '__main__':
+    from ai_redditor_service.weights import WEIGHTS_FILENAME
+
+    if (args.method is None or args.method == 'mmap') and not (Path(args.model_path) / WEIGHTS_FILENAME).is_file():
+        print('\'{}\' has no weight file; create it with "flask convert-weights".'.format(args.model_path))
+        sys.exit(1)
+
+    for method in ['from_pretrained', 'mmap']:
+        if args.method is not None and method != args.method: continue
+        _benchmark(method)
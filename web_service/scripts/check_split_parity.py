@@ -0,0 +1,298 @@
+'''
+Checks that splitting model outputs on their special token ids gives the same
+groups as decoding them in full and splitting them with the decode regex, and
+compares the time taken by both.
+
+The outputs are a fixed set of valid and malformed records of each decode format
+(containing links, or whose special tokens are missing, repeated or out of order),
+followed by random outputs. They are encoded with a small byte-level BPE tokenizer
+built by this script, so that the check is deterministic and does not download a
+model; the tokenizer of a model can be given instead. The check fails if any output
+is split differently.
+
+The web service package must be on the Python path, e.g.:
+    PYTHONPATH=web_service python web_service/scripts/check_split_parity.py
+
+'''
+
+import json
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+import torch
+from transformers import AutoTokenizer, GPT2Tokenizer
+
+from ai_redditor_service.gpt2 import (
+    ModelDecodeFormat,
+    _split_record,
+    _split_records,
+    _get_decode_regex_mapping,
+    _get_decode_special_tokens_mapping
+)
+
+parser = argparse.ArgumentParser(description='Checks the parity of the token id and regex output splitting.')
+parser.add_argument('--tokenizer', type=str, default=None, help='The name or path of a tokenizer (with the special tokens ' +
+                    'of the models) to check instead of the tokenizer built by the script.')
+parser.add_argument('--samples', type=int, default=1000, help='The number of random outputs to split. Defaults to 1000.')
+parser.add_argument('--max-field-length', type=int, default=100,
+                    help='The maximum number of tokens in a field of a random output. Defaults to 100.')
+parser.add_argument('--malformed-probability', type=float, default=0.3,
+                    help='The probability that a random output is malformed (e.g. special tokens are missing, '
+                    'repeated or out of order). Defaults to 0.3.')
+parser.add_argument('--translate-token', type=str, default='<|eq_tok|>',
+                    help='The query/answer separator token. Defaults to \'<|eq_tok|>\'.')
+parser.add_argument('--end-of-likes-token', type=str, default='<|eol|>',
+                    help='The special token specifying the end of likes. Defaults to \'<|eol|>\'.')
+parser.add_argument('--seed', type=int, default=0, help='The seed of the random engine. Defaults to 0.')
+args = parser.parse_args()
+
+random.seed(args.seed)
+
+# The words merged by the vocabulary of the built tokenizer (the other text is spelled out in bytes).
+_WORDS = ['the', 'great', 'video', 'likes', 'john', 'https', 'www', 'pornhub', 'com', 'view', 'php']
+
+def _bytes_to_unicode():
+    '''
+    Gets the mapping of each byte to the unicode character that represents it in the
+    vocabulary of a byte-level BPE tokenizer (as in the GPT2 tokenizer).
+
+    '''
+
+    byte_values = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + \
+        list(range(ord('®'), ord('ÿ') + 1))
+
+    # The other bytes (whitespace and control characters) are shifted past the byte range.
+    characters = list(byte_values)
+    num_shifted = 0
+    for value in range(2 ** 8):
+        if value in byte_values: continue
+        byte_values.append(value)
+        characters.append(2 ** 8 + num_shifted)
+        num_shifted += 1
+
+    return dict(zip(byte_values, map(chr, characters)))
+
+def build_tokenizer():
+    '''
+    Builds a byte-level BPE tokenizer with a small vocabulary (the bytes and the ``_WORDS``,
+    with and without a leading space) and the special tokens of the models.
+
+    '''
+
+    byte_encoder = _bytes_to_unicode()
+    vocab = {character: token_id for token_id, character in enumerate(byte_encoder.values())}
+    merges = []
+    for word in _WORDS:
+        for symbols in (list(word), [byte_encoder[ord(' ')]] + list(word)):
+            # Merge the symbols of the word from left to right.
+            while len(symbols) > 1:
+                if (symbols[0], symbols[1]) not in merges:
+                    merges.append((symbols[0], symbols[1]))
+
+                symbols = [symbols[0] + symbols[1]] + symbols[2:]
+                vocab.setdefault(symbols[0], len(vocab))
+
+    vocab.setdefault('<|endoftext|>', len(vocab))
+    with tempfile.TemporaryDirectory() as directory:
+        vocab_file, merges_file = Path(directory) / 'vocab.json', Path(directory) / 'merges.txt'
+        with open(vocab_file, 'w+', encoding='utf-8') as file:
+            json.dump(vocab, file)
+
+        with open(merges_file, 'w+', encoding='utf-8') as file:
+            file.write('#version: 0.2\n' + ''.join('{} {}\n'.format(*pair) for pair in merges))
+
+        tokenizer = GPT2Tokenizer(str(vocab_file), str(merges_file))
+
+    tokenizer.add_special_tokens({
+        'bos_token': '<|bos|>',
+        'eos_token': '<|eos|>',
+        'pad_token': '<|pad|>',
+        'additional_special_tokens': [args.translate_token, args.end_of_likes_token]
+    })
+
+    return tokenizer
+
+tokenizer = AutoTokenizer.from_pretrained(args.tokenizer) if args.tokenizer is not None else build_tokenizer()
+bos, eos, pad = tokenizer.bos_token, tokenizer.eos_token, tokenizer.pad_token
+translate, end_of_likes = args.translate_token, args.end_of_likes_token
+link = ' https://www.pornhub.com/view_video.php?viewkey=1'
+
+# The fixed outputs of each decode format, as text (in which the special tokens are encoded as such).
+_FIXED_OUTPUTS = {
+    ModelDecodeFormat.QUERY_ANSWER: [
+        # Valid records.
+        f'{bos}the great video{translate} the video was great{eos}',
+        f'{bos}the{translate}great{eos}{pad}{pad}',
+        f'{bos} the video {translate} {link} {eos}',
+        # Missing special tokens.
+        f'the great video{translate} the video{eos}',
+        f'{bos}the great video the video{eos}',
+        f'{bos}the great video{translate} the video',
+        # Repeated special tokens.
+        f'{bos}{bos}the video{translate} great{eos}',
+        f'{bos}the video{translate} great{translate} video{eos}',
+        f'{bos}the video{translate} great{eos}{eos}',
+        # Special tokens out of order.
+        f'{bos}the video{eos} great{translate}',
+        f'{translate}the video{bos} great{eos}',
+        # Empty or blank fields.
+        f'{bos}{translate} great{eos}',
+        f'{bos}the video{translate}{eos}',
+        f'{bos} {translate} {eos}',
+        # Text after the end of sentence token.
+        f'{bos}the video{translate} great{eos} the',
+        f'{bos}the video{translate} great{eos}{bos}john{translate} likes{eos}',
+        # Other special tokens in a field.
+        f'{bos}the video{end_of_likes} john{translate} great{eos}',
+        f'{bos}the video{translate} great{pad} video{eos}'
+    ],
+    ModelDecodeFormat.PHC: [
+        # Valid records.
+        f'{bos}12{end_of_likes}john{translate}great video{eos}',
+        f'{bos}0{end_of_likes} john {translate} the video was great {eos}{pad}{pad}{pad}',
+        # Links in the comment, and at the end of each group.
+        f'{bos}3{end_of_likes}john{translate}the video{link} great{eos}',
+        f'{bos}3{end_of_likes}john{translate}the video pornhub.com{eos}',
+        f'{bos}3{end_of_likes}pornhub.com{translate}the video{eos}',
+        f'{bos}pornhub.com{end_of_likes}john{translate}the video{eos}',
+        f'{bos}3{end_of_likes}john{translate}the video{eos} pornhub.com',
+        # Missing special tokens.
+        f'12{end_of_likes}john{translate}great video{eos}',
+        f'{bos}12 john{translate}great video{eos}',
+        f'{bos}12{end_of_likes}john great video{eos}',
+        f'{bos}12{end_of_likes}john{translate}great video',
+        # Repeated special tokens.
+        f'{bos}12{end_of_likes}{end_of_likes}john{translate}great video{eos}',
+        f'{bos}12{end_of_likes}john{end_of_likes}the{translate}great video{eos}',
+        f'{bos}12{end_of_likes}john{translate}great{translate} video{eos}',
+        f'{bos}12{end_of_likes}john{translate}great video{eos}{eos}',
+        # Special tokens out of order.
+        f'{bos}12{translate}john{end_of_likes}great video{eos}',
+        f'{bos}12{end_of_likes}john{eos}great video{translate}',
+        f'{end_of_likes}12{bos}john{translate}great video{eos}',
+        # Empty or blank fields.
+        f'{bos}{end_of_likes}john{translate}great video{eos}',
+        f'{bos}12{end_of_likes}{translate}great video{eos}',
+        f'{bos}12{end_of_likes}john{translate}{eos}',
+        f'{bos} {end_of_likes} {translate} {eos}',
+        # Text after the end of sentence token.
+        f'{bos}12{end_of_likes}john{translate}great video{eos} the',
+        f'{bos}12{end_of_likes}john{translate}great video{eos}{bos}1{end_of_likes}the{translate}video{eos}',
+        # Padding in a field.
+        f'{bos}12{end_of_likes}john{pad}{translate}great video{eos}'
+    ]
+}
+
+def random_output(special_token_ids, text_token_ids, link_token_ids):
+    '''
+    Gets the token ids of a random model output, laid out in the decode format.
+
+    '''
+
+    def _random_field():
+        # A random field (possibly empty or containing a link).
+        field = [random.choice(text_token_ids) for _ in range(random.randint(0, args.max_field_length))]
+        if random.random() < 0.05:
+            field[random.randint(0, len(field)):0] = link_token_ids
+
+        return field
+
+    special_tokens = list(special_token_ids)
+    if random.random() < args.malformed_probability:
+        i = random.randrange(len(special_tokens))
+        malformation = random.choice(['drop', 'repeat', 'swap', 'replace'])
+        if malformation == 'drop':
+            del special_tokens[i]
+        elif malformation == 'repeat':
+            special_tokens.insert(i, special_tokens[i])
+        elif malformation == 'swap' and len(special_tokens) > 1:
+            j = random.randrange(len(special_tokens))
+            special_tokens[i], special_tokens[j] = special_tokens[j], special_tokens[i]
+        else:
+            special_tokens[i] = random.choice(text_token_ids)
+
+    output = []
+    for i, token_id in enumerate(special_tokens):
+        output.append(token_id)
+        if i < len(special_tokens) - 1 or random.random() < 0.05:
+            output.extend(_random_field())
+
+    return output
+
+text_token_ids = [
+    token_id for token_id in range(len(tokenizer))
+    if token_id not in tokenizer.all_special_ids
+]
+
+link_token_ids = tokenizer.encode(link, add_special_tokens=False)
+
+num_mismatches = 0
+for decode_format in ModelDecodeFormat:
+    decode_strict_regex = _get_decode_regex_mapping(
+        True, bos, eos, translate, end_of_likes
+    )[decode_format]
+
+    special_token_ids = tokenizer.convert_tokens_to_ids(_get_decode_special_tokens_mapping(
+        bos, eos, translate, end_of_likes
+    )[decode_format])
+
+    fixed_outputs = [tokenizer.encode(text, add_special_tokens=False) for text in _FIXED_OUTPUTS[decode_format]]
+    # Each fixed output is split both with and without the link filter.
+    outputs = [x for x in fixed_outputs for _ in range(2)] + [
+        random_output(special_token_ids, text_token_ids, link_token_ids) for _ in range(args.samples)
+    ]
+
+    use_link_filters = [i % 2 == 0 for i in range(2 * len(fixed_outputs))] + [
+        random.random() < 0.5 for _ in range(args.samples)
+    ]
+
+    max_length = max(len(x) for x in outputs)
+    output = torch.tensor([
+        x + [tokenizer.pad_token_id] * (max_length - len(x)) for x in outputs
+    ])
+
+    rows = list(range(len(outputs)))
+
+    start_time = time.time()
+    regex_groups = [
+        _split_record(
+            tokenizer.decode(output[row, :].tolist()), decode_format,
+            decode_strict_regex, use_link_filter=use_link_filters[row]
+        ) for row in rows
+    ]
+    regex_time = time.time() - start_time
+
+    start_time = time.time()
+    token_groups = _split_records(
+        output, rows, tokenizer, decode_format, decode_strict_regex,
+        special_token_ids, use_link_filters
+    )
+    token_time = time.time() - start_time
+
+    mismatches = [row for row in rows if regex_groups[row] != token_groups[row]]
+    for row in mismatches[:10]:
+        print('- Mismatch in {} output {}: {}'.format(
+            decode_format.name, row, repr(tokenizer.decode(output[row, :].tolist()))
+        ))
+
+        print('  regex: {}'.format(regex_groups[row]))
+        print('  token ids: {}'.format(token_groups[row]))
+
+    print('- {}: split {} outputs ({} fixed, {} valid records); {} mismatches'.format(
+        decode_format.name, len(rows), len(fixed_outputs) * 2,
+        sum(groups is not None for groups in regex_groups), len(mismatches)
+    ))
+
+    print('  Regex: {:.2f} ms per output; token ids: {:.2f} ms per output ({:.1f}x)'.format(
+        regex_time / len(rows) * 1000, token_time / len(rows) * 1000,
+        regex_time / token_time if token_time > 0 else float('inf')
+    ))
+
+    num_mismatches += len(mismatches)
+
+assert num_mismatches == 0, '{} outputs were split differently on their token ids and with the decode regex.'.format(
+    num_mismatches
+)